@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A local API to submit files to a running sorter, over a Unix socket
+
+Clients connect to the socket, and send a single request, as a line of JSON,
+e.g.::
+
+  {"paths": ["/uploads/img_0001.jpg", "/uploads/2019"], "wait": true}
+
+Files and directories (that are scanned recursively) are queued for import
+right away, with the files found by the sorter itself: they are assumed to
+be complete.  They must be under the source folder of one of the sorter's
+routes, so that clients cannot have files imported (and, when moving, removed)
+from anywhere else.  The server replies with lines of JSON:
+
+  1. ``{"job": 1, "files": 12}``: the job was accepted, with the number of
+     files queued.  If ``wait`` was not set, the connection is closed.
+  2. ``{"job": 1, "src": ..., "dst": ..., "status": ..., "action": ...,
+     "error": ...}``: as each file is processed.  The status is one of
+     ``imported``, ``ignored`` or ``failed``.  For imported files, the action
+     is one of :py:data:`popster.records.ACTIONS`.
+  3. ``{"job": 1, "done": true, "imported": 10, "ignored": 1, "failed": 1}``:
+     once all files were processed.  If the sorter stops before that,
+     ``done`` is ``false``, and the number of files left is given as
+     ``remaining``.
+
+Invalid requests, and requests with paths outside source folders, are
+answered with ``{"error": ...}``, and nothing is queued.  See :py:func:`submit`
+for a client.
+"""
+
+import os
+import json
+import queue
+import socket
+import threading
+import itertools
+import socketserver
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .sorter import ExplicitIgnore, UnsupportedExtensionError
+
+
+def record_status(record):
+    """Returns the status reported for an import record
+
+  It is one of ``imported``, ``ignored`` or ``failed``.  Shared with the
+  ``import`` program, so that both report files the same way.
+
+  """
+
+    if record.error is None:
+        return "imported"
+    if issubclass(record.error, (ExplicitIgnore, UnsupportedExtensionError)):
+        return "ignored"
+    return "failed"
+
+
+class _Job(object):
+    """Files submitted by a client, and the events to stream back"""
+
+    def __init__(self, number, files):
+        self.number = number
+        self.remaining = set(files)
+        self.counts = dict(imported=0, ignored=0, failed=0)
+        self.events = queue.Queue()
+
+    def update(self, record):
+        """Records a file was processed, queues the corresponding events"""
+
+        self.remaining.discard(record.src)
+        status = record_status(record)
+        self.counts[status] += 1
+        self.events.put(
+            dict(
+                job=self.number,
+                src=record.src,
+                dst=record.dst,
+                status=status,
+                action=record.action,
+                error=None if record.error is None else record.error.__name__,
+            )
+        )
+        if not self.remaining:
+            self.events.put(dict(job=self.number, done=True, **self.counts))
+            self.events.put(None)
+
+    def abort(self):
+        """Queues the final events, if the sorter stops before completion"""
+
+        self.events.put(
+            dict(
+                job=self.number,
+                done=False,
+                remaining=len(self.remaining),
+                **self.counts
+            )
+        )
+        self.events.put(None)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Serves a single request, see :py:mod:`popster.api`"""
+
+    def _send(self, data):
+        self.wfile.write((json.dumps(data) + "\n").encode())
+        self.wfile.flush()
+
+    def handle(self):
+
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            paths = request["paths"]
+            if isinstance(paths, str) or not all(
+                [isinstance(k, str) for k in paths]
+            ):
+                raise ValueError("paths must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(dict(error="invalid request: %s" % e))
+            return
+
+        try:
+            job = self.server.api.submit(paths)
+        except ValueError as e:
+            self._send(dict(error="refused: %s" % e))
+            return
+        self._send(dict(job=job.number, files=len(job.remaining)))
+        if not request.get("wait", True):
+            return
+
+        try:
+            while True:
+                event = job.events.get()
+                if event is None:
+                    break
+                self._send(event)
+        except OSError:  # client went away
+            logger.debug("[api] client of job %d went away", job.number)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+
+class Server(object):
+    """Serves requests to submit files to a sorter
+
+
+  Parameters:
+
+    path (str): Path leading to the Unix socket to listen on.  A stale socket
+      at this path is removed.
+
+    sorter (popster.sorter.Sorter): The sorter to submit files to
+
+  """
+
+    def __init__(self, path, sorter):
+
+        self.path = path
+        self.sorter = sorter
+        self.lock = threading.Lock()
+        self.waiting = {}  # path -> list of jobs
+        self.jobs = set()
+        self._numbers = itertools.count(1)
+
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise RuntimeError("%s is in use by another process" % path)
+            except OSError:
+                os.unlink(path)
+            finally:
+                probe.close()
+
+        self.server = _UnixServer(path, _RequestHandler)
+        self.server.api = self
+        os.chmod(path, 0o660)
+        self.thread = None
+
+        for handler in sorter.handlers:
+            handler.listeners.append(self.completed)
+
+    def submit(self, paths):
+        """Queues files (or directories) for import, returns the new job"""
+
+        # held while queueing, so that files cannot complete before the job
+        # is registered
+        with self.lock:
+            files = self.sorter.submit(paths)
+            job = _Job(next(self._numbers), files)
+            for k in job.remaining:
+                self.waiting.setdefault(k, []).append(job)
+            if job.remaining:
+                self.jobs.add(job)
+            else:
+                job.events.put(dict(job=job.number, done=True, **job.counts))
+                job.events.put(None)
+
+        logger.info(
+            "[api] job %d: %d file(s) submitted", job.number, len(files)
+        )
+        return job
+
+    def completed(self, records):
+        """Notifies jobs waiting for files that were processed"""
+
+        with self.lock:
+            for record in records:
+                for job in self.waiting.pop(record.src, []):
+                    job.update(record)
+                    if not job.remaining:
+                        self.jobs.discard(job)
+                        logger.info("[api] job %d done", job.number)
+
+    def start(self):
+        """Starts serving requests on a separate thread"""
+
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="popster-api"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("[api] listening on %s", self.path)
+
+    def stop(self):
+        """Stops serving new requests
+
+    Clients waiting for jobs to complete are still served, until
+    :py:meth:`close` is called.
+
+    """
+
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        """Stops serving requests, aborts jobs that did not complete"""
+
+        self.stop()
+        with self.lock:
+            for job in self.jobs:
+                job.abort()
+            self.jobs = set()
+            self.waiting = {}
+
+
+def submit(path, paths, wait=True, timeout=None):
+    """Submits files to a sorter serving requests on a Unix socket
+
+
+  Parameters:
+
+    path (str): Path leading to the Unix socket of the sorter
+
+    paths (list): Paths of files or directories to import
+
+    wait (bool): If set, wait for files to be processed
+
+    timeout (float): If set, maximum number of seconds to wait for each reply
+
+
+  Yields:
+
+    dict: Each reply from the sorter, see :py:mod:`popster.api`
+
+
+  Raises:
+
+    RuntimeError: If the request is refused (e.g. if a path is not under a
+    source folder of the sorter)
+
+  """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        request = dict(paths=[os.path.abspath(k) for k in paths], wait=wait)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile("rb") as f:
+            for line in f:
+                reply = json.loads(line.decode())
+                if "job" not in reply:
+                    raise RuntimeError(reply.get("error"))
+                yield reply
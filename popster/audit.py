@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Audits of date metadata on large numbers of files, before importing them
+
+Each file is probed (see :py:func:`probe`) as it would be during an import:
+its date is read from metadata, falling back to the file system timestamp if
+that fails.  Probes record which reader was used, whether it fell back, how
+long it took and how many bytes were read, so that slow or failing kinds of
+files can be found (see :py:class:`Summary`).  Files are probed concurrently,
+see :py:func:`probe_all`.
+"""
+
+import os
+import time
+import functools
+import collections
+import concurrent.futures
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .sorter import (
+    CREATION_DATE_READER,
+    READERS,
+    DateReadoutError,
+    file_timestamp,
+    _jpeg_read_creation_date,
+    _select_dir,
+    _select_file,
+)
+from .walker import walk
+
+
+COLUMNS = (
+    "path",
+    "extension",
+    "model",
+    "date",
+    "reader",
+    "fallback",
+    "error",
+    "elapsed",
+    "bytes",
+)
+"""Columns of the table of probes, see :py:meth:`DateProbe.row`"""
+
+
+def _rchar():
+    """Returns the number of bytes read so far by the calling thread
+
+  Returns ``None`` if the operating system does not account for them (only
+  Linux does).  Otherwise, returns a tuple with the number of bytes read
+  before the call, and the number of bytes read by the call itself, from the
+  accounting file.
+
+  """
+
+    try:
+        with open("/proc/thread-self/io", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    for line in data.splitlines():
+        if line.startswith(b"rchar:"):
+            return int(line.split()[1]), len(data)
+    return None
+
+
+class DateProbe(object):
+    """The outcome of reading the date of a single file
+
+
+  Parameters:
+
+    path (str): The path leading to the file
+
+    model (str): The camera model, if found on the metadata that was read
+
+    date (datetime.datetime): The date of the file, or ``None``, if none was
+      found
+
+    reader (str): How the date was found, see
+      :py:data:`popster.sorter.READERS`, or ``None``
+
+    fallback (bool): ``True`` if the date could not be read from metadata, and
+      the file system timestamp was used instead
+
+    error (str): Why the date could not be read from metadata, or ``None``
+
+    elapsed (float): Number of seconds spent reading the date
+
+    nbytes (int): Number of bytes read from disk to find the date, or
+      ``None``, if unknown
+
+  """
+
+    __slots__ = (
+        "path",
+        "model",
+        "date",
+        "reader",
+        "fallback",
+        "error",
+        "elapsed",
+        "nbytes",
+    )
+
+    def __init__(
+        self,
+        path,
+        model=None,
+        date=None,
+        reader=None,
+        fallback=False,
+        error=None,
+        elapsed=0.0,
+        nbytes=None,
+    ):
+
+        self.path = path
+        self.model = model
+        self.date = date
+        self.reader = reader
+        self.fallback = fallback
+        self.error = error
+        self.elapsed = elapsed
+        self.nbytes = nbytes
+
+    @property
+    def extension(self):
+        """The file extension, in lower case"""
+
+        return os.path.splitext(self.path)[1].lower()
+
+    @property
+    def failed(self):
+        """``True`` if the date could not be read from metadata"""
+
+        return self.error is not None
+
+    def row(self):
+        """Returns the probe as a list, with values for :py:data:`COLUMNS`"""
+
+        return [
+            self.path,
+            self.extension,
+            self.model,
+            None if self.date is None else self.date.isoformat(),
+            self.reader,
+            self.fallback,
+            self.error,
+            round(self.elapsed, 6),
+            self.nbytes,
+        ]
+
+    def __repr__(self):
+        return "DateProbe(%r, %s, reader=%s)" % (
+            self.path,
+            self.date,
+            self.reader,
+        )
+
+
+def probe(path):
+    """Reads the date of a file, recording how it was found
+
+  Dates are read as during an import with file system timestamps enabled (see
+  :py:func:`popster.sorter.copy`).  The camera model is only recorded for
+  files with EXIF metadata, as it is found while looking for the date.
+
+
+  Parameters:
+
+    path (str): The path leading to the file to probe
+
+
+  Returns:
+
+    DateProbe: How the date of the file was found.  Files with unsupported
+    extensions, and files that cannot be read, have no date, and their
+    ``error`` attribute set.
+
+  """
+
+    retval = DateProbe(path)
+    reader = CREATION_DATE_READER.get(retval.extension)
+    tags = {}
+
+    start = time.perf_counter()
+    before = _rchar()
+    try:
+        if reader is None:
+            retval.error = "unsupported extension"
+        elif reader is _jpeg_read_creation_date:
+            retval.date = reader(path, tags)
+        else:
+            retval.date = reader(path)
+        retval.reader = READERS.get(reader)
+    except DateReadoutError as e:
+        logger.debug("no date metadata at %s: %s", path, e)
+        retval.error = str(e) or type(e).__name__
+        try:
+            retval.date = file_timestamp(path)
+            retval.reader = READERS[file_timestamp]
+            retval.fallback = True
+        except OSError as e:  # e.g. removed while probing
+            retval.error = str(e)
+    except OSError as e:  # e.g. unreadable, or removed while probing
+        logger.debug("cannot read %s: %s", path, e)
+        retval.error = str(e) or type(e).__name__
+    after = _rchar()
+    retval.elapsed = time.perf_counter() - start
+
+    if before is not None and after is not None:
+        retval.nbytes = after[0] - sum(before)
+    if "Image Model" in tags:
+        retval.model = tags["Image Model"].printable.strip() or None
+    return retval
+
+
+def _expand(paths, workers, rules=None):
+    """Yields the paths of files, recursing into directories"""
+
+    select_dir = functools.partial(
+        _select_dir, erase=False, dry=True, rules=rules
+    )
+    select_file = functools.partial(
+        _select_file, erase=False, dry=True, rules=rules
+    )
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for entry in walk(path, select_dir, select_file, workers):
+            yield entry.path
+
+
+def probe_all(paths, workers=1, rules=None):
+    """Probes files concurrently
+
+
+  Parameters:
+
+    paths (list): Paths leading to files to probe, or directories to probe
+      recursively.  Hidden files and directories, and useless ones produced
+      by cameras are skipped, as during imports.
+
+    workers (int): Number of files to probe concurrently (and of directories
+      to scan concurrently)
+
+    rules (popster.rules.Rules): Rules deciding which directories and files
+      are hidden or useless.  If not set, use the default ones.
+
+
+  Yields:
+
+    DateProbe: A probe for each file, in the order files are found.  Only a
+    bounded number of probes are in flight, so that huge trees may be
+    probed.
+
+  """
+
+    files = _expand(paths, workers, rules)
+    if workers <= 1:
+        yield from map(probe, files)
+        return
+
+    inflight = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for path in files:
+            inflight.append(pool.submit(probe, path))
+            if len(inflight) >= 2 * workers:
+                yield inflight.popleft().result()
+        while inflight:
+            yield inflight.popleft().result()
+
+
+class _Tally(object):
+    """Statistics of probes of a kind of file"""
+
+    __slots__ = ("files", "failed", "elapsed", "slowest", "nbytes")
+
+    def __init__(self):
+
+        self.files = 0
+        self.failed = 0
+        self.elapsed = 0.0
+        self.slowest = 0.0
+        self.nbytes = 0
+
+    def add(self, probe):
+
+        self.files += 1
+        self.failed += probe.failed
+        self.elapsed += probe.elapsed
+        self.slowest = max(self.slowest, probe.elapsed)
+        self.nbytes += probe.nbytes or 0
+
+    def line(self, name, indent="  "):
+        """Returns a line of the summary, for the kind of file ``name``"""
+
+        return (
+            "%s%s: %d file(s), %d failed (%.1f%%), %.1f ms mean, %.1f ms max, "
+            "%.1f kB/file\n"
+            % (
+                indent,
+                name,
+                self.files,
+                self.failed,
+                100.0 * self.failed / self.files,
+                1000.0 * self.elapsed / self.files,
+                1000.0 * self.slowest,
+                self.nbytes / 1000.0 / self.files,
+            )
+        )
+
+
+class Summary(object):
+    """Summarizes probes per file extension and camera model
+
+  Kinds of files are listed by the total time spent reading their dates, so
+  that the ones slowing an import down come first.
+
+
+  Parameters:
+
+    top (int): Maximum number of camera models to list
+
+  """
+
+    def __init__(self, top=20):
+
+        self.top = top
+        self.extensions = collections.defaultdict(_Tally)
+        self.models = collections.defaultdict(_Tally)
+        self.readers = collections.Counter()
+        self.total = _Tally()
+
+    def add(self, probe):
+        """Accounts for a new probe"""
+
+        self.total.add(probe)
+        self.extensions[probe.extension or "(none)"].add(probe)
+        if probe.model is not None:
+            self.models[probe.model].add(probe)
+        self.readers[probe.reader or "(none)"] += 1
+
+    @staticmethod
+    def _slowest(tallies, top=None):
+        """Returns (name, tally) pairs, by decreasing total time"""
+
+        return sorted(tallies.items(), key=lambda k: -k[1].elapsed)[:top]
+
+    def lines(self):
+        """Yields the lines of the summary"""
+
+        if not self.total.files:
+            yield "No files probed\n"
+            return
+
+        yield self.total.line("Total", indent="")
+        yield "Readers: %s\n" % ", ".join(
+            ["%s: %d" % k for k in self.readers.most_common()]
+        )
+        yield "Per extension:\n"
+        for name, tally in self._slowest(self.extensions):
+            yield tally.line(name)
+        if self.models:
+            yield "Per camera model:\n"
+            for name, tally in self._slowest(self.models, self.top):
+                yield tally.line(name)
+            others = len(self.models) - self.top
+            if others > 0:
+                yield "  (and %d other models)\n" % others
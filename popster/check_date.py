@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 
-"""Checks the date on a particular media asset
+"""Checks the date on media assets
 
 Usage: %(prog)s [-v...] [options] <path> [<path>...]
        %(prog)s --help
@@ -10,7 +10,8 @@ Usage: %(prog)s [-v...] [options] <path> [<path>...]
 
 
 Arguments:
-  <path>  Path to asset to check date from
+  <path>  Path to asset to check date from.  Directories are checked
+          recursively
 
 
 Options:
@@ -18,6 +19,28 @@ Options:
   -V, --version               Prints the version and exits
   -v, --verbose               Increases the output verbosity level. May be used
                               multiple times
+  -W, --workers=<n>           Number of files to check concurrently
+                              [default: 4]
+  -F, --format=<fmt>          How to output the date of each file: "text" (one
+                              "path: date" line), "json" (one JSON object per
+                              line) or "csv" [default: text]
+  -o, --output=<path>         Where to write the date of each file. Use "-"
+                              for the standard output [default: -]
+  -s, --summary               At the end, print a summary of readers, failures,
+                              times and bytes read per file extension and
+                              camera model on the standard error
+  -U, --rules=<path>          Path leading to a JSON file with rules deciding
+                              which files are ignored when checking
+                              directories. See the help of the "watch" program
+
+
+With "json" and "csv", each file is described by its "path", "extension",
+camera "model" (for files with EXIF metadata), "date", "reader" (see the help
+of the "import" program), whether it fell back to the file system timestamp
+("fallback"), the "error" reading its metadata, the seconds it took
+("elapsed") and the number of "bytes" read (on Linux only).  Files are
+reported in the order they are found.  Progress is displayed on the standard
+error, if it is a terminal.
 
 
 Examples:
@@ -30,11 +53,17 @@ Examples:
 
      $ %(prog)s -vv /path/to/image.mov
 
+  3. Audit a whole archive before importing it
+
+     $ %(prog)s --workers=16 --format=csv --output=audit.csv --summary /archive
+
 """
 
 
 import os
 import sys
+import csv
+import json
 
 
 def main(user_input=None):
@@ -57,17 +86,53 @@ def main(user_input=None):
     )
 
     from .sorter import setup_logger
+    from .rules import Rules
+    from .audit import probe_all, Summary, COLUMNS
 
     logger = setup_logger("popster", args["--verbose"])
 
-    from .sorter import read_creation_date, file_timestamp, DateReadoutError
-
-    for path in args["<path>"]:
-        try:
-            date = read_creation_date(path)
-        except DateReadoutError:
-            logger.warn(
-                "no date metadata at %s - returning creation date" % path
-            )
-            date = file_timestamp(path)
-        print("%s: %s" % (path, date))
+    if args["--format"] not in ("text", "json", "csv"):
+        raise ValueError("unsupported output format %r" % args["--format"])
+
+    import tqdm
+
+    rules = Rules.load(args["--rules"]) if args["--rules"] else None
+    summary = Summary()
+    output = sys.stdout
+    if args["--output"] != "-":
+        output = open(args["--output"], "wt", newline="")
+    writer = None
+    if args["--format"] == "csv":
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(COLUMNS)
+
+    try:
+        probes = probe_all(args["<path>"], int(args["--workers"]), rules)
+        with tqdm.tqdm(
+            probes, unit=" files", file=sys.stderr, disable=None
+        ) as progress:
+            for probe in progress:
+                summary.add(probe)
+                if args["--format"] == "json":
+                    output.write(json.dumps(dict(zip(COLUMNS, probe.row()))))
+                    output.write("\n")
+                elif writer is not None:
+                    writer.writerow(probe.row())
+                elif probe.fallback:
+                    output.write(
+                        "%s: %s (file timestamp)\n" % (probe.path, probe.date)
+                    )
+                else:
+                    output.write("%s: %s\n" % (probe.path, probe.date))
+                if probe.failed:
+                    logger.info(
+                        "no date metadata at %s: %s", probe.path, probe.error
+                    )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    if args["--summary"]:
+        sys.stderr.writelines(summary.lines())
+
+    return 0
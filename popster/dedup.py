@@ -12,6 +12,8 @@ logger = logging.getLogger(__name__)
 
 import tqdm
 
+from .walker import walk
+
 # from https://stackoverflow.com/questions/748675/finding-duplicate-files-and-removing-them
 
 
@@ -39,8 +41,11 @@ def get_hash(filename, first_chunk_only=False, hash=hashlib.sha256):
     return hashed
 
 
-def check_duplicates(paths, hash=hashlib.sha256):
-    """Checks for duplicates in multiple paths, returns a list of duplicates"""
+def check_duplicates(paths, hash=hashlib.sha256, workers=4):
+    """Checks for duplicates in multiple paths, returns a list of duplicates
+
+    Directories are scanned with ``workers`` threads.
+    """
 
     assert isinstance(paths, (tuple, list))
 
@@ -53,33 +58,31 @@ def check_duplicates(paths, hash=hashlib.sha256):
     hashes_full = {}  # dict of full_file_hash: full_path_to_file_string
 
     for path in paths:
-        for dirpath, dirnames, filenames in tqdm.tqdm(
-            os.walk(path),
-            desc="scanning directories",
+        # resolves symbolic links on the path once - entries found below it
+        # are real paths, unless they are symbolic links themselves
+        for entry in tqdm.tqdm(
+            walk(os.path.realpath(path), workers=workers),
+            desc="scanning files",
             unit="",
             leave=True,
             disable=None,
         ):
             # get all files that have the same size -
             # they are the collision candidates
-            for filename in tqdm.tqdm(
-                sorted(filenames),
-                desc="hashing file sizes",
-                unit="",
-                leave=False,
-                disable=None,
-            ):
-                full_path = os.path.join(dirpath, filename)
-                try:
+            try:
+                if entry.is_symlink():
                     # if the target is a symlink (soft one), this will
                     # dereference it - change the value to the actual target
                     # file
-                    full_path = os.path.realpath(full_path)
+                    full_path = os.path.realpath(entry.path)
                     file_size = os.path.getsize(full_path)
-                    hashes_by_size[file_size].append(full_path)
-                except (OSError,):
-                    # not accessible (permissions, etc) - pass on
-                    continue
+                else:
+                    full_path = entry.path
+                    file_size = entry.stat().st_size
+                hashes_by_size[file_size].append(full_path)
+            except (OSError,):
+                # not accessible (permissions, etc) - pass on
+                continue
 
     # For all files with the same file size, get their hash on the 1st 1024
     # bytes only
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Composition of digest e-mails about imported files
+
+Digests are bounded in size, no matter how many files were imported: they
+summarize counts, bytes and date ranges per folder, list a few example files
+and attach the full lists as compressed CSV tables (see
+:py:meth:`popster.results.Results.table`).  The body is produced line by line,
+see :py:meth:`Digest.lines`.
+"""
+
+import io
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _size(n):
+    """Formats a number of bytes for humans"""
+
+    for unit in ("bytes", "kB", "MB", "GB"):
+        if n < 1000:
+            break
+        n /= 1000.0
+    else:
+        unit = "TB"
+    if unit == "bytes":
+        return "%d bytes" % n
+    return "%.1f %s" % (n, unit)
+
+
+def _range(first, last):
+    """Formats a range of dates for humans"""
+
+    first = first.strftime("%Y-%m-%d %H:%M")
+    if first[:10] == last.strftime("%Y-%m-%d"):
+        last = last.strftime("%H:%M")
+    else:
+        last = last.strftime("%Y-%m-%d %H:%M")
+    if first == last:
+        return first
+    return "%s to %s" % (first, last)
+
+
+class Digest(object):
+    """Summarizes results of imports, for an e-mail
+
+
+  Parameters:
+
+    base (str): The source folder of the imports
+
+    dst (str): The destination folder of the imports
+
+    good (popster.results.Results): Destination paths of files that were
+      imported
+
+    bad (popster.results.Results): Source paths of files that could not be
+      imported
+
+    folders (int): Maximum number of folders to list, per result
+
+  """
+
+    def __init__(self, base, dst, good, bad, folders=20):
+
+        self.base = base
+        self.dst = dst
+        self.good = good
+        self.bad = bad
+        self.folders = folders
+
+    def subject(self):
+        """Returns the subject of the e-mail"""
+
+        if not self.good:
+            return "%d files may need manual intervention" % len(self.bad)
+        return "Organized %d files for you" % len(self.good)
+
+    def _summary(self, results, base):
+        """Yields lines summarizing results, relative to a folder"""
+
+        total = "%d files" % len(results)
+        if results.sizes:
+            total += ", %s" % _size(results.size)
+        if results.dates:
+            total += ", dated %s" % _range(
+                min([k[0] for k in results.dates.values()]),
+                max([k[1] for k in results.dates.values()]),
+            )
+        yield "Total: %s\n" % total
+        yield "\n"
+
+        if len(results) <= results.sample_size:
+            for path in results.sample:
+                yield "%s\n" % path
+            yield "\n"
+            return
+
+        yield "Number of files per folder:\n"
+        yield "\n"
+        for folder, count in results.folders.most_common(self.folders):
+            line = "  %s: %d" % (os.path.relpath(folder, base), count)
+            if folder in results.sizes:
+                line += ", %s" % _size(results.sizes[folder])
+            if folder in results.dates:
+                line += ", %s" % _range(*results.dates[folder])
+            yield line + "\n"
+        others = len(results.folders) - self.folders
+        if others > 0:
+            yield "  (and %d other folders)\n" % others
+        yield "\n"
+        yield "Some of the files:\n"
+        yield "\n"
+        for path in results.sample:
+            yield "%s\n" % path
+        yield "...\n"
+        yield "\n"
+
+    def lines(self):
+        """Yields the lines of the e-mail body"""
+
+        yield "Hello,\n"
+        yield "\n"
+        yield (
+            "This is an automated message that summarizes actions I "
+            'performed at folder\n"%s" for you.\n' % self.base
+        )
+        yield "\n"
+
+        if self.good:
+            yield "List of files correctly moved (%d):\n" % len(self.good)
+            yield "\n"
+            yield from self._summary(self.good, self.dst)
+        else:
+            yield "No files moved\n"
+            yield "\n"
+
+        if self.bad:
+            yield "List of files that could NOT be moved (%d):\n" % len(
+                self.bad
+            )
+            yield "\n"
+            yield from self._summary(self.bad, self.base)
+        else:
+            yield "No problems found!\n"
+            yield "\n"
+
+        if self._attached(self.good) or self._attached(self.bad):
+            yield (
+                "The full lists of files are attached, as compressed CSV "
+                "tables.\n"
+            )
+            yield "\n"
+
+        yield "That is it, have a good day!\n"
+        yield "\n"
+        yield "Your faithul robot\n"
+
+    def body(self):
+        """Returns the e-mail body, as a string
+
+    The body is bounded in size, as only a few paths are listed.
+
+    """
+
+        retval = io.StringIO()
+        retval.writelines(self.lines())
+        return retval.getvalue()
+
+    @staticmethod
+    def _attached(results):
+        """Tells if results are attached, as they do not fit on the body"""
+
+        return len(results) > results.sample_size
+
+    def attachments(self):
+        """Returns the full lists of files that are not listed on the body
+
+    Returns:
+
+      list: Tuples ``(filename, data)``, with compressed CSV tables
+
+    """
+
+        retval = []
+        if self._attached(self.good):
+            retval.append(("moved.csv.gz", self.good.table()))
+        if self._attached(self.bad):
+            retval.append(("failed.csv.gz", self.bad.table()))
+        return retval
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Persisted directory fingerprints, to skip unchanged directories on restart
+
+In copy mode, files are left on the source folder after import, and scanning
+it again on every restart means stat'ing (and tracking) every file it
+contains.  A fingerprint of each directory listed (its modification time, the
+number of entries selected in it and a hash of their names) is kept in the
+state directory.  On the next start, directories with the same fingerprint
+had all their files handled already, and only their sub-directories are
+checked.  The fingerprint of a directory is only committed once all the files
+listed in it reached a final state (see :py:meth:`Fingerprints.handled`):
+directories with files that failed, or that were never processed (e.g. because
+of a crash), are scanned again on the next start.
+
+Fingerprints are only trusted after a clean shutdown: the file is removed as
+soon as it is loaded, and written back by :py:meth:`Fingerprints.save`.  A
+full scan is also forced every once in a while, as a safety net for changes
+that do not affect fingerprints (e.g. files rewritten in place).
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .poller import RACY_NS
+
+
+class Fingerprints(object):
+    """A thread-safe store of directory fingerprints
+
+
+  Parameters:
+
+    path (str): Path leading to the file where fingerprints are persisted.  If
+      the file exists, it is loaded and removed.
+
+    full (float): Number of seconds after which a full scan is forced.  If
+      the last full scan is older than this, previous fingerprints are
+      ignored.  If set to ``0``, fingerprints are never used.
+
+  """
+
+    VERSION = 1
+
+    def __init__(self, path, full=7 * 24 * 60 * 60):
+
+        self.path = path
+        self.full = full
+        self.lock = threading.Lock()
+        self.old = {}  # path -> [mtime_ns, count, hash], from the last run
+        self.new = {}
+        self.waiting = {}  # path -> [fingerprint, set of files not handled]
+        self.since = time.time()  # time of the last full scan
+        self.skipped = 0
+
+        try:
+            with open(self.path, "rt") as f:
+                data = json.load(f)
+            os.unlink(self.path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("[fingerprints] cannot load %s: %s", self.path, e)
+            return
+
+        if data.get("version") != self.VERSION:
+            return
+        if full and time.time() - data["since"] < full:
+            self.old = data["dirs"]
+            self.since = data["since"]
+            logger.info(
+                "[fingerprints] loaded %d directories from %s",
+                len(self.old),
+                self.path,
+            )
+        else:
+            logger.info("[fingerprints] forcing a full scan")
+
+    @staticmethod
+    def fingerprint(path, names):
+        """Fingerprints a directory, given the names of entries listed in it
+
+
+    Parameters:
+
+      path (str): The path leading to the directory
+
+      names (list): Names of (selected) entries listed in the directory
+
+
+    Returns:
+
+      list: The modification time of the directory (in nanoseconds), the
+      number of names and a hash of them.  ``None`` if the directory was
+      modified too recently to be fingerprinted reliably.
+
+    """
+
+        mtime_ns = os.stat(path).st_mtime_ns
+        if time.time_ns() - mtime_ns < RACY_NS:
+            return None
+        digest = hashlib.blake2b(digest_size=8)
+        for k in sorted(names):
+            digest.update(os.fsencode(k) + b"\0")
+        return [mtime_ns, len(names), digest.hexdigest()]
+
+    def unchanged(self, path, files, dirs):
+        """Checks and records the fingerprint of a directory that was listed
+
+    This method may be passed as ``unchanged`` to
+    :py:func:`popster.walker.walk`.
+
+
+    Parameters:
+
+      path (str): The path leading to the directory
+
+      files (list): :py:class:`os.DirEntry` objects for files selected in the
+        directory
+
+      dirs (list): :py:class:`os.DirEntry` objects for sub-directories
+        selected in the directory
+
+
+    Returns:
+
+      bool: ``True`` if the directory did not change since it was last
+      fingerprinted, meaning its files need not be checked again.  Otherwise,
+      the new fingerprint is only committed once all ``files`` are handled.
+
+    """
+
+        try:
+            current = self.fingerprint(path, [k.name for k in files + dirs])
+        except OSError:  # gone
+            return False
+
+        if current is None:
+            return False
+
+        with self.lock:
+            if self.old.get(path) == current:
+                self.new[path] = current
+                self.skipped += 1
+                return True
+            if files:
+                self.waiting[path] = [current, set([k.path for k in files])]
+            else:
+                self.new[path] = current
+        return False
+
+    def handled(self, path, ok=True):
+        """Records a file listed by :py:meth:`unchanged` reached a final state
+
+
+    Parameters:
+
+      path (str): The path leading to the file
+
+      ok (bool): ``True`` if the file was imported, skipped or erased.
+        ``False`` if it failed, in which case the fingerprint of its directory
+        is never committed, so that it is retried on the next start.
+
+    """
+
+        dirname = os.path.dirname(path)
+        with self.lock:
+            waiting = self.waiting.get(dirname)
+            if waiting is None:
+                return
+            if not ok:
+                del self.waiting[dirname]
+                return
+            waiting[1].discard(path)
+            if not waiting[1]:
+                self.new[dirname] = waiting[0]
+                del self.waiting[dirname]
+
+    def save(self, complete):
+        """Persists fingerprints recorded since this object was created
+
+
+    Parameters:
+
+      complete (bool): If ``True``, all directories were scanned, and the
+        fingerprints committed replace previous ones.  Otherwise, the scan was
+        interrupted, and directories may have been listed without their
+        files being tracked: previous fingerprints are kept as they were.
+
+    """
+
+        with self.lock:
+            dirs = self.new if complete else self.old
+            data = dict(version=self.VERSION, since=self.since, dirs=dirs)
+
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "wt") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("[fingerprints] cannot save %s: %s", self.path, e)
+            return
+        logger.info(
+            "[fingerprints] saved %d directories to %s", len(dirs), self.path
+        )
+
+    def __len__(self):
+        return len(self.new)
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A hybrid observer, for source trees too large to watch with inotify
+
+Watching a directory tree recursively with inotify requires one watch per
+directory, and the number of watches per user is limited by the kernel
+(``fs.inotify.max_user_watches``).  The observer in this module keeps a
+bounded number of watches:
+
+  * The base directory and its immediate sub-directories are always watched
+  * Directories where changes were recently seen are watched as well, up to
+    a maximum.  When that is reached, the least recently active directory
+    stops being watched.
+  * All other (cold) directories are polled, as done by
+    :py:class:`popster.poller.PollingEmitter`, at a cost of one
+    :py:func:`os.stat` per directory per cycle.
+
+Notifications on watched directories do not generate events by themselves:
+they cause the affected directories to be listed again right away, and
+events are generated by comparing listings with a
+:py:class:`popster.poller.Snapshot`.  This way, files are never reported
+twice, no matter if their changes are detected through notifications or
+polling.  Only close-after-write notifications are forwarded as they are.
+
+This observer is only available on Linux.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import functools
+import collections
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+import watchdog.events
+import watchdog.observers.api
+
+from .poller import PollingEmitter
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+MASK = (
+    IN_CREATE
+    | IN_DELETE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CLOSE_WRITE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+"""Events watched for.  File modifications are not, as they are frequent
+while files are written to, and do not change directory listings"""
+
+
+COALESCE = 0.05
+"""Seconds to wait for further notifications, before listing directories"""
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):  # not on Linux
+    _libc = None
+
+
+def _check(retval):
+    """Raises :py:class:`OSError` if a libc call failed"""
+
+    if retval == -1:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return retval
+
+
+class Inotify(object):
+    """A minimal inotify instance, with watches that can be added and removed
+
+  Unlike :py:class:`watchdog.observers.inotify_c.Inotify`, events for
+  removed watches (that may still be on the kernel buffer) are dropped, and
+  queue overflows are reported.
+
+
+  Parameters:
+
+    mask (int): The events to watch for
+
+  """
+
+    _HEADER = struct.Struct("iIII")
+
+    def __init__(self, mask):
+
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.mask = mask
+        self.fd = _check(_libc.inotify_init1(os.O_CLOEXEC))
+        self.lock = threading.Lock()
+        self.paths = {}  # wd -> path
+        self.wds = {}  # path -> wd
+        self._kill_r, self._kill_w = os.pipe()
+
+    def add(self, path):
+        """Starts watching the directory at ``path``"""
+
+        wd = _check(
+            _libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        )
+        with self.lock:
+            self.paths[wd] = path
+            self.wds[path] = wd
+
+    def remove(self, path):
+        """Stops watching the directory at ``path``"""
+
+        with self.lock:
+            wd = self.wds.pop(path, None)
+            if wd is None:
+                return
+            self.paths.pop(wd, None)
+        # may fail if the directory is gone, the watch is removed anyway
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Waits for events, returns them
+
+
+    Returns:
+
+      list: A list of tuples ``(path, mask)``, with the path of the file or
+      directory affected, and the event mask.  For queue overflows, the path
+      is ``None``.  If the instance was closed, returns ``None``, and
+      releases its resources.
+
+    """
+
+        ready, _, _ = select.select([self.fd, self._kill_r], [], [])
+        if self._kill_r in ready:
+            for k in (self.fd, self._kill_r, self._kill_w):
+                os.close(k)
+            return None
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        with self.lock:
+            while offset < len(data):
+                wd, mask, cookie, size = self._HEADER.unpack_from(data, offset)
+                offset += self._HEADER.size
+                name = data[offset : offset + size].rstrip(b"\0")
+                offset += size
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                path = self.paths.get(wd)
+                if path is None:  # removed watch
+                    continue
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    if self.wds.get(path) == wd:
+                        del self.wds[path]
+                    continue
+                if name:
+                    path = os.path.join(path, os.fsdecode(name))
+                events.append((path, mask))
+
+        return events
+
+    def close(self):
+        """Closes the instance, waking up the reader"""
+
+        os.write(self._kill_w, b"!")
+
+    def __len__(self):
+        return len(self.wds)
+
+
+class HybridEmitter(PollingEmitter):
+    """Emits events from a :py:class:`popster.poller.Snapshot`, refreshed on
+  notifications for active directories, and polling for all others
+
+
+  Parameters:
+
+    max_watches (int): Maximum number of directories to watch with inotify.
+      This number is lowered at run time if the kernel limit is reached
+      first.
+
+  Remaining parameters are passed to :py:class:`PollingEmitter`.
+
+  """
+
+    def __init__(self, event_queue, watch, max_watches=1024, **kwargs):
+
+        super(HybridEmitter, self).__init__(event_queue, watch, **kwargs)
+        self.max_watches = max_watches
+        self.pinned = set()
+        self.hot = collections.OrderedDict()  # path -> None, LRU first
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.next_poll = 0.0  # first poll is immediate
+        self.inotify = None
+        self.reader = None
+
+    def _heat(self, path):
+        """Adds a watch to ``path``, evicting the least recently used one"""
+
+        if path in self.pinned:
+            return
+        if path in self.hot:
+            self.hot.move_to_end(path)
+            return
+
+        while self.hot and (
+            len(self.pinned) + len(self.hot) >= self.max_watches
+        ):
+            self.inotify.remove(self.hot.popitem(last=False)[0])
+        if len(self.pinned) + len(self.hot) >= self.max_watches:
+            return
+
+        try:
+            self.inotify.add(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # kernel limit reached, do not try to go over it again
+                self.max_watches = len(self.pinned) + len(self.hot)
+                logger.warning(
+                    "inotify watch limit reached - limiting watches to %d",
+                    self.max_watches,
+                )
+            else:
+                logger.debug("cannot watch %s: %s", path, e)
+            return
+
+        self.hot[path] = None
+
+    def _read(self):
+        """Reads notifications, marking affected directories as dirty"""
+
+        while self.should_keep_running():
+            try:
+                events = self.inotify.read()
+            except OSError as e:
+                if self.should_keep_running():
+                    logger.warning("cannot read notifications: %s", e)
+                return
+            if events is None:  # closed
+                return
+
+            dirty = set()
+            for path, mask in events:
+                if path is None:
+                    # events were lost, all directories must be checked
+                    logger.warning("[hybrid] notification queue overflow")
+                    self.next_poll = 0.0
+                    continue
+                if mask & IN_CLOSE_WRITE:
+                    self.queue_event(watchdog.events.FileClosedEvent(path))
+                else:  # the directory containing the affected entry
+                    dirty.add(os.path.dirname(path))
+
+            with self.lock:
+                self.dirty.update(dirty)
+            self.wake.set()
+
+    def on_thread_start(self):
+
+        base = self.watch.path
+        self.inotify = Inotify(MASK)
+        self.inotify.add(base)
+        self.pinned.add(base)
+
+        # top-level directories are always watched, if possible, unless they
+        # are pruned (e.g. hidden, or ignored by the rules)
+        select = self.snapshot.select_dir
+        try:
+            with os.scandir(base) as it:
+                top = [
+                    k.path
+                    for k in it
+                    if k.is_dir(follow_symlinks=False)
+                    and (select is None or select(k))
+                ]
+        except OSError:
+            top = []
+        for k in sorted(top)[: self.max_watches // 2]:
+            try:
+                self.inotify.add(k)
+                self.pinned.add(k)
+            except OSError as e:
+                logger.debug("cannot watch %s: %s", k, e)
+
+        self.reader = threading.Thread(
+            target=self._read, name="popster-inotify"
+        )
+        self.reader.daemon = True
+        self.reader.start()
+
+    def on_thread_stop(self):
+
+        self.wake.set()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def _emit(self, events):
+        """Queues events, watching directories where changes are seen"""
+
+        changes = 0
+        for event in events:
+            if self.stopped_event.is_set():
+                break
+            self.queue_event(event)
+            changes += 1
+            if isinstance(event, watchdog.events.DirDeletedEvent):
+                self.hot.pop(event.src_path, None)
+            elif isinstance(event, watchdog.events.DirCreatedEvent):
+                self._heat(event.src_path)
+            elif not isinstance(event, watchdog.events.FileDeletedEvent):
+                self._heat(os.path.dirname(event.src_path))
+        return changes
+
+    def queue_events(self, timeout):
+
+        # waits until the next poll, or until directories are dirty
+        self.wake.wait(max(0.0, self.next_poll - time.time()))
+        if self.stopped_event.is_set():
+            return
+        self.wake.clear()
+
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+
+        if dirty:
+            time.sleep(COALESCE)
+            with self.lock:
+                dirty.update(self.dirty)
+                self.dirty = set()
+            start = time.time()
+            changes = self._emit(self.snapshot.refresh(dirty))
+            logger.debug(
+                "[hybrid] %d change(s) in %d director(ies) in %.3f seconds",
+                changes,
+                len(dirty),
+                time.time() - start,
+            )
+
+        if time.time() < self.next_poll:
+            return
+
+        start = time.time()
+        changes = self._emit(self.snapshot.refresh())
+        logger.debug(
+            "[hybrid] %d change(s) at %s in %.3f seconds (%d watches)",
+            changes,
+            self.watch.path,
+            time.time() - start,
+            len(self.pinned) + len(self.hot),
+        )
+
+        if changes:
+            self.interval = self.timeout
+        else:
+            self.interval = min(
+                2 * max(self.interval, self.timeout), self.max_interval
+            )
+        self.next_poll = time.time() + self.interval
+
+
+class HybridObserver(watchdog.observers.api.BaseObserver):
+    """An observer using both inotify and polling, see :py:class:`HybridEmitter`
+
+
+  Parameters:
+
+    interval (float): Minimum number of seconds between two polling cycles
+
+    max_watches (int): Maximum number of directories to watch with inotify
+
+    max_interval (float): Maximum number of seconds between two polling
+      cycles, when no changes are found.  If not set, use 10 times
+      ``interval``.
+
+    select_dir (callable): See :py:class:`popster.poller.Snapshot`
+
+    select_file (callable): See :py:class:`popster.poller.Snapshot`
+
+  """
+
+    def __init__(
+        self,
+        interval,
+        max_watches,
+        max_interval=None,
+        select_dir=None,
+        select_file=None,
+    ):
+
+        if _libc is None:
+            raise RuntimeError("inotify is not available on this platform")
+
+        super(HybridObserver, self).__init__(
+            functools.partial(
+                HybridEmitter,
+                max_watches=max_watches,
+                max_interval=max_interval,
+                select_dir=select_dir,
+                select_file=select_file,
+            ),
+            timeout=interval,
+        )
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Imports photos recursively from a folder, once
+
+Usage: %(prog)s [-v...] [options] <source> <dest>
+       %(prog)s [-v...] [options] --execute=<plan>
+       %(prog)s --help
+       %(prog)s --version
+
+
+Arguments:
+  <source>  Path leading to the folder with photos to import
+  <dest>    Path leading to the folder to dump photos to
+
+
+Options:
+  -h, --help                  Shows this help message and exits
+  -V, --version               Prints the version and exits
+  -v, --verbose               Increases the output verbosity level. May be used
+                              multiple times
+  -f, --folder-format=<fmt>   How to format (using date formatters), the
+                              destination folder where the photos/videos are
+                              going to be stored [default: %%Y/%%m/%%d.%%m.%%Y]
+  -N, --no-date-path=<str>    A string with the name of a directory that will
+                              be used verbatim in case a date cannot be
+                              retrieved from the source filename
+                              [default: nodate]
+  -n, --dry-run               If set, just tell what it would do instead of
+                              doing it. This flag is good for testing.
+  -c, --copy                  Copy instead of moving files from the source
+                              folder (this will be a bit slower).
+  -X, --filesystem-timestamp  If set, and if no creation time date is found on
+                              the traditional object metadata, then organizes
+                              images using the filesystem timestamp - first try
+                              the creation time if available, else the
+                              last modification time.
+  -W, --workers=<n>           Number of threads to use for reading metadata
+                              and copying files concurrently [default: 4]
+  -U, --rules=<path>          Path leading to a JSON file with rules deciding
+                              which files are imported, ignored or erased. See
+                              the help of the "watch" program
+  -t, --state=<path>          When copying, path leading to a directory where
+                              to keep a ledger of imported files, so that
+                              files are never imported twice across runs. It
+                              may be shared with the "watch" program
+  -K, --content-hash          When keeping a ledger, also recognize files by
+                              a hash of their contents
+  -o, --output=<path>         Where to write a line of JSON for each file, as
+                              it is processed. Use "-" for the standard
+                              output [default: -]
+  -p, --plan=<plan>           Do not import anything: read dates, decide
+                              destinations and resolve name collisions, and
+                              write them to this file, for review
+  -E, --execute=<plan>        Import files as decided in a plan file, without
+                              reading their metadata again. Files that changed
+                              since they were planned are not imported. The
+                              source, destination, and whether files are
+                              copied or moved, are taken from the plan
+
+
+Each line of output is a JSON object with keys "src", "dst", "status"
+("imported", "ignored" or "failed"), "action", "size", "date", "reader",
+"error" and "elapsed" (seconds).  Progress and throughput are displayed on the
+standard error, if it is a terminal.  When planning, status "imported" means
+the file is to be imported.  The program exits with status 1 if any file
+failed to be imported (or planned), 0 otherwise.
+
+
+Examples:
+
+  1. Test what would be done:
+
+     $ %(prog)s -vv --dry-run /media/card /organized
+
+  2. Copy an old archive into the library, keeping a record of results:
+
+     $ %(prog)s --copy --workers=8 --output=results.jsonl /archive /organized
+
+  3. Plan the migration of an old archive, review it, then execute it:
+
+     $ %(prog)s --copy --plan=archive.plan.gz /archive /organized
+     $ zcat archive.plan.gz | less
+     $ %(prog)s --execute=archive.plan.gz
+
+"""
+
+import os
+import sys
+import json
+import time
+
+
+def _to_json(record, status):
+    """Returns a dictionary describing an import record, for JSON output"""
+
+    return dict(
+        src=record.src,
+        dst=record.dst,
+        status=status,
+        action=record.action,
+        size=record.size,
+        date=None if record.date is None else record.date.isoformat(),
+        reader=record.reader,
+        error=None if record.error is None else record.error.__name__,
+        elapsed=round(record.elapsed, 6),
+    )
+
+
+def main(user_input=None):
+
+    if user_input is not None:
+        argv = user_input
+    else:
+        argv = sys.argv[1:]
+
+    import docopt
+    import pkg_resources
+
+    completions = dict(
+        prog=os.path.basename(sys.argv[0]),
+        version=pkg_resources.require("popster")[0].version,
+    )
+
+    args = docopt.docopt(
+        __doc__ % completions, argv=argv, version=completions["version"],
+    )
+
+    from .sorter import setup_logger, rcopy_iter
+    from .rules import Rules
+    from .ledger import Ledger
+    from .api import record_status
+    from .plan import make_plan, execute_plan, read_plan
+
+    logger = setup_logger("popster", args["--verbose"])
+
+    move = not args["--copy"]
+    dry = args["--dry-run"]
+    workers = int(args["--workers"])
+    if args["--execute"]:
+        header = read_plan(args["--execute"])[0]
+        move = header["move"]
+        logger.info("Executing plan at %s", args["--execute"])
+        args["<source>"], args["<dest>"] = header["base"], header["dst"]
+    logger.info(
+        "%s photos/movies from %s to %s",
+        "Moving" if move else "Copying",
+        args["<source>"],
+        args["<dest>"],
+    )
+    if args["--plan"]:
+        logger.info("Only planning, writing plan to %s", args["--plan"])
+    logger.info("Number of workers: %d", workers)
+
+    ledger = None
+    if args["--state"] and not (move or dry):
+        os.makedirs(args["--state"], exist_ok=True)
+        ledger = Ledger(
+            os.path.join(args["--state"], "ledger.sqlite"),
+            args["--content-hash"],
+        )
+
+    import tqdm
+
+    counts = dict(imported=0, ignored=0, failed=0)
+    size = 0
+    start = time.time()
+    output = sys.stdout
+    if args["--output"] != "-":
+        output = open(args["--output"], "wt")
+
+    rules = Rules.load(args["--rules"]) if args["--rules"] else None
+    arguments = (
+        args["<source>"],
+        args["<dest>"],
+        args["--folder-format"],
+        args["--filesystem-timestamp"],
+        args["--no-date-path"],
+        move,
+    )
+
+    try:
+        if args["--execute"]:
+            records = execute_plan(
+                args["--execute"], dry, workers, ledger=ledger
+            )
+        elif args["--plan"]:
+            records = make_plan(
+                args["--plan"], *arguments, workers, rules, ledger
+            )
+        else:
+            records = rcopy_iter(*arguments, dry, workers, rules, ledger)
+        with tqdm.tqdm(
+            records, unit=" files", file=sys.stderr, disable=None
+        ) as progress:
+            for record in progress:
+                status = record_status(record)
+                counts[status] += 1
+                if status == "imported":
+                    size += record.size or 0
+                output.write(json.dumps(_to_json(record, status)))
+                output.write("\n")
+                output.flush()
+                progress.set_postfix_str(
+                    "%.1f MB/s" % (size / 1e6 / (time.time() - start)),
+                    refresh=False,
+                )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if ledger is not None:
+            ledger.close()
+
+    elapsed = time.time() - start
+    total = sum(counts.values())
+    print(
+        "%d file(s) %s, %d ignored, %d failed, in %.1f seconds "
+        "(%.1f files/s, %.1f MB/s)"
+        % (
+            counts["imported"],
+            "planned" if args["--plan"] else "imported",
+            counts["ignored"],
+            counts["failed"],
+            elapsed,
+            total / elapsed if elapsed else 0.0,
+            size / 1e6 / elapsed if elapsed else 0.0,
+        ),
+        file=sys.stderr,
+    )
+
+    return 1 if counts["failed"] else 0
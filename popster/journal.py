@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Append-only journal of in-flight imports, for crash recovery
+
+Each file handled by :py:func:`popster.sorter.copy` goes through the following
+stages, that are recorded (in order) on the journal:
+
+  1. ``intent``: we are about to transfer ``src`` to ``dst``
+  2. ``copied``: ``dst`` is complete, with final permissions set
+  3. ``removed``: ``src`` was removed from the source folder (move mode only)
+
+Files that are queued but were not yet processed when the daemon stops are
+recorded with the stage ``queued``.  On start-up, :py:func:`recover` replays
+the journal and finishes or rolls back partial operations.
+"""
+
+import os
+import json
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+INTENT = "intent"
+COPIED = "copied"
+REMOVED = "removed"
+QUEUED = "queued"
+
+
+class Journal(object):
+    """A thread-safe, append-only journal of import operations
+
+
+  Parameters:
+
+    path (str): Path leading to the journal file.  If the file exists, new
+      records are appended to it.
+
+    sync (bool): If set to ``True`` (the default), then every record is
+      flushed and synchronized to disk before the operation it describes
+      proceeds.
+
+  """
+
+    def __init__(self, path, sync=True):
+
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self._file = open(self.path, "at")
+
+    def _append(self, record):
+        """Writes a single record to the journal file"""
+
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def intent(self, src, dst, move, size=None):
+        """Records the intent of transferring ``src`` (of ``size`` bytes, if
+    known) into ``dst``"""
+
+        with self.lock:
+            self.inflight[src] = move
+            self._append(
+                dict(stage=INTENT, src=src, dst=dst, move=move, size=size)
+            )
+
+    def copied(self, src):
+        """Records ``src`` was completely transferred to its destination"""
+
+        with self.lock:
+            self._append(dict(stage=COPIED, src=src))
+            if not self.inflight.get(src):
+                self.inflight.pop(src, None)
+
+    def removed(self, src):
+        """Records ``src`` was removed from the source folder"""
+
+        with self.lock:
+            self._append(dict(stage=REMOVED, src=src))
+            self.inflight.pop(src, None)
+
+    def persist_queue(self, paths):
+        """Records files that were queued, but not yet processed"""
+
+        with self.lock:
+            for k in paths:
+                self._append(dict(stage=QUEUED, src=k))
+        logger.info("Persisted %d queued file(s) at %s", len(paths), self.path)
+
+    def checkpoint(self):
+        """Truncates the journal if no operations are in flight
+
+    Returns:
+
+      bool: ``True`` if the journal was truncated, ``False`` otherwise
+
+    """
+
+        with self.lock:
+            if self.inflight:
+                return False
+            self._file.close()
+            self._file = open(self.path, "wt")
+            return True
+
+    def close(self):
+        """Closes the journal file"""
+
+        with self.lock:
+            self._file.close()
+
+
+def _read(path):
+    """Reads the last known state of each file recorded on the journal
+
+  Returns:
+
+    dict: A dictionary mapping each source path to its last known stage,
+    destination, transfer mode and size.  Truncated records (e.g. the last
+    one, if the process was killed while writing it) are ignored.
+
+  """
+
+    state = {}
+    with open(path, "rt") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("ignoring corrupted journal record: %r", line)
+                continue
+            entry = state.setdefault(record["src"], {})
+            if record["stage"] == INTENT:
+                entry.update(
+                    dst=record["dst"],
+                    move=record["move"],
+                    size=record.get("size"),
+                )
+            entry["stage"] = record["stage"]
+    return state
+
+
+def _complete(dst, size, move):
+    """Tells if a destination, whose source is gone, is complete
+
+  If the size of the source was not recorded, moves are assumed complete, as
+  sources are only removed after their destination is written.
+
+  """
+
+    if not os.path.exists(dst):
+        return False
+    if size is None:
+        return bool(move)
+    return os.path.getsize(dst) == size
+
+
+def recover(path, dry):
+    """Replays a journal, finishing or rolling back partial operations
+
+  This function implements the following actions for each file on the
+  journal, depending on the last recorded stage:
+
+    * ``intent``: if the source still exists, the (potentially partial)
+      destination is removed and the source re-queued.  If the source does
+      not exist anymore, the destination is kept only if it has the size the
+      source had: when moving, the source is only removed once its
+      destination is complete.  When copying, the source may have been
+      removed by someone else, so that tells nothing about the destination.
+      Partial destinations are removed.
+    * ``copied`` (move mode): if both source and destination exist, and have
+      the same size, the source is removed.
+    * ``queued``: the source is re-queued, if it still exists.
+
+  The journal is truncated after recovery.
+
+
+  Parameters:
+
+    path (str): Path leading to the journal file.  If it does not exist,
+      nothing is done.
+
+    dry (bool): If set to ``True``, then it will not remove anything, just log.
+
+
+  Returns:
+
+    list: A list of source paths that should be (re-)queued for processing
+
+  """
+
+    if not os.path.exists(path):
+        return []
+
+    requeue = []
+
+    for src, entry in _read(path).items():
+
+        stage = entry.get("stage")
+        dst = entry.get("dst")
+
+        if stage == INTENT:
+            if not os.path.exists(src):
+                if _complete(dst, entry.get("size"), entry.get("move")):
+                    if entry.get("move"):
+                        logger.info("[journal] %s was moved to %s", src, dst)
+                    else:
+                        logger.info("[journal] %s was copied to %s", src, dst)
+                    continue
+                logger.warning(
+                    "[journal] %s is gone, leaving an incomplete copy: "
+                    "rm -f %s",
+                    src,
+                    dst,
+                )
+                if not dry and os.path.exists(dst):
+                    os.unlink(dst)
+                continue
+            if os.path.exists(dst):
+                logger.info("[journal] rolling back partial copy: rm -f %s", dst)
+                if not dry:
+                    os.unlink(dst)
+            requeue.append(src)
+
+        elif stage == COPIED and entry.get("move"):
+            if not os.path.exists(src):
+                continue
+            if os.path.exists(dst) and (
+                os.path.getsize(src) == os.path.getsize(dst)
+            ):
+                logger.info("[journal] finishing move: rm -f %s", src)
+                if not dry:
+                    os.unlink(src)
+            else:
+                requeue.append(src)
+
+        elif stage == QUEUED:
+            if os.path.exists(src):
+                requeue.append(src)
+
+    if not dry:
+        open(path, "wt").close()
+
+    logger.info("[journal] recovered %d file(s) from %s", len(requeue), path)
+
+    return requeue
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Persistent ledger of imported source files, for copy mode
+
+In copy mode, source files stay in place after import, and would be imported
+again every time they are found (e.g. on restart, or when a card is inserted
+again).  The ledger records each imported source by its identity on the file
+system: device, inode, size and modification time, as returned by
+:py:func:`os.stat`.  Optionally, a hash of the contents is recorded as well,
+so that files are recognized even if their identity changes (e.g. if a card
+is mounted as a different device).
+
+Entries are kept in a SQLite database.  All keys are also loaded into a Bloom
+filter, so that files that were never imported (the vast majority, when new
+files arrive) are recognized without querying the database.
+"""
+
+import math
+import time
+import struct
+import hashlib
+import sqlite3
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """A Bloom filter over byte strings
+
+
+  Parameters:
+
+    capacity (int): Number of items the filter is sized for
+
+    error (float): False positive rate at capacity
+
+  """
+
+    def __init__(self, capacity, error=0.01):
+
+        self.capacity = max(capacity, 1)
+        self.size = int(
+            math.ceil(-self.capacity * math.log(error) / (math.log(2) ** 2))
+        )
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for k in self._positions(item):
+            self.bits[k >> 3] |= 1 << (k & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            [self.bits[k >> 3] & (1 << (k & 7)) for k in self._positions(item)]
+        )
+
+
+def file_digest(path, chunk=1 << 20):
+    """Returns a hash (hexadecimal) of the contents of a file"""
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Ledger(object):
+    """A thread-safe, persistent, ledger of imported source files
+
+
+  Parameters:
+
+    path (str): Path leading to the SQLite database.  It is created if it
+      does not exist.
+
+    hash (bool): If set, also identify files by a hash of their contents, if
+      their identity on the file system is unknown.  This requires reading
+      all new files once more.
+
+  """
+
+    def __init__(self, path, hash=False):
+
+        self.path = path
+        self.hash = hash
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS imported ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "digest TEXT, src TEXT, dst TEXT, at REAL, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS contents ON imported (size, digest)"
+        )
+        self.db.commit()
+        self.last_commit = time.time()
+
+        count = self.db.execute("SELECT COUNT(*) FROM imported").fetchone()[0]
+        self._rebuild(count)
+        logger.info("[ledger] %d file(s) recorded in %s", count, path)
+
+    @staticmethod
+    def key(info):
+        """Returns the key of a file in the ledger, given its stat result"""
+
+        return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+    @staticmethod
+    def _pack(key):
+        dev, ino, size, mtime_ns = key
+        return struct.pack("<QQqq", dev, ino, size, mtime_ns)
+
+    def _rebuild(self, count):
+        """Creates a new Bloom filter, with room for twice as many keys"""
+
+        bloom = BloomFilter(max(2 * count, 100000))
+        for key in self.db.execute(
+            "SELECT dev, ino, size, mtime_ns FROM imported"
+        ):
+            bloom.add(self._pack(key))
+        self.bloom = bloom
+
+    def contains(self, info, path=None):
+        """Tells if a file was already imported
+
+
+    Parameters:
+
+      info (os.stat_result): The result of :py:func:`os.stat` on the file
+
+      path (str): The path leading to the file.  If set, and if hashing is
+        enabled, files not found by their identity are looked-up by
+        contents.
+
+
+    Returns:
+
+      bool: ``True`` if the file was already imported
+
+      str: The hash of the file contents, if it was computed, or ``None``
+
+    """
+
+        key = self.key(info)
+        if self._pack(key) in self.bloom:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT 1 FROM imported WHERE dev=? AND ino=? AND size=? "
+                    "AND mtime_ns=?",
+                    key,
+                ).fetchone()
+            if row is not None:
+                return True, None
+
+        if not (self.hash and path is not None):
+            return False, None
+
+        digest = file_digest(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM imported WHERE size=? AND digest=?",
+                (info.st_size, digest),
+            ).fetchone()
+        return row is not None, digest
+
+    def add(self, info, src, dst, digest=None):
+        """Records a file was imported
+
+
+    Parameters:
+
+      info (os.stat_result): The result of :py:func:`os.stat` on the source
+        file, before it was imported
+
+      src (str): The path leading to the source file
+
+      dst (str): The path leading to the destination file
+
+      digest (str): The hash of the file contents, if known
+
+    """
+
+        key = self.key(info)
+        if self.hash and digest is None:
+            digest = file_digest(src)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO imported "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (digest, src, dst, time.time()),
+            )
+            self.bloom.add(self._pack(key))
+            if self.bloom.count > self.bloom.capacity:
+                self._rebuild(self.bloom.count)
+            # commits are batched, a crash may cause a few files to be
+            # imported again
+            if time.time() - self.last_commit > 1.0:
+                self.db.commit()
+                self.last_commit = time.time()
+
+    def __len__(self):
+        with self.lock:
+            row = self.db.execute("SELECT COUNT(*) FROM imported").fetchone()
+        return row[0]
+
+    def close(self):
+        """Commits pending records and closes the database"""
+
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Background delivery of e-mails, with an on-disk queue and retries
+
+Messages handed to :py:meth:`Mailer.send` are written to a spool directory
+(if one is set) and delivered by a background thread, so that callers never
+wait on the SMTP server.  The connection to the server is kept open while
+messages keep coming, and closed after being idle for a while.  If delivery
+fails, it is retried with exponential backoff, also if logging in fails
+(until settings are fixed).  Messages refused by the server (e.g. for a bad
+address) are set aside, so they do not hold others.  Messages left in the
+spool directory (e.g. as the server was down when the program stopped) are
+delivered after a restart.
+"""
+
+import os
+import time
+import smtplib
+import threading
+import itertools
+import collections
+import email.parser
+import email.utils
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+_IDLE = object()
+"""Returned by :py:meth:`Mailer._wait` when the connection is idle"""
+
+
+class Mailer(object):
+    """Delivers e-mails on a background thread, through a reused connection
+
+
+  Parameters:
+
+    server (str): Name of the SMTP server to use
+
+    port (int): Port to use on the server
+
+    username (str): Username for the SMTP authentication.  If not set, do not
+      authenticate.  If set, the connection must be encrypted with STARTTLS,
+      or messages are not delivered.
+
+    password (str): Password for the SMTP authentication
+
+    spool (str): If set, a directory where messages are kept until they are
+      delivered, across restarts.  It is created if it does not exist.
+      Messages refused by the server are moved to its ``failed``
+      sub-directory.  If not set, messages are only kept in memory.
+
+    timeout (float): Number of seconds to wait for the server, on each
+      operation
+
+    keepalive (float): Number of seconds an idle connection is kept open
+
+    backoff (float): Number of seconds to wait before retrying a failed
+      delivery.  It doubles after each consecutive failure, up to
+      ``max_backoff``.
+
+    max_backoff (float): Maximum number of seconds in-between retries
+
+  """
+
+    def __init__(
+        self,
+        server,
+        port,
+        username=None,
+        password=None,
+        spool=None,
+        timeout=30.0,
+        keepalive=60.0,
+        backoff=10.0,
+        max_backoff=900.0,
+    ):
+
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.spool = spool
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.condition = threading.Condition()
+        self.pending = collections.deque()  # spool file names, or bytes
+        self.retry_at = None  # set while backing off
+        self.failures = 0  # consecutive
+        self.delivered = 0
+        self.stopping = False
+        self.thread = None
+        self._connection = None
+        self._last_used = None
+        self._seq = itertools.count()
+
+        if spool is not None:
+            os.makedirs(os.path.join(spool, "failed"), exist_ok=True)
+            self.pending.extend(
+                sorted(
+                    [
+                        os.path.join(spool, k)
+                        for k in os.listdir(spool)
+                        if k.endswith(".eml")
+                    ]
+                )
+            )
+            if self.pending:
+                logger.info(
+                    "[mailer] %d message(s) left to deliver in %s",
+                    len(self.pending),
+                    spool,
+                )
+
+    def start(self):
+        """Starts delivering messages on a separate thread"""
+
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.stopping = False
+            self.thread = threading.Thread(
+                target=self._run, name="popster-mailer"
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def send(self, message):
+        """Queues a message for delivery, returns immediately
+
+
+    Parameters:
+
+      message (popster.sorter.Email): The message to send.  It is serialized
+        right away, so it may refer to data that is removed afterwards.
+
+    """
+
+        data = message.msg.as_bytes()
+        entry = data
+        if self.spool is not None:
+            name = "%020d-%06d.eml" % (time.time_ns(), next(self._seq))
+            entry = os.path.join(self.spool, name)
+            with open(entry + ".tmp", "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(entry + ".tmp", entry)
+
+        with self.condition:
+            self.pending.append(entry)
+            self.condition.notify_all()
+        self.start()
+
+    def _connect(self):
+        """Returns a connection to the server, reusing the current one"""
+
+        if self._connection is not None:
+            try:
+                if self._connection.noop()[0] == 250:
+                    return self._connection
+            except (OSError, smtplib.SMTPException):
+                pass
+            self._disconnect()
+
+        connection = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            connection.ehlo()
+            if self.username:
+                # never send credentials in clear text, e.g. if STARTTLS was
+                # stripped from the server reply
+                if not connection.has_extn("starttls"):
+                    raise smtplib.SMTPNotSupportedError(
+                        "%s does not support STARTTLS, refusing to log in"
+                        % self.server
+                    )
+                connection.starttls()
+                connection.ehlo()
+                connection.login(self.username, self.password)
+            elif connection.has_extn("starttls"):
+                connection.starttls()
+                connection.ehlo()
+        except BaseException:
+            connection.close()
+            raise
+        self._connection = connection
+        return connection
+
+    def _disconnect(self):
+        """Closes the current connection, if any"""
+
+        if self._connection is None:
+            return
+        try:
+            self._connection.quit()
+        except (OSError, smtplib.SMTPException):
+            self._connection.close()
+        self._connection = None
+
+    def _deliver(self, entry):
+        """Delivers a single message, raises in case of errors"""
+
+        if isinstance(entry, bytes):
+            data = entry
+        else:
+            with open(entry, "rb") as f:
+                data = f.read()
+
+        headers = email.parser.BytesHeaderParser().parsebytes(data)
+        sender = email.utils.parseaddr(headers.get("From", ""))[1]
+        to = [
+            k[1]
+            for k in email.utils.getaddresses(headers.get_all("To", []))
+            if k[1]
+        ]
+
+        refused = self._connect().sendmail(sender, to, data)
+        self._last_used = time.time()
+        if refused:
+            logger.warning(
+                "[mailer] message not delivered to: %s",
+                ", ".join(sorted(refused)),
+            )
+
+    def _done(self, entry, failed=False):
+        """Removes a message from the queue (and from the spool directory)"""
+
+        if isinstance(entry, bytes):
+            pass
+        elif failed:
+            os.replace(
+                entry,
+                os.path.join(self.spool, "failed", os.path.basename(entry)),
+            )
+        else:
+            os.unlink(entry)
+
+        with self.condition:
+            self.pending.popleft()
+            if not failed:
+                self.failures = 0
+                self.retry_at = None
+            self.condition.notify_all()
+
+    def _wait(self):
+        """Waits until a message may be delivered, returns it
+
+    Returns ``None`` if stopping, or :py:data:`_IDLE` if the connection
+    should be closed, as it was idle for too long.
+
+    """
+
+        with self.condition:
+            while not self.stopping:
+                now = time.time()
+                if self.pending and (
+                    self.retry_at is None or now >= self.retry_at
+                ):
+                    return self.pending[0]
+                timeout = None
+                if self.retry_at is not None and self.pending:
+                    timeout = self.retry_at - now
+                if self._last_used is not None:
+                    idle = self._last_used + self.keepalive - now
+                    if idle <= 0:
+                        self._last_used = None
+                        return _IDLE
+                    timeout = min(idle, timeout or idle)
+                self.condition.wait(timeout)
+        return None
+
+    def _run(self):
+        """Delivers messages as they arrive, until stopped"""
+
+        while True:
+            entry = self._wait()
+            if entry is None:
+                break
+            if entry is _IDLE:
+                self._disconnect()
+                continue
+
+            try:
+                self._deliver(entry)
+            except (
+                smtplib.SMTPAuthenticationError,
+                smtplib.SMTPNotSupportedError,
+            ) as e:
+                # affects all messages: keep them, until settings are fixed
+                logger.error(
+                    "[mailer] cannot log in to %s (check the e-mail "
+                    "settings): %s",
+                    self.server,
+                    e,
+                )
+                self._failed(e)
+                continue
+            except (
+                smtplib.SMTPRecipientsRefused,
+                smtplib.SMTPSenderRefused,
+            ) as e:
+                # only affects this message, do not hold others behind it
+                logger.error("[mailer] message refused: %s", e)
+                self._done(entry, failed=True)
+                continue
+            except smtplib.SMTPResponseException as e:
+                if 500 <= e.smtp_code < 600:  # permanent, do not retry
+                    logger.error("[mailer] message refused: %s", e)
+                    self._done(entry, failed=True)
+                    continue
+                self._failed(e)
+                continue
+            except (OSError, smtplib.SMTPException) as e:
+                self._failed(e)
+                continue
+
+            self.delivered += 1
+            self._done(entry)
+            logger.debug("[mailer] message delivered")
+
+        self._disconnect()
+
+    def _failed(self, error):
+        """Schedules a retry, after a failed delivery"""
+
+        self._disconnect()
+        with self.condition:
+            delay = min(self.backoff * 2 ** self.failures, self.max_backoff)
+            self.failures += 1
+            self.retry_at = time.time() + delay
+            self.condition.notify_all()
+        logger.warning(
+            "[mailer] delivery failed (%s), %d message(s) pending, retrying "
+            "in %d seconds",
+            error,
+            len(self.pending),
+            delay,
+        )
+
+    def close(self, timeout=None):
+        """Delivers pending messages, then stops the delivery thread
+
+    Messages that cannot be delivered right away (the last delivery failed),
+    or within ``timeout`` seconds, are left in the spool directory, for the
+    next start.
+
+    """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            if self.thread is not None:
+                self.condition.wait_for(
+                    lambda: not self.pending or self.retry_at is not None,
+                    None if deadline is None else deadline - time.time(),
+                )
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.pending:
+            logger.warning(
+                "[mailer] %d message(s) not delivered%s",
+                len(self.pending),
+                (" (kept in %s)" % self.spool) if self.spool else "",
+            )
+
+    def __len__(self):
+        return len(self.pending)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Import plans: resolve an import once, review it, and apply it later
+
+Planning an import (see :py:func:`make_plan`) runs files through the same
+stages as an import, without changing anything on disk: dates are read from
+file metadata, destination folders are decided, and collisions with existing
+files (or with other files of the plan) are resolved, as they would be during
+the import.  Results are written to a plan file, that may be reviewed (e.g.
+before a large migration).
+
+Executing a plan (see :py:func:`execute_plan`) does not read metadata again.
+Destination folders are created at once, and files are then transferred
+concurrently.  Source files are verified to be unchanged (same size and
+modification time) since they were planned.
+
+Plan files are gzip-compressed, with one JSON document per line.  The first
+line is a header (see :py:data:`VERSION`), and each following line is an
+array describing a file: its path relative to the source folder, its size,
+its modification time (in nanoseconds), its destination path relative to the
+destination folder (or ``null``), its date (ISO 8601, or ``null``), the
+reader that found it, the planned action (see
+:py:data:`popster.records.ACTIONS`, or ``null``) and the name of the error
+that would prevent its import (or ``null``).
+"""
+
+import os
+import json
+import gzip
+import datetime
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from .sorter import (
+    Pipeline,
+    ExplicitIgnore,
+    UnsupportedExtensionError,
+    make_dirs,
+    _scan,
+    _check_ledger,
+    _find_duplicate,
+    _reserve,
+)
+from .utils import files_match
+
+
+VERSION = 1
+"""Version of the plan file format"""
+
+
+class SourceChanged(RuntimeError):
+    """Exception raised if a source file changed since it was planned"""
+
+    pass
+
+
+class _Planner(Pipeline):
+    """A pipeline that decides where files go, without transferring them
+
+  Collisions are resolved against existing files and files planned before,
+  in the order files were found, as during an import: files with the same
+  contents as an existing file, or as a file planned before, are skipped (or
+  unlinked).
+
+  """
+
+    def __init__(self, *args, **kwargs):
+        super(_Planner, self).__init__(*args, **kwargs)
+        self.taken = {}  # destination names planned so far -> source paths
+        self.lock = threading.Lock()
+
+    def _plan(self, job):
+        filename = os.path.join(
+            self.dst, job.dirname, os.path.basename(job.src).lower()
+        )
+        with self.lock:
+            while True:
+                planned = self.taken.get(filename)
+                if planned is not None:
+                    # the file at this name is yet to be imported
+                    if files_match(job.src, planned):
+                        job.dst, job.duplicate = filename, True
+                        return
+                elif not os.path.exists(filename):
+                    break
+                elif files_match(job.src, filename):
+                    job.dst, job.duplicate = filename, True
+                    return
+                filename, e = os.path.splitext(filename)
+                filename += "~" + e
+            self.taken[filename] = job.src
+        job.dst = filename
+
+    def _copy(self, job):
+        if job.duplicate:
+            job.action = "unlink" if self.move else "skip"
+        else:
+            job.action = "move" if self.move else "copy"
+
+    def _finalize(self, job):
+        pass
+
+
+def _entry(job, base, dst):
+    """Returns the line of a plan file for a planned file"""
+
+    return [
+        os.path.relpath(job.src, base),
+        None if job.info is None else job.info.st_size,
+        None if job.info is None else job.info.st_mtime_ns,
+        None if job.dst is None else os.path.relpath(job.dst, dst),
+        None if job.date is None else job.date.isoformat(),
+        job.reader,
+        job.action if job.error is None else None,
+        None if job.error is None else type(job.error).__name__,
+    ]
+
+
+def make_plan(
+    path,
+    base,
+    dst,
+    fmt,
+    timestamp,
+    nodate,
+    move,
+    workers=1,
+    rules=None,
+    ledger=None,
+):
+    """Plans the import of all files found under a given base directory
+
+  Nothing is changed on disk, besides the plan file, that is only written if
+  all files were planned.  Parameters are the same as for
+  :py:func:`popster.sorter.rcopy_iter`, except for:
+
+
+  Parameters:
+
+    path (str): Path leading to the plan file to write
+
+
+  Yields:
+
+    ImportRecord: A record of the planned import of each file, in completion
+    order
+
+  """
+
+    pipeline = _Planner(
+        dst,
+        fmt,
+        timestamp,
+        nodate,
+        move,
+        True,
+        workers=workers,
+        rules=rules,
+        ledger=ledger,
+    )
+    scanners = workers
+    if isinstance(workers, dict):
+        scanners = workers.get("scan", 1)
+
+    header = dict(
+        version=VERSION,
+        base=os.path.abspath(base),
+        dst=os.path.abspath(dst),
+        move=move,
+        created=datetime.datetime.now().isoformat(),
+    )
+
+    tmp = path + ".tmp"
+    try:
+        with gzip.open(tmp, "wt") as f:
+            f.write(json.dumps(header) + "\n")
+            for job in pipeline.run(_scan(base, True, scanners, rules)):
+                f.write(json.dumps(_entry(job, base, dst)) + "\n")
+                yield job.record()
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+    logger.info("Import plan written to %s", path)
+
+
+def read_plan(path):
+    """Reads a plan file
+
+
+  Returns:
+
+    dict: The plan header, with keys ``base``, ``dst`` and ``move``
+
+    generator: An iterator over the files of the plan, as lists (see
+    :py:mod:`popster.plan`)
+
+
+  Raises:
+
+    ValueError: If the file is not a plan of a supported version
+
+  """
+
+    f = gzip.open(path, "rt")
+    try:
+        header = json.loads(f.readline())
+    except (ValueError, OSError) as e:
+        f.close()
+        raise ValueError("%s is not an import plan: %s" % (path, e))
+    if not isinstance(header, dict) or header.get("version") != VERSION:
+        f.close()
+        raise ValueError(
+            "%s is not an import plan (version %d)" % (path, VERSION)
+        )
+
+    def _entries():
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    return header, _entries()
+
+
+class _Executor(Pipeline):
+    """A pipeline that transfers files as planned, without reading metadata"""
+
+    def __init__(self, entries, *args, **kwargs):
+        super(_Executor, self).__init__(*args, **kwargs)
+        self.entries = entries  # src -> (size, mtime_ns, dst, date, reader)
+
+    def _date(self, job):
+        size, mtime_ns, dst, date, reader = self.entries[job.src]
+        job.info, job.digest = _check_ledger(job.src, self.ledger)
+        if (job.info.st_size, job.info.st_mtime_ns) != (size, mtime_ns):
+            raise SourceChanged(job.src)
+        job.dirname = os.path.dirname(dst)
+        if date is not None:
+            job.date = datetime.datetime.fromisoformat(date)
+        job.reader = reader
+
+    def _plan(self, job):
+        # destination folders were all created beforehand
+        filename = os.path.join(self.dst, self.entries[job.src][2])
+        duplicate = _find_duplicate(job.src, filename, self.abort)
+        if duplicate is not None:
+            job.dst, job.duplicate = duplicate, True
+            return
+        job.dst = _reserve(filename)
+
+
+def execute_plan(path, dry, workers=1, journal=None, ledger=None):
+    """Imports files as planned
+
+
+  Parameters:
+
+    path (str): Path leading to the plan file, see :py:func:`make_plan`
+
+    dry (bool): If set to ``True``, then it will not copy anything, just log.
+
+    workers (int, dict): Number of threads for each stage of the import
+      pipeline.  See :py:class:`popster.sorter.Pipeline`.
+
+    journal (popster.journal.Journal): If set, record each file transfer on
+      this journal, so that partial operations can be recovered after a
+      crash.
+
+    ledger (popster.ledger.Ledger): If set, files recorded on this ledger are
+      skipped, and imported files are recorded on it
+
+
+  Yields:
+
+    ImportRecord: A record for each file of the plan that was to be imported,
+    in completion order.  Files that changed since the plan was made are
+    not imported, and have their ``error`` attribute set to
+    :py:class:`SourceChanged`.  If a destination file name was taken since,
+    a new one is chosen, as during an import.
+
+  """
+
+    header, lines = read_plan(path)
+    base, dst, move = header["base"], header["dst"], header["move"]
+
+    # the plan is read in a single pass, and destination folders created once
+    entries = {}
+    for src, size, mtime_ns, target, date, reader, action, error in lines:
+        if action is None:
+            continue
+        src = os.path.join(base, src)
+        entries[src] = (size, mtime_ns, target, date, reader)
+    dirnames = sorted(set([os.path.dirname(k[2]) for k in entries.values()]))
+    for dirname in dirnames:
+        make_dirs(dst, dirname, dry)
+    logger.info(
+        "Executing plan %s: %d file(s) to %s into %d folder(s)",
+        path,
+        len(entries),
+        "move" if move else "copy",
+        len(dirnames),
+    )
+
+    pipeline = _Executor(
+        entries,
+        dst,
+        None,
+        False,
+        None,
+        move,
+        dry,
+        journal,
+        workers,
+        ledger=ledger,
+    )
+
+    action = "copy" if not move else "move"
+    for job in pipeline.run(list(entries)):
+        if isinstance(job.error, (ExplicitIgnore, UnsupportedExtensionError)):
+            logger.debug("ignoring file during %s: %s", action, job.error)
+        elif job.error is not None:
+            logger.warning(
+                "could not %s %s to new destination: %s",
+                action,
+                job.src,
+                job.error,
+            )
+        yield job.record()
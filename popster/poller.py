@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A polling observer, for folders where file system events are unavailable
+
+Network file systems (SMB, NFS) mounted on the host running popster do not
+deliver file system notifications for changes done by other clients.  The
+observer in this module periodically compares the folder with a compact
+snapshot of its previous state.  Unlike :py:class:`watchdog.observers.polling.
+PollingObserver`, it does not re-list and re-stat every file in every cycle:
+
+  * Directories whose modification time did not change since the last cycle
+    are not listed again (entries were not added, removed or renamed in
+    them).  Only their sub-directories are checked, so a cycle over an
+    unchanged tree costs a single :py:func:`os.stat` per directory.
+  * Directories modified very recently are listed again in the next cycle,
+    as further changes may fall within the file system's timestamp
+    resolution.
+  * The polling interval shrinks to its minimum while changes are found, and
+    doubles with every quiet cycle, up to a maximum.
+
+Changes to the contents of existing files, in directories that were not
+otherwise modified, are not reported.  Files being written to are reported
+as created and are re-sampled until complete by
+:py:class:`popster.stability.StabilityTracker`.
+"""
+
+import os
+import time
+import array
+import functools
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+import watchdog.events
+import watchdog.observers.api
+
+
+RACY_NS = 2 * 10 ** 9
+"""Directories modified less than this (in nanoseconds) before they were
+listed are listed again on the next cycle"""
+
+
+class Snapshot(object):
+    """A compact snapshot of a directory tree, that can be refreshed
+
+  For each directory, the snapshot keeps its modification time, the names of
+  its files and sub-directories, and the size and modification time of each
+  file (packed in an :py:class:`array.array`).
+
+
+  Parameters:
+
+    base (str): The path leading to the directory to track
+
+    select_dir (callable): If set, a function that is called with the
+      :py:class:`os.DirEntry` of every directory found.  If it returns
+      ``False``, the directory is not tracked.
+
+    select_file (callable): If set, a function that is called with the
+      :py:class:`os.DirEntry` of every file found.  If it returns ``False``,
+      the file is not tracked.
+
+  """
+
+    def __init__(self, base, select_dir=None, select_file=None):
+
+        self.base = base
+        self.select_dir = select_dir
+        self.select_file = select_file
+        # path -> (mtime_ns or None, file names, file stats, dir names)
+        self.dirs = {}
+
+    def _list(self, path):
+        """Lists a directory, returns files, their stats, and sub-directories"""
+
+        files, stats, subdirs = [], array.array("q"), []
+
+        with os.scandir(path) as it:
+            for entry in sorted(it, key=lambda k: k.name):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.select_dir is None or self.select_dir(entry):
+                            subdirs.append(entry.name)
+                    elif self.select_file is None or self.select_file(entry):
+                        info = entry.stat()
+                        stats.extend((info.st_size, info.st_mtime_ns))
+                        files.append(entry.name)
+                except OSError:  # gone while listing
+                    continue
+
+        return tuple(files), stats, tuple(subdirs)
+
+    def _removed(self, path):
+        """Forgets a directory and all its contents, yields deletion events"""
+
+        record = self.dirs.pop(path, None)
+        if record is None:
+            return
+        for k in record[3]:
+            yield from self._removed(os.path.join(path, k))
+        for k in record[1]:
+            yield watchdog.events.FileDeletedEvent(os.path.join(path, k))
+        if path != self.base:
+            yield watchdog.events.DirDeletedEvent(path)
+
+    def _relist(self, path, record, mtime_ns):
+        """Lists a directory again, yields events for changed entries"""
+
+        try:
+            files, stats, subdirs = self._list(path)
+        except OSError as e:
+            if not os.path.isdir(path):
+                yield from self._removed(path)
+            else:
+                logger.debug("cannot list %s: %s", path, e)
+                if record is not None:  # retries on the next cycle
+                    self.dirs[path] = (None,) + record[1:]
+            return
+
+        if time.time_ns() - mtime_ns < RACY_NS:
+            mtime_ns = None
+
+        if record is None:
+            old_files, old_stats, old_subdirs = {}, None, ()
+            if path != self.base:
+                yield watchdog.events.DirCreatedEvent(path)
+        else:
+            old_files = dict([(k, i) for i, k in enumerate(record[1])])
+            old_stats, old_subdirs = record[2], record[3]
+
+        self.dirs[path] = (mtime_ns, files, stats, subdirs)
+
+        for k in set(old_subdirs).difference(subdirs):
+            yield from self._removed(os.path.join(path, k))
+
+        for i, k in enumerate(files):
+            j = old_files.pop(k, None)
+            if j is None:
+                yield watchdog.events.FileCreatedEvent(os.path.join(path, k))
+            elif stats[2 * i : 2 * i + 2] != old_stats[2 * j : 2 * j + 2]:
+                yield watchdog.events.FileModifiedEvent(os.path.join(path, k))
+
+        for k in old_files:
+            yield watchdog.events.FileDeletedEvent(os.path.join(path, k))
+
+    def refresh(self, paths=None):
+        """Compares the snapshot with the directory tree, and updates it
+
+
+    Parameters:
+
+      paths (iterable): If set, only these directories (that must be part of
+        the snapshot) are listed again, even if their modification time did
+        not change, together with new sub-directories found in them.
+        Otherwise, the whole tree is checked.
+
+
+    Yields:
+
+      watchdog.events.FileSystemEvent: Events for files (and directories)
+      created, modified and deleted since the last refresh, as they are
+      found.  On the first refresh, all existing files are reported as
+      created.
+
+    """
+
+        if paths is None:
+            stack = [self.base]
+            forced = set()
+        else:
+            forced = set([k for k in paths if k in self.dirs])
+            stack = sorted(forced, reverse=True)
+
+        while stack:
+            path = stack.pop()
+            record = self.dirs.get(path)
+
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:  # gone
+                yield from self._removed(path)
+                continue
+
+            old_subdirs = () if record is None else record[3]
+
+            if record is None or record[0] != mtime_ns or path in forced:
+                yield from self._relist(path, record, mtime_ns)
+                record = self.dirs.get(path)
+                if record is None:
+                    continue
+            elif paths is not None:
+                continue
+
+            subdirs = record[3]
+            if paths is not None:  # only descends into new directories
+                subdirs = [k for k in subdirs if k not in old_subdirs]
+            stack.extend([os.path.join(path, k) for k in reversed(subdirs)])
+
+    def __len__(self):
+        """Returns the number of files in the snapshot"""
+
+        return sum([len(k[1]) for k in self.dirs.values()])
+
+
+class PollingEmitter(watchdog.observers.api.EventEmitter):
+    """Emits events by periodically refreshing a :py:class:`Snapshot`
+
+  The first refresh happens as soon as the emitter starts, and reports all
+  existing files.  Following refreshes happen every ``timeout`` seconds while
+  changes are found.  The interval doubles after every cycle without changes,
+  up to ``max_interval`` seconds.  Remaining parameters are passed to
+  :py:class:`Snapshot`.
+
+  """
+
+    def __init__(
+        self,
+        event_queue,
+        watch,
+        timeout=1.0,
+        max_interval=None,
+        select_dir=None,
+        select_file=None,
+        **kwargs
+    ):
+
+        super(PollingEmitter, self).__init__(
+            event_queue, watch, timeout=timeout, **kwargs
+        )
+        self.snapshot = Snapshot(watch.path, select_dir, select_file)
+        self.max_interval = max_interval or (10 * timeout)
+        self.interval = 0.0  # first refresh is immediate
+
+    def queue_events(self, timeout):
+
+        if self.stopped_event.wait(self.interval):
+            return
+
+        start = time.time()
+        changes = 0
+        for event in self.snapshot.refresh():
+            if self.stopped_event.is_set():
+                return
+            self.queue_event(event)
+            changes += 1
+
+        logger.debug(
+            "[poll] %d change(s) at %s in %.3f seconds",
+            changes,
+            self.watch.path,
+            time.time() - start,
+        )
+
+        if changes:
+            self.interval = self.timeout
+        else:
+            self.interval = min(
+                2 * max(self.interval, self.timeout), self.max_interval
+            )
+
+
+class PollingObserver(watchdog.observers.api.BaseObserver):
+    """An observer that polls scheduled folders, see :py:class:`PollingEmitter`
+
+
+  Parameters:
+
+    interval (float): Minimum number of seconds between two polling cycles
+
+    max_interval (float): Maximum number of seconds between two polling
+      cycles, when no changes are found.  If not set, use 10 times
+      ``interval``.
+
+    select_dir (callable): See :py:class:`Snapshot`
+
+    select_file (callable): See :py:class:`Snapshot`
+
+  """
+
+    def __init__(
+        self, interval, max_interval=None, select_dir=None, select_file=None
+    ):
+
+        super(PollingObserver, self).__init__(
+            functools.partial(
+                PollingEmitter,
+                max_interval=max_interval,
+                select_dir=select_dir,
+                select_file=select_file,
+            ),
+            timeout=interval,
+        )
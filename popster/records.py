@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Compact records of import operations"""
+
+import os
+import sys
+
+
+STAGES = ("date", "plan", "copy", "finalize")
+"""Stages of an import, in order, see :py:class:`popster.sorter.Pipeline`"""
+
+ACTIONS = ("copy", "move", "skip", "unlink")
+"""What was done with a file that was imported: its data was copied or moved
+to the destination, or, as a file with the same contents was already there,
+the source was skipped (left in place) or unlinked"""
+
+
+def _split(path):
+    """Splits a path, interning its directory, so it is stored only once"""
+
+    if path is None:
+        return None, None
+    dirname, basename = os.path.split(path)
+    return sys.intern(dirname), basename
+
+
+class ImportRecord(object):
+    """The outcome of importing a single file
+
+  Records are meant to be kept in large numbers (e.g. for a digest), so they
+  use ``__slots__``, and directories of source and destination paths are
+  interned: files in the same directory share the same string.  Paths are
+  joined when accessed.
+
+
+  Parameters:
+
+    src (str): The path leading to the source file
+
+    dst (str): The path leading to the destination file, if one was decided
+
+    size (int): The size of the file in bytes, if known
+
+    date (datetime.datetime): The date the file was produced, if found
+
+    reader (str): How the date was found: the name of the metadata that was
+      read (e.g. ``exif``), ``timestamp`` if the file system timestamp was
+      used, or ``None``
+
+    timings (tuple): Number of seconds spent on each of :py:data:`STAGES`
+      (zero for stages that did not run)
+
+    error (type): The class of the exception that stopped the import, or
+      ``None``, if the file was imported
+
+    action (str): If the file was imported, one of :py:data:`ACTIONS`.  For
+      ``skip`` and ``unlink``, ``dst`` is the existing duplicate.
+
+  """
+
+    __slots__ = (
+        "_srcdir",
+        "_srcname",
+        "_dstdir",
+        "_dstname",
+        "size",
+        "date",
+        "reader",
+        "timings",
+        "error",
+        "action",
+    )
+
+    def __init__(
+        self,
+        src,
+        dst=None,
+        size=None,
+        date=None,
+        reader=None,
+        timings=(),
+        error=None,
+        action=None,
+    ):
+
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.date = date
+        self.reader = reader
+        self.timings = tuple(timings)
+        self.error = error
+        self.action = action
+
+    @property
+    def src(self):
+        return os.path.join(self._srcdir, self._srcname)
+
+    @src.setter
+    def src(self, path):
+        self._srcdir, self._srcname = _split(path)
+
+    @property
+    def dst(self):
+        if self._dstdir is None:
+            return None
+        return os.path.join(self._dstdir, self._dstname)
+
+    @dst.setter
+    def dst(self, path):
+        self._dstdir, self._dstname = _split(path)
+
+    @property
+    def ok(self):
+        """``True`` if the file was imported"""
+
+        return self.error is None
+
+    @property
+    def duplicate(self):
+        """``True`` if the file was already at the destination"""
+
+        return self.action in ("skip", "unlink")
+
+    @property
+    def elapsed(self):
+        """Total number of seconds spent importing the file"""
+
+        return sum(self.timings)
+
+    def __fspath__(self):
+        """Returns the destination path, or the source path if there is none,
+    so that records may be passed to :py:mod:`os.path` functions"""
+
+        return self.dst if self._dstdir is not None else self.src
+
+    def __repr__(self):
+        if self.error is None:
+            return "ImportRecord(%r -> %r, %s)" % (
+                self.src,
+                self.dst,
+                self.action,
+            )
+        return "ImportRecord(%r, error=%s)" % (self.src, self.error.__name__)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Bounded-memory accumulation of import results, between digests"""
+
+import io
+import os
+import csv
+import gzip
+import tempfile
+import collections
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+COLUMNS = (
+    "path",
+    "src",
+    "dst",
+    "size",
+    "date",
+    "reader",
+    "action",
+    "error",
+    "elapsed",
+)
+"""Columns of the table of results, see :py:meth:`Results.table`"""
+
+
+def _row(path, record):
+    """Returns the row of the table of results for a path and its record"""
+
+    if record is None:
+        return [path] + [""] * (len(COLUMNS) - 1)
+    return [
+        path,
+        record.src,
+        record.dst or "",
+        "" if record.size is None else record.size,
+        "" if record.date is None else record.date.isoformat(),
+        record.reader or "",
+        record.action or "",
+        "" if record.error is None else record.error.__name__,
+        "%.3f" % record.elapsed,
+    ]
+
+
+class Results(object):
+    """A list of paths that keeps a bounded number of them in memory
+
+  Paths are counted per folder, and the first few are kept as a sample, for
+  summaries.  If import records are given with paths, the number of bytes and
+  the range of dates of files are also kept per folder.  The full list is
+  kept in memory up to ``threshold`` paths.  Beyond that, paths (and details
+  from their records) are spilled to a compressed CSV file on disk, in
+  batches.
+
+
+  Parameters:
+
+    sample (int): Number of paths to keep as a sample
+
+    threshold (int): Maximum number of paths to keep in memory, before
+      spilling them to disk
+
+    dirname (str): Directory where to create the spill file.  If not set, use
+      the default temporary directory.
+
+  """
+
+    def __init__(self, sample=20, threshold=1000, dirname=None):
+
+        self.sample_size = sample
+        self.threshold = threshold
+        self.dirname = dirname
+        self.clear()
+
+    def clear(self):
+        """Forgets all paths, removing the spill file, if any"""
+
+        if getattr(self, "spill", None) is not None:
+            try:
+                os.unlink(self.spill)
+            except OSError as e:
+                logger.warning("cannot remove %s: %s", self.spill, e)
+
+        self.count = 0
+        self.folders = collections.Counter()
+        self.sizes = collections.Counter()  # folder -> number of bytes
+        self.dates = {}  # folder -> [first date, last date]
+        self.sample = []
+        self.spill = None
+        self._memory = []  # (path, record)
+
+    def append(self, path, record=None):
+        """Records a new path
+
+    Parameters:
+
+      path (str): The path to record
+
+      record (popster.records.ImportRecord): If set, the record of the import
+        of the file, with further details
+
+    """
+
+        self.count += 1
+        folder = os.path.dirname(path)
+        self.folders[folder] += 1
+        if record is not None:
+            self.sizes[folder] += record.size or 0
+            if record.date is not None:
+                dates = self.dates.get(folder)
+                if dates is None:
+                    self.dates[folder] = [record.date, record.date]
+                else:
+                    dates[0] = min(dates[0], record.date)
+                    dates[1] = max(dates[1], record.date)
+        if len(self.sample) < self.sample_size:
+            self.sample.append(path)
+        self._memory.append((path, record))
+        if len(self._memory) >= self.threshold:
+            self._flush()
+
+    @property
+    def size(self):
+        """Total number of bytes of files with records"""
+
+        return sum(self.sizes.values())
+
+    def _write(self, f, header=False):
+        """Writes rows kept in memory as CSV to a (text) file object"""
+
+        writer = csv.writer(f, lineterminator="\n")
+        if header:
+            writer.writerow(COLUMNS)
+        for path, record in self._memory:
+            writer.writerow(_row(path, record))
+
+    def _flush(self):
+        """Spills the paths kept in memory to disk"""
+
+        if not self._memory:
+            return
+
+        header = self.spill is None
+        if header:
+            fd, self.spill = tempfile.mkstemp(
+                prefix="popster-", suffix=".csv.gz", dir=self.dirname
+            )
+            os.close(fd)
+            logger.debug("Spilling results to %s", self.spill)
+
+        # each batch is a gzip member of its own, concatenated to the others
+        with gzip.open(self.spill, "at", newline="") as f:
+            self._write(f, header)
+        self._memory = []
+
+    def table(self):
+        """Returns all results as a gzip-compressed CSV table
+
+    The table has a header, and one row per path, with the columns in
+    :py:data:`COLUMNS`.  Details from import records are left empty for paths
+    recorded without them.
+
+    """
+
+        if self.spill is None:
+            data = io.BytesIO()
+            with gzip.open(data, "wt", newline="") as f:
+                self._write(f, header=True)
+            return data.getvalue()
+
+        self._flush()
+        with open(self.spill, "rb") as f:
+            return f.read()
+
+    def __iter__(self):
+        if self.spill is not None:
+            with gzip.open(self.spill, "rt", newline="") as f:
+                rows = csv.reader(f)
+                next(rows)  # header
+                for row in rows:
+                    yield row[0]
+        yield from [k[0] for k in self._memory]
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Rules deciding which files and directories are imported, ignored or erased
+
+Rules are lists of names, that may contain shell-style wildcards (see
+:py:mod:`fnmatch`), for directories and files that should be ignored or
+erased, and a list of file extensions that are supported.  They are compiled
+once: plain names are kept in :py:class:`frozenset` objects, and all
+wildcards are compiled into a single regular expression.  Ignore rules take
+precedence over erase rules.
+
+Verdicts on directories are cached, so that when checking many files in the
+same directory, its ancestors are judged only once.
+"""
+
+import os
+import re
+import json
+import fnmatch
+import functools
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+EXTENSIONS = [
+    ".jpg",
+    ".jpeg",
+    ".cr2",  # canon raw images (mostly tiff with exif)
+    ".thm",  # thumbnail files, with exif information (little jpg)
+    ".png",  # screenshots on macOS and iOS devices
+    ".avi",  # older cameras
+    ".mp4",  # canon powershot g7 x mark ii
+    ".mov",  # iphone, powershot sx230 hs, canon eos 500d
+    ".m4v",  # ipod encoded clips
+    ".aae",  # editing information for iPhone Photos app
+    ".heic",  # high-efficiency image format (Apple)
+    ".heif",  # high-efficiency image format (Apple)
+]
+"""List of extensions supported by this program (lower-case)"""
+
+
+ACCEPT = "accept"
+IGNORE = "ignore"
+ERASE = "erase"
+UNSUPPORTED = "unsupported"
+
+
+def _compile(**rules):
+    """Compiles lists of names into sets and a single regular expression
+
+
+  Parameters:
+
+    rules (dict): Lists of names, that may contain wildcards, indexed by the
+      verdict they lead to
+
+
+  Returns:
+
+    dict: Sets of plain names, indexed by verdict
+
+    re.Pattern: A regular expression matching names with wildcards, with a
+    named group for each verdict, or ``None``, if there are no wildcards
+
+  """
+
+    names = {}
+    globs = []
+    for verdict, patterns in rules.items():
+        plain = [k for k in patterns if not any(c in k for c in "*?[")]
+        names[verdict] = frozenset(plain)
+        wild = [fnmatch.translate(k) for k in patterns if k not in plain]
+        if wild:
+            globs.append("(?P<%s>%s)" % (verdict, "|".join(wild)))
+
+    return names, re.compile("|".join(globs)) if globs else None
+
+
+class Rules(object):
+    """A compiled set of rules for directories and files
+
+
+  Parameters:
+
+    extensions (list): File extensions (including the leading dot) that are
+      supported.  Matching is case-insensitive.
+
+    ignore_dirs (list): Names of directories that are ignored, with all their
+      contents
+
+    erase_dirs (list): Names of directories that are erased (e.g. useless
+      directories produced by cameras), when cleaning-up
+
+    ignore_files (list): Names of files that are ignored
+
+    erase_files (list): Names of files that are erased, when cleaning-up
+
+  """
+
+    def __init__(
+        self,
+        extensions=EXTENSIONS,
+        ignore_dirs=(".*",),
+        erase_dirs=("MISC", "CANONMSC"),
+        ignore_files=(".Icon", ".*"),
+        erase_files=(".DS_Store",),
+    ):
+
+        self.extensions = frozenset([k.lower() for k in extensions])
+        # order matters: ignore rules take precedence
+        self._dirs, self._dirs_re = _compile(
+            ignore=ignore_dirs, erase=erase_dirs
+        )
+        self._files, self._files_re = _compile(
+            ignore=ignore_files, erase=erase_files
+        )
+        self.ignored = functools.lru_cache(maxsize=4096)(self._ignored)
+
+    @classmethod
+    def load(cls, path):
+        """Loads rules from a JSON file
+
+    The file should contain an object, with optional keys ``extensions``,
+    ``ignore-dirs``, ``erase-dirs``, ``ignore-files`` and ``erase-files``,
+    each a list of strings.  Missing keys are set to their defaults.
+
+
+    Raises:
+
+      ValueError: If the file contents are invalid
+
+    """
+
+        with open(path, "rt") as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict):
+            raise ValueError("rules in %s must be a JSON object" % path)
+        kwargs = {}
+        for key, value in data.items():
+            arg = key.replace("-", "_")
+            if arg not in (
+                "extensions",
+                "ignore_dirs",
+                "erase_dirs",
+                "ignore_files",
+                "erase_files",
+            ):
+                raise ValueError("unknown key %r in rules at %s" % (key, path))
+            if not isinstance(value, list):
+                raise ValueError("%r must be a list in %s" % (key, path))
+            kwargs[arg] = value
+        return cls(**kwargs)
+
+    @staticmethod
+    def _judge(name, names, regexp):
+        """Returns the verdict on a name, given compiled rules"""
+
+        if name in names["ignore"]:
+            return IGNORE
+        match = regexp.match(name) if regexp is not None else None
+        if match is not None and match.lastgroup == "ignore":
+            return IGNORE
+        if name in names["erase"] or match is not None:
+            return ERASE
+        return ACCEPT
+
+    def directory(self, name):
+        """Judges a directory by its name
+
+    Returns:
+
+      str: One of :py:data:`IGNORE`, :py:data:`ERASE` or :py:data:`ACCEPT`
+
+    """
+
+        return self._judge(name, self._dirs, self._dirs_re)
+
+    def file(self, name):
+        """Judges a file by its name
+
+    Returns:
+
+      str: One of :py:data:`IGNORE`, :py:data:`ERASE`,
+      :py:data:`UNSUPPORTED` or :py:data:`ACCEPT`
+
+    """
+
+        verdict = self._judge(name, self._files, self._files_re)
+        if verdict != ACCEPT:
+            return verdict
+        if os.path.splitext(name)[1].lower() not in self.extensions:
+            return UNSUPPORTED
+        return ACCEPT
+
+    def _ignored(self, path):
+        """Tells if a directory, or any of its ancestors, is ignored"""
+
+        parent, name = os.path.split(path)
+        if name and self.directory(name) == IGNORE:
+            return True
+        if not parent or parent == path:
+            return False
+        return self.ignored(parent)
+
+    def check(self, path):
+        """Judges a file by its path, considering directories leading to it
+
+    Returns:
+
+      str: :py:data:`IGNORE` if the file or any directory leading to it is
+      ignored, otherwise, the verdict on the file name (see :py:meth:`file`)
+
+    """
+
+        dirname, name = os.path.split(path)
+        if self.ignored(dirname):
+            return IGNORE
+        return self.file(name)
+
+    def accepts(self, path):
+        """Tells if the file at ``path`` should be imported"""
+
+        return self.check(path) == ACCEPT
+
+    def patterns(self):
+        """Returns patterns for supported files, for
+    :py:class:`watchdog.events.PatternMatchingEventHandler`"""
+
+        return ["*%s" % k for k in sorted(self.extensions)]
+
+
+DEFAULT = Rules()
+"""Rules used when none are given"""
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Ordering of queued files for import, in per-device lanes
+
+Files waiting to be imported are grouped in lanes, one per device (as given by
+``st_dev``), so that sources on different devices (e.g. an SD card slot and a
+USB port) take turns, instead of competing at random.  Within each lane, files
+are ordered according to one of :py:data:`ORDERS`:
+
+  * ``size``: smaller files first, so that a large video does not delay
+    hundreds of photos.  Files are grouped in size classes (see
+    :py:data:`CLASSES`) and ordered by inode within each class, which often
+    matches their order on disk.  Files are promoted by a class for every
+    ``aging`` seconds they wait, so large files are not delayed forever.
+  * ``inode``: inode order only, favouring sequential reads
+  * ``arrival``: the order in which files were first seen by the scheduler
+
+The number of files copied concurrently from each device may also be bounded,
+see :py:meth:`Scheduler.lane`.
+"""
+
+import os
+import time
+import bisect
+import heapq
+import threading
+import itertools
+import contextlib
+import collections
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+ORDERS = ("size", "inode", "arrival")
+"""Supported orderings of files within a lane"""
+
+CLASSES = (1 << 20, 16 << 20, 256 << 20)
+"""Upper bounds of size classes, in bytes.  Files larger than the last bound
+are in a class of their own."""
+
+
+class Scheduler(object):
+    """Decides which queued files to import next, and in which order
+
+
+  Parameters:
+
+    order (str): How to order files within a lane, one of :py:data:`ORDERS`
+
+    lanes (int): If set, the maximum number of files of the same device that
+      may be copied at once.  Otherwise, concurrency is only bounded by the
+      number of workers.
+
+    aging (float): When ordering by size, number of seconds a file must wait
+      to be promoted to the next smaller size class
+
+  """
+
+    def __init__(self, order="size", lanes=None, aging=60.0):
+
+        if order not in ORDERS:
+            raise ValueError(
+                "unsupported order %r, choose one of %s"
+                % (order, ", ".join(ORDERS))
+            )
+        self.order = order
+        self.lanes = lanes
+        self.aging = aging
+        self.lock = threading.Lock()
+        self.semaphores = {}  # st_dev -> threading.BoundedSemaphore
+        self.devices = {}  # path -> st_dev, for files of the last plan
+        self._info = {}  # path -> (st_dev, size class, st_ino, seen at, seq)
+        self._seq = itertools.count()
+
+    def _describe(self, path, now):
+        """Returns (and caches) information used to schedule ``path``"""
+
+        info = self._info.get(path)
+        if info is not None:
+            return info
+
+        try:
+            st = os.stat(path)
+            dev, cls, ino = (
+                st.st_dev,
+                bisect.bisect_left(CLASSES, st.st_size),
+                st.st_ino,
+            )
+        except OSError:  # gone, fails right away when processed
+            dev, cls, ino = None, 0, 0
+
+        info = self._info[path] = (dev, cls, ino, now, next(self._seq))
+        return info
+
+    def _key(self, info, now):
+        """Returns the sort key of a file within its lane"""
+
+        dev, cls, ino, seen, seq = info
+        if self.order == "size":
+            if self.aging:
+                cls = max(0, cls - int((now - seen) / self.aging))
+            return (cls, ino, seq)
+        if self.order == "inode":
+            return (ino, seq)
+        return (seq,)
+
+    def plan(self, paths, limit=None, now=None):
+        """Returns queued files in the order they should be imported
+
+
+    Parameters:
+
+      paths (iterable): Paths of all files waiting to be imported
+
+      limit (int): If set, return at most this number of files
+
+      now (float): The current time, as returned by :py:func:`time.time`.  If
+        not set, use the current time.
+
+
+    Returns:
+
+      list: Paths of files to import next, in order.  Lanes take turns, one
+      file at a time.
+
+    """
+
+        now = time.time() if now is None else now
+        paths = list(paths)
+
+        lanes = collections.defaultdict(list)
+        for path in paths:
+            info = self._describe(path, now)
+            lanes[info[0]].append((self._key(info, now), path))
+
+        ordered = []
+        for dev in sorted(lanes, key=lambda k: (k is not None, k)):
+            if limit is not None and limit < len(lanes[dev]):
+                lane = heapq.nsmallest(limit, lanes[dev])
+            else:
+                lane = sorted(lanes[dev])
+            ordered.append([k[1] for k in lane])
+
+        # lanes take turns
+        retval = [
+            k
+            for k in itertools.chain.from_iterable(
+                itertools.zip_longest(*ordered)
+            )
+            if k is not None
+        ]
+        if limit is not None:
+            retval = retval[:limit]
+
+        self.devices = dict([(k, self._info[k][0]) for k in retval])
+        for k in retval:
+            del self._info[k]
+
+        # forgets files that left the queue otherwise (e.g. removed)
+        if len(self._info) > 2 * (len(paths) - len(retval)) + 1024:
+            pending = set(paths)
+            self._info = dict(
+                [(k, v) for k, v in self._info.items() if k in pending]
+            )
+
+        if len(lanes) > 1:
+            logger.debug(
+                "[scheduler] %d file(s) planned from %d device(s)",
+                len(retval),
+                len(lanes),
+            )
+        return retval
+
+    def lane(self, path):
+        """Returns a context manager bounding copies per device
+
+
+    Parameters:
+
+      path (str): The path of a file returned by the last call to
+        :py:meth:`plan`
+
+
+    Returns:
+
+      object: A context manager that waits for a free slot on the file's
+      device when entered, and releases it when exited
+
+    """
+
+        dev = self.devices.get(path)
+        if self.lanes is None or dev is None:
+            return contextlib.nullcontext()
+        with self.lock:
+            semaphore = self.semaphores.get(dev)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.lanes)
+                self.semaphores[dev] = semaphore
+        return semaphore
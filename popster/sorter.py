@@ -13,9 +13,15 @@ import errno
 import shutil
 import smtplib
 import datetime
+import queue
 import platform
+import threading
+import functools
+import concurrent.futures
 import pkg_resources
 import email.mime.text
+import email.mime.multipart
+import email.mime.application
 
 import logging
 
@@ -27,40 +33,27 @@ from PIL import Image
 import watchdog.events
 import watchdog.observers
 
-
-EXTENSIONS = [
-    ".jpg",
-    ".jpeg",
-    ".cr2",  # canon raw images (mostly tiff with exif)
-    ".thm",  # thumbnail files, with exif information (little jpg)
-    ".png",  # screenshots on macOS and iOS devices
-    ".avi",  # older cameras
-    ".mp4",  # canon powershot g7 x mark ii
-    ".mov",  # iphone, powershot sx230 hs, canon eos 500d
-    ".m4v",  # ipod encoded clips
-    ".aae",  # editing information for iPhone Photos app
-    ".heic",  # high-efficiency image format (Apple)
-    ".heif",  # high-efficiency image format (Apple)
-]
-"""List of extensions supported by this program (lower-case)"""
-
+from .journal import Journal, recover
+from .stability import StabilityTracker
+from .walker import walk
+from .poller import PollingObserver
+from .hybrid import HybridObserver
+from .results import Results
+from .digest import Digest
+from .mailer import Mailer
+from .fingerprints import Fingerprints
+from .scheduler import Scheduler
+from .rules import EXTENSIONS  # backwards compatibility
+from .rules import DEFAULT as DEFAULT_RULES
+from .rules import ACCEPT, IGNORE, ERASE, UNSUPPORTED
+from .records import ImportRecord, STAGES
+from .ledger import Ledger
+from .utils import files_match
 
 XMP_DATECREATED = re.compile(r"(?P<d>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})")
 """Regular expression to search for dates in XMP data"""
 
 
-def _ignore_dir(d):
-    """Select directories that should be ignored"""
-
-    return d.startswith(".")
-
-
-def _erase_dir(d):
-    """Select directories that should be erased"""
-
-    return d in ("MISC", "CANONMSC")
-
-
 def _rmtree(d, dry):
     """Removes a directory recursively
 
@@ -82,12 +75,6 @@ def _rmtree(d, dry):
     return d
 
 
-def _erase_file(f):
-    """Select files that should be erased"""
-
-    return f in (".DS_Store",)
-
-
 def _rmfile(f, dry):
     """Removes a file"""
 
@@ -97,17 +84,81 @@ def _rmfile(f, dry):
     return f
 
 
-def _ignore_file(path, f):
-    """Select files that should be ignored"""
+def _remove_empty(base, dirs, dry, rules=None):
+    """Removes directories that became empty, and their empty ancestors
+
+  Only the given directories and their ancestors (up to, but excluding,
+  ``base``) are considered.  A directory is empty if it only contains hidden
+  or useless files and directories.  Directories that are hidden, or inside
+  hidden directories, are never removed.
+
+
+  Parameters:
+
+    base (str): The path leading to the base directory that is being monitored.
+      It is never removed.
+
+    dirs (iterable): Paths of directories that may have become empty (e.g.
+      because files were moved out of them)
+
+    dry (bool): If set to ``True``, then it will not remove anything, just log.
+
+    rules (popster.rules.Rules): Rules deciding which files and directories
+      are hidden or useless.  If not set, use the default ones.
+
+
+  Returns:
+
+    list: The paths of directories that were removed
 
-    if f in (".Icon",) or f.startswith("."):
-        return True
+  """
 
-    for p in path.split(os.sep):
-        if _ignore_dir(p):
-            return True
+    rules = rules or DEFAULT_RULES
+    base = os.path.normpath(base)
+
+    candidates = set()
+    for d in dirs:
+        d = os.path.normpath(d)
+        while d != base and d.startswith(base + os.sep):
+            if d in candidates:
+                break
+            candidates.add(d)
+            d = os.path.dirname(d)
+
+    removed = []
+    kept = set()
+
+    # deepest first, so that parents of removed directories are removed as
+    # well, if they become empty
+    for d in sorted(candidates, key=lambda k: k.count(os.sep), reverse=True):
+        if d in kept:
+            continue
+        parts = os.path.relpath(d, base).split(os.sep)
+        if any(rules.directory(k) != ACCEPT for k in parts):
+            continue
+        try:
+            # names are judged both as directories and as files
+            contents = [
+                k
+                for k in os.listdir(d)
+                if rules.directory(k) == ACCEPT
+                and rules.file(k) not in (IGNORE, ERASE)
+            ]
+        except OSError:  # gone
+            continue
+        if contents:
+            # no ancestor can be empty either
+            parent = os.path.dirname(d)
+            while parent != base and parent not in kept:
+                kept.add(parent)
+                parent = os.path.dirname(parent)
+            continue
+        try:
+            removed.append(_rmtree(d, dry))
+        except OSError as e:
+            logger.warning("could not remove %s: %s", d, e)
 
-    return False
+    return removed
 
 
 class DateReadoutError(IOError):
@@ -128,6 +179,12 @@ class ExplicitIgnore(RuntimeError):
     pass
 
 
+class AlreadyImported(ExplicitIgnore):
+    """Exception raised if the ledger shows a file was already imported"""
+
+    pass
+
+
 def setup_logger(name, verbosity):
     """Sets up the logging of a script
 
@@ -208,7 +265,7 @@ def _png_read_creation_date(path):
         raise DateReadoutError(str(e))
 
 
-def _jpeg_read_creation_date(path):
+def _jpeg_read_creation_date(path, tags=None):
     """Retrieves the original creation date of the input JPEG file
 
   This function use the EXIF tags (DateTimeOriginal) to figure out when a file
@@ -219,6 +276,9 @@ def _jpeg_read_creation_date(path):
 
     path (str): A full-path leading to the file to read the data from
 
+    tags (dict): If set, it is updated with the EXIF tags read until the date
+      was found (e.g. ``Image Model``), even if the date cannot be parsed
+
 
   Returns:
 
@@ -235,12 +295,14 @@ def _jpeg_read_creation_date(path):
 
     try:
         with open(path, "rb") as f:
-            tags = exifread.process_file(
+            found = exifread.process_file(
                 f, details=False, stop_tag="EXIF DateTimeOriginal"
             )
-            return datetime.datetime.strptime(
-                tags["EXIF DateTimeOriginal"].printable, "%Y:%m:%d %H:%M:%S"
-            )
+        if tags is not None:
+            tags.update(found)
+        return datetime.datetime.strptime(
+            found["EXIF DateTimeOriginal"].printable, "%Y:%m:%d %H:%M:%S"
+        )
     except Exception as e:
         raise DateReadoutError(str(e))
 
@@ -371,6 +433,15 @@ CREATION_DATE_READER = {
 """For each supported extension, uses a specific reader for its date"""
 
 
+READERS = {
+    _jpeg_read_creation_date: "exif",
+    _png_read_creation_date: "xmp",
+    _video_read_creation_date: "mediainfo",
+    file_timestamp: "timestamp",
+}
+"""Short names of date readers, recorded on :py:class:`ImportRecord` objects"""
+
+
 def read_creation_date(path):
     """Retrieves the original creation date of the input file
 
@@ -478,8 +549,8 @@ def _remove_osx_locks(f, dry):
             os.chflags(f, new_flags)
 
 
-def _copy_file(src, dst, move, dry):
-    """Copies file and sets permissions and ownership to meet parent directory
+def _transfer_file(src, dst, move, dry):
+    """Copies (or moves) file data from source to destination
 
   This function will raise an exception in case of errors.
 
@@ -501,6 +572,20 @@ def _copy_file(src, dst, move, dry):
             shutil.copyfile(src, dst)
     logger.info("%s -> %s", src, dst)
 
+
+def _set_permissions(dst, dry):
+    """Sets permissions and ownership of a file to meet parent directory
+
+  This function will raise an exception in case of errors.
+
+
+  Parameters:
+
+    dst (str): The path leading to the file
+    dry (bool): If set to ``True``, just show what it would do
+
+  """
+
     if not dry:
         parent = os.path.dirname(dst)
         info = os.stat(parent)
@@ -520,14 +605,67 @@ def _copy_file(src, dst, move, dry):
         logger.info("chmod %s %s", oct(perms), dst)
 
 
-def copy(src, dst, fmt, timestamp, nodate, move, dry):
+_RESERVED = {}
+"""Destination file names being currently written to by :py:func:`copy`,
+mapped to events that are set once they are released"""
+
+_RESERVED_LOCK = threading.Lock()
+
+RESERVED_WAIT = 60.0
+"""Maximum number of seconds to wait for a file being written to by another
+thread, before comparing it with a possible duplicate, see
+:py:func:`_find_duplicate`"""
+
+
+def _reserve(filename):
+    """Reserves a destination file name that is free to be written to
+
+  If a file with the same name exists, or is being currently written to by
+  another thread, then a ``~`` is appended to the file name (before the
+  extension), until a free name is found.
+
+
+  Parameters:
+
+    filename (str): The preferred destination file name
+
+
+  Returns:
+
+    str: The reserved file name, that must be released with
+    :py:func:`_release` once the file is written.
+
+  """
+
+    with _RESERVED_LOCK:
+        while os.path.exists(filename) or filename in _RESERVED:
+            filename, e = os.path.splitext(filename)
+            filename += "~" + e
+        _RESERVED[filename] = threading.Event()
+    return filename
+
+
+def _release(filename):
+    """Releases a file name reserved with :py:func:`_reserve`"""
+
+    with _RESERVED_LOCK:
+        released = _RESERVED.pop(filename, None)
+    if released is not None:
+        released.set()
+
+
+def copy(
+    src, dst, fmt, timestamp, nodate, move, dry, journal=None, ledger=None
+):
     """Copies a single source file to a destination directory
 
   This function performs 4 distinct tasks:
 
     1. Determines if file has a supported extension, otherwise ignores it
     2. Figures out when the file was produced
-    3. Moves file to destination directory
+    3. Moves file to destination directory, unless a file with the same
+       contents is already there.  In that case, the source file is left in
+       place (when copying) or removed (when moving).
 
 
   Parameters:
@@ -558,11 +696,19 @@ def copy(src, dst, fmt, timestamp, nodate, move, dry):
 
     dry (bool): If set to ``True``, then it will not copy anything, just log.
 
+    journal (popster.journal.Journal): If set, record each stage of the
+      transfer on this journal, so that partial operations can be recovered
+      after a crash.
+
+    ledger (popster.ledger.Ledger): If set, files recorded on this ledger are
+      not imported again, and imported files are recorded on it.
+
 
   Returns:
 
-    str: A string object, if the file was correctly moved, pointing out
-    to the path where the new file resides.
+    ImportRecord: A record of the import, if the file was correctly moved.
+    Its ``dst`` attribute points out to the path where the new file resides.
+    Its ``action`` attribute tells if the file was a duplicate.
 
 
   Raises:
@@ -573,310 +719,1286 @@ def copy(src, dst, fmt, timestamp, nodate, move, dry):
     UnsupportedExtensionError: in case the file extension is unsupported by
     this procedure
 
+    AlreadyImported: in case the ledger shows the file was already imported
+
   """
 
-    if _ignore_file(os.path.dirname(src), os.path.basename(src)):
-        raise ExplicitIgnore(src)
+    times = [time.time()]
+    _check_file(src)
+    info, digest = _check_ledger(src, ledger)
+    dst_dirname, date, reader = _destination(src, fmt, timestamp, nodate)
+    times.append(time.time())
+    dst_filename, duplicate = _plan_destination(src, dst, dst_dirname, dry)
+    times.append(time.time())
+
+    if duplicate:
+        action = _skip(src, dst_filename, move, dry)
+        times.append(time.time())
+    else:
+        action = "move" if move else "copy"
+        try:
+            _transfer(src, dst_filename, move, dry, journal)
+            times.append(time.time())
+            _finalize(src, dst_filename, move, dry, journal)
+        finally:
+            _release(dst_filename)
+    if ledger is not None and not dry:
+        ledger.add(info, src, dst_filename, digest)
+    times.append(time.time())
+
+    return ImportRecord(
+        src,
+        dst_filename,
+        info.st_size,
+        date,
+        reader,
+        [j - i for i, j in zip(times[:-1], times[1:])],
+        action=action,
+    )
+
+
+def _check_ledger(src, ledger):
+    """Stats a file, raises if the ledger shows it was already imported
+
 
-    # 1. determines if file is something we need to take care of
-    if os.path.splitext(src)[1].lower() not in EXTENSIONS:
+  Returns:
+
+    os.stat_result: The result of :py:func:`os.stat` on ``src``
+
+    str: The hash of the file contents, if computed by the ledger
+
+  """
+
+    info = os.stat(src)
+    if ledger is None:
+        return info, None
+    seen, digest = ledger.contains(info, src)
+    if seen:
+        raise AlreadyImported(src)
+    return info, digest
+
+
+def _check_file(src, rules=None):
+    """Checks if a file should be imported, raises otherwise"""
+
+    verdict = (rules or DEFAULT_RULES).check(src)
+    if verdict == UNSUPPORTED:
         raise UnsupportedExtensionError(src)
+    if verdict != ACCEPT:
+        raise ExplicitIgnore(src)
+
+
+def _destination(src, fmt, timestamp, nodate):
+    """Figures out when the file was produced, returns the destination folder
+
+  Parameters are the same as for :py:func:`copy`.
+
+
+  Returns:
+
+    str: The name of the directory, relative to the destination directory,
+    where the file should be stored.
+
+    datetime.datetime: The date the file was produced, or ``None``, if it
+    could not be found
+
+    str: How the date was found, see :py:data:`READERS`, or ``None``
+
+  """
 
-    # 2. figures out when the file was produced - may raise
     try:
         date = read_creation_date(src)
-        dst_dirname = date.strftime(fmt).lower()
+        reader = CREATION_DATE_READER[os.path.splitext(src)[1].lower()]
+        return date.strftime(fmt).lower(), date, READERS.get(reader)
     except DateReadoutError:
         if timestamp:
             date = file_timestamp(src)
-            dst_dirname = date.strftime(fmt).lower()
+            return date.strftime(fmt).lower(), date, READERS[file_timestamp]
         else:
-            dst_dirname = nodate
+            return nodate, None, None
 
-    # 3. move file to destination directory
-    dst_path = make_dirs(dst, dst_dirname, dry)
-    dst_filename = os.path.join(dst, dst_dirname, os.path.basename(src).lower())
 
-    # if a file with the same name exists, recalls myself with a "~" added to
-    # the destination filename
-    while os.path.exists(dst_filename):
-        dst_filename, e = os.path.splitext(dst_filename)
-        dst_filename += "~" + e
+def _find_duplicate(src, dst_filename, abort=None):
+    """Looks for a file with the same contents as the source at the destination
 
-    _copy_file(src, dst_filename, move, dry)
+  The file at the preferred destination name, and those at the same name with
+  ``~`` appended (see :py:func:`_reserve`), are compared with the source:
+  sizes first, then contents, up to the first difference (see
+  :py:func:`popster.utils.files_match`).  Files still being written to (e.g.
+  an identical file imported concurrently) are waited for, so that they are
+  compared once complete, as if files were imported one after the other.
+  Files still being written to after :py:data:`RESERVED_WAIT` seconds are
+  considered different, so that a stuck (or leaked) reservation does not block
+  the caller.
 
-    return dst_filename
 
+  Parameters:
 
-def rcopy(base, dst, fmt, timestamp, nodate, move, dry):
-    """Recursively copies all files found under a given base directory
+    src (str): The path leading to the source file
 
-  This function recursively treats all files found in the source directory. It
-  emits a warning when a file was found cannot be processed. It calls
-  py:func:`move` to move files that match our prescription.
+    dst_filename (str): The preferred destination file name
 
+    abort (threading.Event): If set, stop waiting for files being written to
+      once this event is set, and consider them different
 
-  Parameters:
 
-    base (str): The path leading to the base directory that is being monitored.
-      This value is provided so we don't accidentally erase it.
+  Returns:
 
-    dst (str): A path leading to the base destination directory where to store
-      pictures. If the path does not exist, it will be created.
+    str: The path of the existing file with the same contents, or ``None``
 
-    fmt (str): A string containing date formatters for a **folder** structure
-      that will be added to destination folder, prefixing the files copied. For
-      example: ``"%Y/%B/%d.%m.%Y"``. For information on date fields that be
-      used, please refer to :py:func:`time.strftime`.
+  """
 
-    timestamp (bool): If set, and if no creation time date is found on the
-      traditional object metadata, then organizes images using the filesystem
-      timestamp - first try the creation time if available, else the last
-      modification time.
+    candidate = dst_filename
+    while True:
+        with _RESERVED_LOCK:
+            writing = _RESERVED.get(candidate)
+        if writing is not None:
+            limit = time.time() + RESERVED_WAIT
+            while not writing.wait(0.1):
+                if abort is not None and abort.is_set():
+                    break
+                if time.time() > limit:
+                    logger.warning(
+                        "%s is still being written to after %g seconds, "
+                        "considering it different from %s",
+                        candidate,
+                        RESERVED_WAIT,
+                        src,
+                    )
+                    break
+            else:
+                writing = None
+        if writing is None:
+            if not os.path.exists(candidate):
+                return None
+            if files_match(src, candidate):
+                return candidate
+        candidate, e = os.path.splitext(candidate)
+        candidate += "~" + e
 
-    nodate (str): A string with the name of a directory that will be used
-      verbatim in case a date cannot be retrieved from the source filename.
-      This setting is (naturally) affected by the ``timestamp`` parameter above
-      - if that is set (to ``True``), then dates will likely be attributed to
-        all files
 
-    move (bool): If set to ``True``, move instead of copying
+def _plan_destination(src, dst, dst_dirname, dry, abort=None):
+    """Creates the destination folder and reserves the destination file name
 
-    dry (bool): If set to ``True``, then it will not copy anything, just log.
+  Parameters are the same as for :py:func:`copy` and
+  :py:func:`_find_duplicate`.
 
 
   Returns:
 
-    list: A list containing the full paths of all files successfully copied to
-    the destination directory. The list correspond to the **new** file
-    locations.
+    str: The (reserved) destination file name.  It should be released with
+    :py:func:`_release` once the file is written.  If a file with the same
+    contents already exists at the destination, its path is returned instead,
+    and it is not reserved.
 
-    list: A list containing the full paths of all files that could **not** be
-    copied to the destination directory. A warning is emitted for each of the
-    files that could not be moved.
+    bool: ``True`` if the returned path is that of an existing duplicate
 
   """
 
-    good, bad = [], []
+    make_dirs(dst, dst_dirname, dry)
+    dst_filename = os.path.join(dst, dst_dirname, os.path.basename(src).lower())
 
-    for path, dirs, files in os.walk(base, topdown=True):
+    duplicate = _find_duplicate(src, dst_filename, abort)
+    if duplicate is not None:
+        return duplicate, True
 
-        # ignore hidden directories, erase useless directories from camera
-        # ignore any further interaction with those
-        keep = []
-        for d in dirs:
-            if _ignore_dir(d):
-                logger.info("ignoring %s..." % os.path.join(path, d))
-                continue
-            if _erase_dir(d):
-                dirpath = os.path.join(path, d)
-                _rmtree(dirpath, dry)
-                continue
-            keep.append(d)
-        dirs[:] = keep  # effectively prunes os.walk() - see manual
+    # if a file with the same name exists, recalls myself with a "~" added to
+    # the destination filename
+    return _reserve(dst_filename), False
 
-        for f in files:
-            if _ignore_file(path, f):
-                logger.info("ignoring %s..." % os.path.join(path, f))
-                continue
-            if _erase_file(f):
-                filepath = os.path.join(path, f)
-                _rmfile(filepath, dry)
-                continue
-            try:
-                good.append(
-                    copy(
-                        os.path.join(path, f),
-                        dst,
-                        fmt,
-                        timestamp,
-                        nodate,
-                        move,
-                        dry,
-                    )
-                )
-            except ExplicitIgnore as e:
-                action = "copy" if not move else "move"
-                logger.debug(
-                    "explicitly ignoring file during %s operation: %s",
-                    e,
-                    action,
-                )
-            except UnsupportedExtensionError as e:
-                action = "copy" if not move else "move"
-                logger.debug(
-                    "ignoring file during %s operation - unsupported ext: %s",
-                    e,
-                    action,
-                )
-                bad.append(os.path.join(path, f))
-            except Exception as e:
-                action = "copy" if not move else "move"
-                logger.warn(
-                    "could not %s %s to new destination: %s", action, path, e
-                )
-                bad.append(os.path.join(path, f))
 
-    return good, bad
+def _skip(src, duplicate, move, dry):
+    """Handles a source file that is already at the destination
 
+  When copying, the source file is left in place.  When moving, it is removed,
+  as if it had been moved over its duplicate.
 
-class Email(object):
-    """An object representing a message to be sent to maintainers
 
+  Returns:
 
-  Parameters:
+    str: The action taken, ``skip`` or ``unlink`` (see
+    :py:data:`popster.records.ACTIONS`)
 
-    subject (str): The e-mail subject
+  """
 
-    body (str): The e-mail body
+    if not move:
+        logger.info("%s == %s (skipped, already imported)", src, duplicate)
+        return "skip"
 
-    hostname (str): The value of hostname to use for e-mail headers.
+    if not dry:
+        _remove_osx_locks(src, dry)
+        os.unlink(src)
+    logger.info("%s == %s (removed, already imported)", src, duplicate)
+    return "unlink"
 
-    sender (str): The e-mail sender. E.g.: ``John Doe <joe@example.com>``
 
-    to (list): The e-mail receiver(s). E.g.:
-      ``Alice Allison <alice@example.com>``
+def _transfer(src, dst_filename, move, dry, journal):
+    """Transfers file data into its (reserved) destination"""
 
-  """
+    if journal is not None and not dry:
+        journal.intent(src, dst_filename, move, os.path.getsize(src))
 
-    def __init__(self, subject, body, hostname, sender, to):
+    _transfer_file(src, dst_filename, move, dry)
 
-        # get information from package and host, put on header
-        prefix = "[popster-%s@%s] " % (
-            pkg_resources.require("popster")[0].version,
-            hostname,
-        )
 
-        self.subject = prefix + subject
-        self.body = body
-        self.sender = sender
-        self.to = to
+def _finalize(src, dst_filename, move, dry, journal):
+    """Sets permissions on the destination file, records completion"""
 
-        # mime message setup
-        self.msg = email.mime.text.MIMEText(self.body)
-        self.msg["Subject"] = self.subject
-        self.msg["From"] = self.sender
-        self.msg["To"] = ", ".join(self.to)
+    _set_permissions(dst_filename, dry)
 
-    def send(self, server, port, username, password):
+    if journal is not None and not dry:
+        journal.copied(src)
+        if move:
+            journal.removed(src)
 
-        server = smtplib.SMTP(server, port)
-        server.ehlo()
-        server.starttls()
-        server.login(username, password)
-        server.sendmail(self.sender, self.to, self.msg.as_bytes())
-        server.close()
 
-    def message(self):
-        """Returns a string representation of the message"""
+class DeadlineReached(RuntimeError):
+    """Exception set on files a :py:class:`Pipeline` did not process in time"""
 
-        return self.msg.as_string()
+    pass
 
 
-class Handler(watchdog.events.PatternMatchingEventHandler):
-    """Handles file moving/copying
+class _Job(object):
+    """A file going through the stages of a :py:class:`Pipeline`"""
+
+    def __init__(self, seq, src):
+        self.seq = seq
+        self.src = src
+        self.dirname = None
+        self.dst = None
+        self.duplicate = False
+        self.action = None
+        self.error = None
+        self.info = None
+        self.digest = None
+        self.date = None
+        self.reader = None
+        self.timings = [0.0] * len(STAGES)
+
+    def record(self):
+        """Returns an :py:class:`ImportRecord` for this job"""
+
+        return ImportRecord(
+            self.src,
+            self.dst,
+            None if self.info is None else self.info.st_size,
+            self.date,
+            self.reader,
+            self.timings,
+            None if self.error is None else type(self.error),
+            self.action if self.error is None else None,
+        )
 
 
-  Parameters:
+_STOP = object()
+"""Marks the end of the input for a :py:class:`Pipeline` stage"""
 
-    base (str): The path leading to the base directory that is being monitored.
-      This value is provided so we don't accidentally erase it.
 
-    dst (str): A path leading to the base destination directory where to store
+class Pipeline(object):
+    """A staged, concurrent, import pipeline
+
+  Files flow through the following stages, connected by bounded queues.  Each
+  stage runs on its own thread(s), so that the metadata for the next files is
+  read while the current one is being copied:
+
+    1. ``scan``: files are taken from the input iterable (e.g. a directory
+       traversal)
+    2. ``date``: checks if the file should be imported and resolves its
+       creation date, and therefore, its destination folder
+    3. ``plan``: creates the destination folder and reserves the destination
+       file name.  Files are planned one at a time, in the order they were
+       taken from the input, so that name collisions and duplicates are
+       resolved as if files were imported one after the other, no matter the
+       number of threads of other stages.
+    4. ``copy``: transfers file data, unless a file with the same contents
+       was found at the destination (see :py:func:`copy`)
+    5. ``finalize``: sets permissions and records completion on the journal
+
+  As all queues are bounded, the memory used by the pipeline does not depend
+  on the number of files fed into it.
+
+
+  Parameters:
+
+    dst (str): A path leading to the root destination directory where to store
       pictures. If the path does not exist, it will be created.
 
     fmt (str): A string containing date formatters for a **folder** structure
-      that will be added to destination folder, prefixing the files copied. For
-      example: ``"%Y/%B/%d.%m.%Y"``. For information on date fields that be
-      used, please refer to :py:func:`time.strftime`.
+      that will be added to destination folder, prefixing the files copied.
 
     timestamp (bool): If set, and if no creation time date is found on the
       traditional object metadata, then organizes images using the filesystem
-      timestamp - first try the creation time if available, else the last
-      modification time.
+      timestamp.
 
     nodate (str): A string with the name of a directory that will be used
       verbatim in case a date cannot be retrieved from the source filename.
-      This setting is (naturally) affected by the ``timestamp`` parameter above
-      - if that is set (to ``True``), then dates will always be attributed to
-        all files
 
-    move (bool): If set to ``True``, move instead of copying
+    move (bool): If set to `True`, move instead of copying.
 
     dry (bool): If set to ``True``, then it will not copy anything, just log.
 
-    hostname (str): The value of hostname to use for e-mail headers.
+    journal (popster.journal.Journal): If set, record each stage of the
+      transfer on this journal.
 
-    sender (str): The e-mail sender. E.g.: ``John Doe <joe@example.com>``
+    workers (int, dict): Number of threads for each stage.  If an integer is
+      passed, it is used for the ``date`` and ``copy`` stages, while
+      ``finalize`` (which is cheap) uses a single thread.  A dictionary
+      mapping stage names to number of threads may be passed instead.  The
+      ``plan`` stage always uses a single thread.
 
-    to (list): The e-mail receiver(s). E.g.:
-      ``Alice Allison <alice@example.com>``
+    depth (int): Maximum number of files waiting in-between two stages
+
+    scheduler (popster.scheduler.Scheduler): If set, the scheduler that
+      ordered the files to process.  Concurrent copies from the same device
+      are bounded as it defines.
+
+    rules (popster.rules.Rules): Rules deciding which files are imported.  If
+      not set, use the default ones.
+
+    ledger (popster.ledger.Ledger): If set, files recorded on this ledger are
+      not imported again (before their metadata is read), and imported files
+      are recorded on it.
 
   """
 
+    STAGES = STAGES
+
+    ORDERED = "plan"
+    """The stage running on a single thread, that processes files in order"""
+
     def __init__(
-        self, base, dst, fmt, timestamp, nodate, move, dry, hostname, sender, to
+        self,
+        dst,
+        fmt,
+        timestamp,
+        nodate,
+        move,
+        dry,
+        journal=None,
+        workers=1,
+        depth=32,
+        scheduler=None,
+        rules=None,
+        ledger=None,
     ):
 
-        super(Handler, self).__init__(
-            patterns=["*%s" % k for k in EXTENSIONS],
-            ignore_patterns=[],
-            ignore_directories=True,
-            case_sensitive=False,
-        )
-
-        self.base = base
         self.dst = dst
         self.fmt = fmt
         self.timestamp = timestamp
         self.nodate = nodate
         self.move = move
         self.dry = dry
-        self.hostname = hostname
-        self.sender = sender
-        self.to = to
+        self.journal = journal
+        if not isinstance(workers, dict):
+            workers = dict(date=workers, copy=workers)
+        self.workers = dict(
+            [
+                (k, 1 if k == self.ORDERED else max(1, workers.get(k, 1)))
+                for k in self.STAGES
+            ]
+        )
+        self.depth = depth
+        self.scheduler = scheduler
+        self.rules = rules
+        self.ledger = ledger
+        self.abort = None  # set while running
+
+    def _date(self, job):
+        _check_file(job.src, self.rules)
+        job.info, job.digest = _check_ledger(job.src, self.ledger)
+        job.dirname, job.date, job.reader = _destination(
+            job.src, self.fmt, self.timestamp, self.nodate
+        )
 
-        from threading import RLock
+    def _plan(self, job):
+        job.dst, job.duplicate = _plan_destination(
+            job.src, self.dst, job.dirname, self.dry, self.abort
+        )
 
-        self.queue_lock = RLock()
-        self.queue = set()
-        self.good = []
-        self.bad = []
-        self.last_activity = time.time()
+    def _copy(self, job):
+        if job.duplicate:
+            job.action = _skip(job.src, job.dst, self.move, self.dry)
+            return
+        job.action = "move" if self.move else "copy"
+        if self.scheduler is None:
+            _transfer(job.src, job.dst, self.move, self.dry, self.journal)
+            return
+        with self.scheduler.lane(job.src):
+            _transfer(job.src, job.dst, self.move, self.dry, self.journal)
 
-        # queues all existing files
-        self.queue_existing()
+    def _finalize(self, job):
+        # always called, so that reserved destination names are released
+        if job.dst is None:
+            return
+        try:
+            if job.error is None and not job.duplicate:
+                _finalize(job.src, job.dst, self.move, self.dry, self.journal)
+            if job.error is None and self.ledger is not None and not self.dry:
+                self.ledger.add(job.info, job.src, job.dst, job.digest)
+        finally:
+            if not job.duplicate:
+                _release(job.dst)
+
+    @staticmethod
+    def _discard(job):
+        """Releases the destination reserved for a job that is not finalized"""
+
+        if job.dst is not None and not job.duplicate:
+            _release(job.dst)
+
+    @staticmethod
+    def _put(q, item, abort):
+        """Puts an item in a bounded queue, returns ``False`` if aborted"""
+
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if abort.is_set():
+                    return False
 
-    def queue_existing(self):
-        """Queues existing files on start-up"""
+    @staticmethod
+    def _get(q, abort):
+        """Gets an item from a queue, returns :py:data:`_STOP` if aborted"""
 
-        for path, dirs, files in os.walk(self.base, topdown=True):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if abort.is_set():
+                    return _STOP
 
-            # ignore hidden directories, erase useless directories from camera
-            # ignore any further interaction with those
-            keep = []
-            for d in dirs:
-                if _ignore_dir(d):
-                    logger.info("ignoring %s..." % os.path.join(path, d))
-                    continue
-                if _erase_dir(d):
-                    logger.info("ignoring %s..." % os.path.join(path, d))
-                    continue
-                keep.append(d)
-            dirs[:] = keep  # effectively prunes os.walk() - see manual
+    def _feed(self, paths, deadline, out, abort, errors, window):
+        """Feeds the first stage of the pipeline with files to process"""
 
-            for f in files:
-                if _ignore_file(path, f):
-                    logger.info("ignoring %s..." % os.path.join(path, f))
-                    continue
-                if _erase_file(f):
-                    logger.info("ignoring %s..." % os.path.join(path, f))
+        try:
+            for seq, path in enumerate(paths):
+                # bounds jobs that may be held, waiting for earlier ones
+                while not window.acquire(timeout=0.1):
+                    if abort.is_set():
+                        return
+                job = _Job(seq, path)
+                limit = deadline() if callable(deadline) else deadline
+                if limit is not None and time.time() > limit:
+                    job.error = DeadlineReached(path)
+                if not self._put(out, job, abort):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for k in range(self.workers[self.STAGES[0]]):
+                self._put(out, _STOP, abort)
+
+    def _work(self, stage, inq, outq, abort, remaining, lock, window):
+        """Runs one thread of a pipeline stage, until its input ends"""
+
+        name = self.STAGES[stage]
+        func = getattr(self, "_" + name)
+        ordered = name == self.ORDERED
+        waiting = {}  # seq -> job, for jobs arriving before earlier ones
+        next_seq = 0
+        aborted = False
+
+        while not aborted:
+            job = self._get(inq, abort)
+            if job is _STOP:
+                break
+            ready = [job]
+            if ordered:
+                # every job goes through every stage, so no seq is missing
+                waiting[job.seq] = job
+                ready = []
+                while next_seq in waiting:
+                    ready.append(waiting.pop(next_seq))
+                    next_seq += 1
+            for job in ready:
+                if job.error is None or name == "finalize":
+                    start = time.time()
+                    try:
+                        func(job)
+                    except Exception as e:
+                        job.error = e
+                    job.timings[stage] = time.time() - start
+                if ordered:
+                    window.release()
+                if not self._put(outq, job, abort):
+                    if name != "finalize":
+                        self._discard(job)
+                    aborted = True
+                    break
+
+        # the last thread of a stage signals the end to the next stage
+        with lock:
+            remaining[name] -= 1
+            last = remaining[name] == 0
+        if last:
+            if stage + 1 < len(self.STAGES):
+                n = self.workers[self.STAGES[stage + 1]]
+            else:
+                n = 1
+            for k in range(n):
+                self._put(outq, _STOP, abort)
+
+    def run(self, paths, deadline=None):
+        """Runs files through the pipeline
+
+
+    Parameters:
+
+      paths (iterable): An iterable (possibly a generator) over the paths of
+        files to import.  It is consumed on a separate thread, as the pipeline
+        has room for more files.
+
+      deadline (float, callable): If set, a time (as returned by
+        :py:func:`time.time`) after which no new files are processed, or a
+        callable returning such a time (or ``None``), which is evaluated for
+        every file.  Files that were not processed by then leave the pipeline
+        with their ``error`` attribute set to :py:class:`DeadlineReached`.
+
+
+    Yields:
+
+      object: An object for each file leaving the pipeline, in completion
+      order, with attributes ``src`` (the source path), ``dst`` (the
+      destination path), ``seq`` (the order in which the file was taken from
+      ``paths``) and ``error`` (the exception raised while processing the
+      file, or ``None``, if the file was imported).  Its method ``record()``
+      returns an :py:class:`ImportRecord` with further details.
+
+    """
+
+        abort = threading.Event()
+        self.abort = abort
+        lock = threading.Lock()
+        errors = []
+        remaining = dict(self.workers)
+        queues = [queue.Queue(self.depth) for k in range(len(self.STAGES) + 1)]
+        # jobs fed, but not planned yet: all that fits in queues and threads
+        # up to the ordered stage, so that holding jobs does not add to them
+        upstream = self.STAGES[: self.STAGES.index(self.ORDERED)]
+        window = threading.Semaphore(
+            self.depth * (len(upstream) + 1)
+            + sum([self.workers[k] for k in upstream])
+        )
+
+        threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(paths, deadline, queues[0], abort, errors, window),
+                name="popster-scan",
+            )
+        ]
+        for i, name in enumerate(self.STAGES):
+            for k in range(self.workers[name]):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(
+                            i,
+                            queues[i],
+                            queues[i + 1],
+                            abort,
+                            remaining,
+                            lock,
+                            window,
+                        ),
+                        name="popster-%s-%d" % (name, k),
+                    )
+                )
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            while True:
+                job = queues[-1].get()
+                if job is _STOP:
+                    break
+                yield job
+
+        finally:
+            # if the caller stops early, release all threads and reservations
+            abort.set()
+            for t in threads:
+                t.join()
+            for q in queues:
+                while not q.empty():
+                    job = q.get()
+                    # jobs that left the pipeline were already finalized
+                    if job is not _STOP and q is not queues[-1]:
+                        self._discard(job)
+
+        if errors:
+            raise errors[0]
+
+
+def _select_dir(entry, erase, dry, rules=None):
+    """Selects directories to traverse while scanning for files to import
+
+  Hidden directories are ignored.  Useless directories produced by cameras are
+  erased, if ``erase`` is set, or ignored otherwise.
+
+
+  Parameters:
+
+    entry (os.DirEntry): The directory entry to check
+
+    erase (bool): If set to ``True``, then erase useless directories
+
+    dry (bool): If set to ``True``, then it will not erase anything, just log.
+
+    rules (popster.rules.Rules): Rules deciding which directories are hidden
+      or useless.  If not set, use the default ones.
+
+
+  Returns:
+
+    bool: ``True`` if the directory should be traversed
+
+  """
+
+    verdict = (rules or DEFAULT_RULES).directory(entry.name)
+    if verdict == IGNORE:
+        logger.info("ignoring %s..." % entry.path)
+        return False
+    if verdict == ERASE:
+        if erase:
+            _rmtree(entry.path, dry)
+        else:
+            logger.info("ignoring %s..." % entry.path)
+        return False
+    return True
+
+
+def _select_file(entry, erase, dry, rules=None):
+    """Selects files to import while scanning a directory tree
+
+  Hidden files are ignored.  Useless files produced by cameras are erased, if
+  ``erase`` is set, or ignored otherwise.  Parameters are the same as for
+  :py:func:`_select_dir`.
+
+  """
+
+    verdict = (rules or DEFAULT_RULES).file(entry.name)
+    if verdict == IGNORE:
+        logger.info("ignoring %s..." % entry.path)
+        return False
+    if verdict == ERASE:
+        if erase:
+            _rmfile(entry.path, dry)
+        else:
+            logger.info("ignoring %s..." % entry.path)
+        return False
+    return True
+
+
+def _scan(base, dry, workers=1, rules=None):
+    """Scans a directory tree for files to import
+
+  Hidden directories and files are ignored. Useless directories and files
+  produced by cameras are erased.
+
+
+  Parameters:
+
+    base (str): The path leading to the base directory to scan
+
+    dry (bool): If set to ``True``, then it will not erase anything, just log.
+
+    workers (int): Number of directories to scan concurrently
+
+    rules (popster.rules.Rules): Rules deciding which directories and files
+      are hidden or useless.  If not set, use the default ones.
+
+
+  Yields:
+
+    str: The path of each file that should be considered for import
+
+  """
+
+    for entry in walk(
+        base,
+        select_dir=functools.partial(
+            _select_dir, erase=True, dry=dry, rules=rules
+        ),
+        select_file=functools.partial(
+            _select_file, erase=True, dry=dry, rules=rules
+        ),
+        workers=workers,
+    ):
+        yield entry.path
+
+
+def rcopy_iter(
+    base,
+    dst,
+    fmt,
+    timestamp,
+    nodate,
+    move,
+    dry,
+    workers=1,
+    rules=None,
+    ledger=None,
+):
+    """Recursively copies all files found under a given base directory
+
+  Files are sent through a :py:class:`Pipeline` as they are found, and a
+  record is yielded for each one of them, as soon as it is processed.  This
+  function emits a warning when a file that was found cannot be processed.
+  Only a bounded number of files is in-flight at any time, no matter how many
+  files are found.  If the caller stops iterating, processing stops.
+
+
+  Parameters:
+
+    base (str): The path leading to the base directory that is being monitored.
+      This value is provided so we don't accidentally erase it.
+
+    dst (str): A path leading to the base destination directory where to store
+      pictures. If the path does not exist, it will be created.
+
+    fmt (str): A string containing date formatters for a **folder** structure
+      that will be added to destination folder, prefixing the files copied. For
+      example: ``"%Y/%B/%d.%m.%Y"``. For information on date fields that be
+      used, please refer to :py:func:`time.strftime`.
+
+    timestamp (bool): If set, and if no creation time date is found on the
+      traditional object metadata, then organizes images using the filesystem
+      timestamp - first try the creation time if available, else the last
+      modification time.
+
+    nodate (str): A string with the name of a directory that will be used
+      verbatim in case a date cannot be retrieved from the source filename.
+      This setting is (naturally) affected by the ``timestamp`` parameter above
+      - if that is set (to ``True``), then dates will likely be attributed to
+        all files
+
+    move (bool): If set to ``True``, move instead of copying
+
+    dry (bool): If set to ``True``, then it will not copy anything, just log.
+
+    workers (int, dict): Number of threads for each stage of the import
+      pipeline.  See :py:class:`Pipeline`.  The number of directories to scan
+      concurrently may be set with the key ``scan``.
+
+    rules (popster.rules.Rules): Rules deciding which files are imported,
+      ignored or erased.  If not set, use the default ones.
+
+    ledger (popster.ledger.Ledger): If set, files recorded on this ledger are
+      skipped, and imported files are recorded on it
+
+
+  Yields:
+
+    ImportRecord: A record for each file found, in completion order.  Files
+    that were imported have their ``error`` attribute set to ``None``.
+    Otherwise, it is set to the class of the exception that stopped the
+    import (e.g. :py:class:`ExplicitIgnore`, for files that were explicitly
+    ignored).
+
+  """
+
+    pipeline = Pipeline(
+        dst,
+        fmt,
+        timestamp,
+        nodate,
+        move,
+        dry,
+        workers=workers,
+        rules=rules,
+        ledger=ledger,
+    )
+    scanners = workers
+    if isinstance(workers, dict):
+        scanners = workers.get("scan", 1)
+
+    action = "copy" if not move else "move"
+    for job in pipeline.run(_scan(base, dry, scanners, rules)):
+        if isinstance(job.error, ExplicitIgnore):
+            logger.debug(
+                "explicitly ignoring file during %s operation: %s",
+                job.error,
+                action,
+            )
+        elif isinstance(job.error, UnsupportedExtensionError):
+            logger.debug(
+                "ignoring file during %s operation - unsupported ext: %s",
+                job.error,
+                action,
+            )
+        elif job.error is not None:
+            logger.warn(
+                "could not %s %s to new destination: %s",
+                action,
+                job.src,
+                job.error,
+            )
+        yield job.record()
+
+
+def rcopy(
+    base,
+    dst,
+    fmt,
+    timestamp,
+    nodate,
+    move,
+    dry,
+    workers=1,
+    rules=None,
+    ledger=None,
+):
+    """Recursively copies all files found under a given base directory
+
+  This function recursively treats all files found in the source directory. It
+  emits a warning when a file was found cannot be processed.  See
+  :py:func:`rcopy_iter`, to process results as they are available.
+
+
+  Parameters:
+
+    base (str): The path leading to the base directory that is being monitored.
+      This value is provided so we don't accidentally erase it.
+
+    dst (str): A path leading to the base destination directory where to store
+      pictures. If the path does not exist, it will be created.
+
+    fmt (str): A string containing date formatters for a **folder** structure
+      that will be added to destination folder, prefixing the files copied. For
+      example: ``"%Y/%B/%d.%m.%Y"``. For information on date fields that be
+      used, please refer to :py:func:`time.strftime`.
+
+    timestamp (bool): If set, and if no creation time date is found on the
+      traditional object metadata, then organizes images using the filesystem
+      timestamp - first try the creation time if available, else the last
+      modification time.
+
+    nodate (str): A string with the name of a directory that will be used
+      verbatim in case a date cannot be retrieved from the source filename.
+      This setting is (naturally) affected by the ``timestamp`` parameter above
+      - if that is set (to ``True``), then dates will likely be attributed to
+        all files
+
+    move (bool): If set to ``True``, move instead of copying
+
+    dry (bool): If set to ``True``, then it will not copy anything, just log.
+
+    workers (int, dict): Number of threads for each stage of the import
+      pipeline.  See :py:class:`Pipeline`.  The number of directories to scan
+      concurrently may be set with the key ``scan``.
+
+    rules (popster.rules.Rules): Rules deciding which files are imported,
+      ignored or erased.  If not set, use the default ones.
+
+    ledger (popster.ledger.Ledger): If set, files recorded on this ledger are
+      skipped, and imported files are recorded on it
+
+
+  Returns:
+
+    list: A list of :py:class:`ImportRecord` objects, for all files
+    successfully copied to the destination directory.  Their ``dst``
+    attribute corresponds to the **new** file locations.
+
+    list: A list of :py:class:`ImportRecord` objects, for all files that
+    could **not** be copied to the destination directory.  A warning is
+    emitted for each of the files that could not be moved.
+
+  """
+
+    good, bad = [], []
+
+    for record in rcopy_iter(
+        base, dst, fmt, timestamp, nodate, move, dry, workers, rules, ledger
+    ):
+        if record.error is None:
+            good.append(record)
+        elif not issubclass(record.error, ExplicitIgnore):
+            bad.append(record)
+
+    return good, bad
+
+
+class Email(object):
+    """An object representing a message to be sent to maintainers
+
+
+  Parameters:
+
+    subject (str): The e-mail subject
+
+    body (str): The e-mail body
+
+    hostname (str): The value of hostname to use for e-mail headers.
+
+    sender (str): The e-mail sender. E.g.: ``John Doe <joe@example.com>``
+
+    to (list): The e-mail receiver(s). E.g.:
+      ``Alice Allison <alice@example.com>``
+
+    attachments (list): If set, a list of tuples ``(filename, data)``, with
+      the name and contents (bytes) of files to attach to the message
+
+  """
+
+    def __init__(self, subject, body, hostname, sender, to, attachments=None):
+
+        # get information from package and host, put on header
+        prefix = "[popster-%s@%s] " % (
+            pkg_resources.require("popster")[0].version,
+            hostname,
+        )
+
+        self.subject = prefix + subject
+        self.body = body
+        self.sender = sender
+        self.to = to
+
+        # mime message setup
+        if attachments:
+            self.msg = email.mime.multipart.MIMEMultipart()
+            self.msg.attach(email.mime.text.MIMEText(self.body))
+            for filename, data in attachments:
+                part = email.mime.application.MIMEApplication(data)
+                part.add_header(
+                    "Content-Disposition", "attachment", filename=filename
+                )
+                self.msg.attach(part)
+        else:
+            self.msg = email.mime.text.MIMEText(self.body)
+        self.msg["Subject"] = self.subject
+        self.msg["From"] = self.sender
+        self.msg["To"] = ", ".join(self.to)
+
+    def send(self, server, port, username, password):
+
+        server = smtplib.SMTP(server, port)
+        server.ehlo()
+        server.starttls()
+        server.login(username, password)
+        server.sendmail(self.sender, self.to, self.msg.as_bytes())
+        server.close()
+
+    def message(self):
+        """Returns a string representation of the message"""
+
+        return self.msg.as_string()
+
+
+class Handler(watchdog.events.PatternMatchingEventHandler):
+    """Handles file moving/copying
+
+
+  Parameters:
+
+    base (str): The path leading to the base directory that is being monitored.
+      This value is provided so we don't accidentally erase it.
+
+    dst (str): A path leading to the base destination directory where to store
+      pictures. If the path does not exist, it will be created.
+
+    fmt (str): A string containing date formatters for a **folder** structure
+      that will be added to destination folder, prefixing the files copied. For
+      example: ``"%Y/%B/%d.%m.%Y"``. For information on date fields that be
+      used, please refer to :py:func:`time.strftime`.
+
+    timestamp (bool): If set, and if no creation time date is found on the
+      traditional object metadata, then organizes images using the filesystem
+      timestamp - first try the creation time if available, else the last
+      modification time.
+
+    nodate (str): A string with the name of a directory that will be used
+      verbatim in case a date cannot be retrieved from the source filename.
+      This setting is (naturally) affected by the ``timestamp`` parameter above
+      - if that is set (to ``True``), then dates will always be attributed to
+        all files
+
+    move (bool): If set to ``True``, move instead of copying
+
+    dry (bool): If set to ``True``, then it will not copy anything, just log.
+
+    hostname (str): The value of hostname to use for e-mail headers.
+
+    sender (str): The e-mail sender. E.g.: ``John Doe <joe@example.com>``
+
+    to (list): The e-mail receiver(s). E.g.:
+      ``Alice Allison <alice@example.com>``
+
+    journal (popster.journal.Journal): If set, record each file transfer on
+      this journal, so that partial operations can be recovered after a crash.
+
+    workers (int): Number of threads to use for processing queued files
+
+    settle (float): Number of seconds a file's size and modification time
+      must remain unchanged for, before it is considered complete, and
+      therefore, queued for processing
+
+    wakeup (threading.Condition): If set, the condition to notify when files
+      may be ready for processing.  It may be shared by several handlers.
+
+    spool (str): If set, a directory where to spill results of large imports,
+      instead of the default temporary directory.  See
+      :py:class:`popster.results.Results`.
+
+    fingerprints (popster.fingerprints.Fingerprints): If set, directories that
+      did not change since they were last fingerprinted are skipped when
+      scanning for existing files.  This should only be used in copy mode.
+
+    order (str): How to order queued files for processing, see
+      :py:class:`popster.scheduler.Scheduler`
+
+    lanes (int): If set, the maximum number of files from the same device
+      that are copied at once
+
+    rules (popster.rules.Rules): Rules deciding which files are imported,
+      ignored or erased.  Events for other files are dropped as they arrive.
+      If not set, use the default ones.
+
+    ledger (popster.ledger.Ledger): If set, files recorded on this ledger are
+      not imported again, and imported files are recorded on it.  This should
+      only be used in copy mode.
+
+  """
+
+    BURST = 1000
+    """Minimum number of events in a burst of activity, for it to be verified
+    for lost events, see :py:meth:`verify`"""
+
+    MARGIN = 2.0
+    """Seconds subtracted from the start of a burst when verifying it, to
+    account for the resolution of modification times"""
+
+    def __init__(
+        self,
+        base,
+        dst,
+        fmt,
+        timestamp,
+        nodate,
+        move,
+        dry,
+        hostname,
+        sender,
+        to,
+        journal=None,
+        workers=1,
+        settle=1.0,
+        wakeup=None,
+        spool=None,
+        fingerprints=None,
+        order="size",
+        lanes=None,
+        rules=None,
+        ledger=None,
+    ):
+
+        self.rules = rules or DEFAULT_RULES
+        super(Handler, self).__init__(
+            patterns=self.rules.patterns(),
+            ignore_patterns=[],
+            ignore_directories=True,
+            case_sensitive=False,
+        )
+
+        self.base = base
+        self.dst = dst
+        self.fmt = fmt
+        self.timestamp = timestamp
+        self.nodate = nodate
+        self.move = move
+        self.dry = dry
+        self.hostname = hostname
+        self.sender = sender
+        self.to = to
+        self.journal = journal
+        self.workers = workers
+        self.fingerprints = fingerprints
+        self.ledger = ledger
+        self.scheduler = Scheduler(order, lanes)
+
+        from threading import RLock, Condition
+
+        self.queue_lock = RLock()
+        self.queue = set()
+        self.pending = StabilityTracker(settle)
+        self.wakeup = wakeup if wakeup is not None else Condition()
+        self.dirty = False
+        self.deadline = None
+        self.good = Results(dirname=spool)
+        self.bad = Results(dirname=spool)
+        self.last_activity = time.time()
+
+        # existing files are scanned with queue_existing(), see Sorter.start()
+        self.scanning = False
+        self.scanned = False
+        self.seen = set()
+
+        # directories with activity since the last known-good point, checked
+        # for files missed by notifications after large bursts, see verify()
+        self.burst_since = None
+        self.burst_dirs = set()
+        self.burst_events = 0
+        self.recent = set()
+
+        # source directories files were removed from, cleaned-up on reset()
+        self.touched = set()
+
+        # called with the import records of files processed, or forgotten
+        self.listeners = []
+        self.cleaner = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="popster-cleanup"
+        )
+
+    def queue_existing(self, stop=None):
+        """Tracks existing files, streaming them for processing as found
+
+    This method is meant to run on a separate thread, while file system events
+    are already being observed.  Files that were already notified by file
+    system events, or queued, or processed since the scan started, are
+    skipped.  If fingerprints are available, files in directories that did
+    not change since the last run are not tracked again.  If a ledger is
+    available, files it records are not tracked either.
+
+
+    Parameters:
+
+      stop (threading.Event): If set, stop scanning as soon as this event is
+        set
+
+    """
+
+        unchanged = None
+        if self.fingerprints is not None:
+            unchanged = self.fingerprints.unchanged
+
+        with self.queue_lock:
+            self.scanning = True
+            self.seen = set()
+
+        try:
+            for entry in walk(
+                self.base,
+                select_dir=functools.partial(
+                    _select_dir, erase=False, dry=self.dry, rules=self.rules
+                ),
+                select_file=functools.partial(
+                    _select_file, erase=False, dry=self.dry, rules=self.rules
+                ),
+                workers=self.workers,
+                unchanged=unchanged,
+            ):
+
+                if stop is not None and stop.is_set():
+                    logger.info("Stopped scanning %s", self.base)
+                    return
+
+                try:
+                    info = entry.stat()
+                except OSError:  # gone
+                    self._handled(entry.path)
                     continue
+                if self.ledger is not None and self.ledger.contains(info)[0]:
+                    self._handled(entry.path)
+                    continue
+
+                # files that are queued or tracked are handled once processed
+                with self.queue_lock:
+                    if entry.path in self.queue or entry.path in self.seen:
+                        continue
+                    if not self.pending.discover(entry.path, info):
+                        continue
+                logger.debug("tracking file %s..." % entry.path)
+                self.last_activity = time.time()
+                self.notify()
+
+        finally:
+            with self.queue_lock:
+                self.scanning = False
+                self.seen = set()
+
+        self.scanned = True
+        logger.info("Finished scanning %s", self.base)
+
+    def _handled(self, path, ok=True):
+        """Records a file reached a final state, see
+    :py:meth:`popster.fingerprints.Fingerprints.handled`"""
+
+        if self.fingerprints is not None:
+            self.fingerprints.handled(path, ok)
+
+    def notify(self):
+        """Wakes up whoever is waiting for files to process"""
+
+        with self.wakeup:
+            self.dirty = True
+            self.wakeup.notify_all()
+
+    def wait(self, timeout=None):
+        """Waits until there may be new files to process
+
+
+    Parameters:
+
+      timeout (float): Maximum number of seconds to wait for.  If ``None``,
+        wait until :py:meth:`notify` is called.
+
+
+    Returns:
+
+      bool: ``True`` if :py:meth:`notify` was called since the last call to
+      this method, ``False`` if the timeout expired.
+
+    """
+
+        with self.wakeup:
+            retval = self.wakeup.wait_for(lambda: self.dirty, timeout)
+            self.dirty = False
+        return retval
+
+    def promote(self):
+        """Queues files that are complete, so they can be processed
+
+
+    Returns:
+
+      int: The number of files that were queued
+
+    """
 
-                with self.queue_lock:
-                    self.queue.add(os.path.join(path, f))
-                logger.debug("queuing file %s..." % os.path.join(path, f))
-                self.last_activity = time.time()
+        with self.queue_lock:
+            ready = self.pending.pop_ready()
+            self.queue.update(ready)
+        if ready:
+            logger.debug("%d file(s) are complete and were queued", len(ready))
+        return len(ready)
+
+    def dispatch(self, event):
+        """Dispatches events for files accepted by the rules
+
+    This replaces matching by patterns, which is done with
+    :py:meth:`pathlib.PurePath.match` for every pattern.  For moves, the event
+    is dispatched if either the source or the destination is accepted.
+
+
+    Parameters:
+
+      event (watchdog.events.FileSystemEvent): Event corresponding to the
+        event that occurred with a specific file or directory being observed
+
+    """
+
+        if event.is_directory:
+            return
+        paths = [os.fsdecode(event.src_path)]
+        if getattr(event, "dest_path", None):
+            paths.append(os.fsdecode(event.dest_path))
+        if any([self.rules.accepts(k) for k in paths]):
+            watchdog.events.FileSystemEventHandler.dispatch(self, event)
 
     def on_created(self, event):
         """Called when a file or directory is created
@@ -891,9 +2013,9 @@ class Handler(watchdog.events.PatternMatchingEventHandler):
         super(Handler, self).on_created(event)
         what = "directory" if event.is_directory else "file"
         logger.debug("[watchdog] created %s: %s", what, event.src_path)
-        with self.queue_lock:
-            self.queue.add(event.src_path)
-        self.last_activity = time.time()
+        if self.pending.touch(event.src_path):
+            self.notify()
+        self._active(event.src_path)
 
     def on_moved(self, event):
         super(Handler, self).on_moved(event)
@@ -904,147 +2026,515 @@ class Handler(watchdog.events.PatternMatchingEventHandler):
             event.src_path,
             event.dest_path,
         )
+        # e.g. a temporary file renamed into its final name after written
+        self._forget(event.src_path)
+        if event.dest_path.startswith(self.base):
+            if self.pending.touch(event.dest_path):
+                self.notify()
+            self._active(event.dest_path)
+        self.last_activity = time.time()
 
     def on_deleted(self, event):
         super(Handler, self).on_deleted(event)
         what = "directory" if event.is_directory else "file"
         logger.debug("[watchdog] deleted %s: %s", what, event.src_path)
-        with self.queue_lock:
-            try:
-                self.queue.remove(event.src_path)
-            except KeyError:
-                pass
+        self._forget(event.src_path)
         self.last_activity = time.time()
 
     def on_modified(self, event):
         super(Handler, self).on_modified(event)
         what = "directory" if event.is_directory else "file"
         logger.debug("[watchdog] modified %s: %s", what, event.src_path)
+        # n.b.: modifications only postpone the import of known files
+        if self.pending.touch(event.src_path):
+            self.notify()
+        self._active(event.src_path)
+
+    def on_closed(self, event):
+        """Called when a file opened for writing is closed
+
+    This notification is not available on all platforms.  Where it is, files
+    are queued as soon as they are closed.
+
+    """
+
+        super(Handler, self).on_closed(event)
+        logger.debug("[watchdog] closed file: %s", event.src_path)
+        self.pending.close(event.src_path)
+        self.notify()
+        self._active(event.src_path)
+
+    def _active(self, path):
+        """Registers activity on a file, possibly starting a burst"""
+
         with self.queue_lock:
-            self.queue.add(event.src_path)
+            if self.burst_since is None:
+                self.burst_since = time.time()
+            self.burst_dirs.add(os.path.dirname(path))
+            self.burst_events += 1
         self.last_activity = time.time()
 
-    def reset(self):
-        """Reset accumulated good/bad lists, removes empty directories"""
-
-        for path, dirs, files in os.walk(self.base, topdown=False):
-            for d in dirs:
-                dirpath = os.path.join(path, d)
-                contents = [
-                    k
-                    for k in os.listdir(dirpath)
-                    if not (
-                        _ignore_dir(k)
-                        or _ignore_file(dirpath, k)
-                        or _erase_dir(k)
-                        or _erase_file(k)
-                    )
+    def verify(self, now=None, rescan=True):
+        """Checks for files missed by notifications, once a burst is over
+
+    Under heavy bursts of activity, the kernel notification queue may
+    overflow, and events are lost without notice.  Once activity ceases for
+    ``settle`` seconds after a burst of at least :py:attr:`BURST` events,
+    sub-trees where activity was seen are scanned for files that were not
+    notified.  Only directories modified since the burst started are listed,
+    and files that are already pending, queued or were processed since are
+    skipped.
+
+
+    Parameters:
+
+      now (float): The current time, as returned by :py:func:`time.time`
+
+      rescan (bool): If ``False``, bursts are ended without verification
+        (e.g. as events come from polling, that does not lose them)
+
+
+    Returns:
+
+      float: The number of seconds after which this method should be called
+      again, or ``None``, if there is no burst to verify
+
+    """
+
+        now = time.time() if now is None else now
+
+        with self.queue_lock:
+            if self.burst_since is None:
+                return None
+            idle = now - self.last_activity
+            if idle < self.pending.settle:
+                return self.pending.settle - idle
+            since, dirs, events = (
+                self.burst_since,
+                self.burst_dirs,
+                self.burst_events,
+            )
+            recent = self.recent
+            self.burst_since = None
+            self.burst_dirs = set()
+            self.burst_events = 0
+            self.recent = set()
+
+        if rescan and events >= self.BURST:
+            # directories created during the burst may have been missed
+            # entirely - starts from their parents
+            roots = set([os.path.dirname(k) for k in dirs])
+            self.rescan(roots, since - self.MARGIN, recent)
+
+        return None
+
+    def rescan(self, roots, since, skip=()):
+        """Tracks files under ``roots``, in directories modified ``since``
+
+
+    Parameters:
+
+      roots (iterable): Paths of directories to scan.  Directories outside the
+        base directory are ignored.
+
+      since (float): Only files in directories modified at, or after this
+        time, are considered
+
+      skip (set): Paths of files to skip (e.g. as they were processed)
+
+
+    Returns:
+
+      int: The number of files found
+
+    """
+
+        base = os.path.join(self.base, "")
+        roots = set(
+            [
+                k
+                for k in roots
+                if os.path.join(k, "").startswith(base) and os.path.isdir(k)
+            ]
+        )
+        # removes roots that are under other roots
+        roots = [
+            k
+            for k in sorted(roots)
+            if not any(
+                [
+                    k.startswith(os.path.join(j, ""))
+                    for j in roots
+                    if j != k
                 ]
-                if not contents:
-                    _rmtree(dirpath, self.dry)
-            for f in files:
-                if _erase_file(f):
-                    filepath = os.path.join(path, f)
-                    _rmfile(filepath, self.dry)
-
-        self.good = []
-        self.bad = []
-        self.queue = set()
+            )
+        ]
+
+        found = 0
+        for root in roots:
+
+            try:
+                changed = {root: os.stat(root).st_mtime >= since}
+            except OSError:  # gone
+                continue
+
+            for entry in walk(
+                root,
+                select_dir=functools.partial(
+                    _select_dir, erase=False, dry=self.dry, rules=self.rules
+                ),
+                select_file=functools.partial(
+                    _select_file, erase=False, dry=self.dry, rules=self.rules
+                ),
+                workers=self.workers,
+                directories=True,
+            ):
+
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        changed[entry.path] = entry.stat().st_mtime >= since
+                        continue
+                    if not changed.get(os.path.dirname(entry.path)):
+                        continue
+                    if entry.path in skip:
+                        continue
+                    with self.queue_lock:
+                        if entry.path in self.queue:
+                            continue
+                        if not self.pending.discover(entry.path, entry.stat()):
+                            continue
+                except OSError:  # gone
+                    continue
+                found += 1
+
+        if found:
+            logger.warning(
+                "Found %d file(s) missed by notifications under %s",
+                found,
+                ", ".join(roots),
+            )
+            self.notify()
+
+        return found
+
+    def _forget(self, path):
+        """Stops tracking a file that is gone"""
+
+        self.pending.discard(path)
+        with self.queue_lock:
+            queued = path in self.queue
+            self.queue.discard(path)
+            self.touched.add(os.path.dirname(path))
+        if queued:
+            self._publish([ImportRecord(path, error=FileNotFoundError)])
+
+    def _publish(self, records):
+        """Passes import records to all listeners"""
+
+        for listener in self.listeners:
+            try:
+                listener(records)
+            except Exception as e:
+                logger.exception("Listener failed: %s", e)
+
+    def submit(self, paths):
+        """Queues files for processing right away
+
+    Files are assumed to be complete, and are no longer tracked for
+    stability.
+
+
+    Parameters:
+
+      paths (iterable): Paths of files or directories to process.  Directories
+        are scanned recursively, with the handler's rules.
+
+
+    Returns:
+
+      list: The paths of files that were queued
+
+    """
+
+        select = dict(erase=False, dry=self.dry, rules=self.rules)
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                found = walk(
+                    path,
+                    select_dir=functools.partial(_select_dir, **select),
+                    select_file=functools.partial(_select_file, **select),
+                    workers=self.workers,
+                )
+                files += [k.path for k in found]
+            elif os.path.exists(path):
+                files.append(path)
+            else:
+                logger.warning("cannot submit %s: no such file", path)
+
+        for path in files:
+            self.pending.discard(path)
+        with self.queue_lock:
+            self.queue.update(files)
+        self.last_activity = time.time()
+        if files:
+            self.notify()
+        return files
+
+    def reset(self):
+        """Reset accumulated good/bad lists, removes empty directories
+
+    Only source directories files were removed from since the last reset (and
+    their ancestors) are checked for emptiness.  That is done on a separate
+    thread, so that processing of new files is not delayed.  Queued files are
+    kept, as they may have been submitted since the digest was prepared.
+
+
+    Returns:
+
+      concurrent.futures.Future: A future that completes when empty
+      directories were removed.  Its result is the list of directories
+      removed.
+
+    """
+
+        with self.queue_lock:
+            touched = self.touched
+            self.touched = set()
+            self.good.clear()
+            self.bad.clear()
         self.last_activity = time.time()
 
+        if self.journal is not None:
+            self.journal.checkpoint()
+
+        return self.cleaner.submit(
+            _remove_empty, self.base, touched, self.dry, self.rules
+        )
+
     def needs_clearing(self):
         """Returns ``True`` if this handler has accumulated outputs"""
 
         return bool(self.queue or self.good or self.bad)
 
-    def process_queue(self):
-        """Process queued events"""
+    def process_queue(self, deadline=None, limit=None):
+        """Process queued events
+
+    Files are sent through a :py:class:`Pipeline` with ``workers`` threads for
+    its I/O-bound stages, in the order decided by the handler's
+    :py:class:`popster.scheduler.Scheduler`.  Results are accumulated in that
+    order, so that outputs do not depend on the number of workers.
+
+
+    Parameters:
+
+      deadline (float): If set, a time (as returned by :py:func:`time.time`)
+        after which no new files are processed.  Files that were not processed
+        by then are put back in the queue.  If not set, use the value of the
+        ``deadline`` attribute, which may be set while files are processed.
+
+      limit (int): If set, process at most this number of files, leaving
+        the others in the queue
+
+
+    Returns:
+
+      list: A list of :py:class:`ImportRecord` objects, for files that were
+      processed, in order.  Files put back in the queue are not included.
+
+    """
 
         if not self.queue:
-            return
+            return []
 
         logger.debug("Processing queue with %d elements", len(self.queue))
 
+        # files are ordered (and stat'ed) without holding the lock
+        with self.queue_lock:
+            queued = list(self.queue)
+        planned = self.scheduler.plan(queued, limit)
+
         with self.queue_lock:
-            # we copy the queue locally, we relesae the lock and reset the queue
-            local_queue = list(self.queue)
-            self.queue = set()
+            # files may have been removed in the meanwhile
+            local_queue = [k for k in planned if k in self.queue]
+            self.queue.difference_update(local_queue)
+            if self.scanning:
+                self.seen.update(local_queue)
+            if self.burst_since is not None and not self.move:
+                # files that remain on the source, should not be re-found
+                self.recent.update(local_queue)
 
         # process local queue copy - deletions are no longer possible
-        for path in local_queue:
-            try:
-                self.good.append(
-                    copy(
-                        path,
-                        self.dst,
-                        self.fmt,
-                        self.timestamp,
-                        self.nodate,
-                        self.move,
-                        self.dry,
-                    )
-                )
-            except ExplicitIgnore as e:
-                action = "copy" if not self.move else "move"
+        pipeline = Pipeline(
+            self.dst,
+            self.fmt,
+            self.timestamp,
+            self.nodate,
+            self.move,
+            self.dry,
+            self.journal,
+            self.workers,
+            scheduler=self.scheduler,
+            rules=self.rules,
+            ledger=self.ledger,
+        )
+        results = sorted(
+            pipeline.run(
+                local_queue,
+                lambda: deadline if deadline is not None else self.deadline,
+            ),
+            key=lambda k: k.seq,
+        )
+
+        deferred = []
+        records = []
+        action = "copy" if not self.move else "move"
+        with self.queue_lock:
+            self.touched.update(
+                [
+                    os.path.dirname(k.src)
+                    for k in results
+                    if not isinstance(k.error, DeadlineReached)
+                ]
+            )
+        for job in results:
+            if isinstance(job.error, DeadlineReached):
+                deferred.append(job.src)
+                continue
+            records.append(job.record())
+            self._handled(
+                job.src,
+                job.error is None
+                or isinstance(
+                    job.error, (ExplicitIgnore, UnsupportedExtensionError)
+                ),
+            )
+            if job.error is None:
+                # duplicates are not new to the destination, not reported
+                if not job.duplicate:
+                    self.good.append(job.dst, records[-1])
+            elif isinstance(job.error, ExplicitIgnore):
                 logger.debug(
                     "explicitly ignoring file during %s operation: %s",
-                    e,
+                    job.error,
                     action,
                 )
-            except UnsupportedExtensionError as e:
-                action = "copy" if not self.move else "move"
+            elif isinstance(job.error, UnsupportedExtensionError):
                 logger.debug(
                     "ignoring file during %s operation - unsupported ext: %s",
-                    e,
+                    job.error,
                     action,
                 )
-            except Exception as e:
-                action = "copy" if not self.move else "move"
+            else:
                 logger.warn(
-                    "could not %s %s to new destination: %s", action, path, e
+                    "could not %s %s to new destination: %s",
+                    action,
+                    job.src,
+                    job.error,
                 )
-                self.bad.append(path)
+                self.bad.append(job.src, records[-1])
+
+        if deferred:
+            logger.warning(
+                "Deadline reached with %d file(s) left to process",
+                len(deferred),
+            )
+            with self.queue_lock:
+                self.queue.update(deferred)
+
+        if records:
+            self._publish(records)
+        return records
 
     def write_email(self):
-        """Composes e-mail about accumulated outputs"""
+        """Composes e-mail about accumulated outputs
 
-        # compose e-mail
-        if not self.good:
-            subject = "%(bad_len)d files may need manual intervention"
-        else:
-            subject = "Organized %(good_len)d files for you"
-
-        body = (
-            "Hello,\n"
-            "\n"
-            "This is an automated message that summarizes actions I performed "
-            'at folder\n"%(base)s" for you.\n'
-            "\n"
+    Files are listed on the message body if they are few.  Otherwise, they
+    are summarized by folder, and the full lists are attached to the message
+    as compressed CSV tables.  See :py:class:`popster.digest.Digest`.
+
+    """
+
+        digest = Digest(self.base, self.dst, self.good, self.bad)
+        return Email(
+            digest.subject(),
+            digest.body(),
+            self.hostname,
+            self.sender,
+            self.to,
+            digest.attachments(),
         )
 
-        if self.good:
-            body += "List of files correctly moved (%(good_len)d):\n\n"
-            body += "\n".join(self.good) + "\n\n"
-        else:
-            body += "No files moved\n\n"
 
-        if self.bad:
-            body += "List of files that could NOT be moved (%(bad_len)d):\n\n"
-            body += "\n".join(self.bad) + "\n\n"
-        else:
-            body += "No problems found!\n\n"
+class DigestPolicy(object):
+    """Decides when digest e-mails are sent
 
-        body += "That is it, have a good day!\n\nYour faithul robot\n"
+  A digest is sent once no file system activity was registered for ``quiet``
+  seconds.  This period adapts to the observed activity: it starts at
+  ``idleness`` and doubles (up to ``maximum``) every time activity resumes
+  shortly after a digest was sent (e.g. a card reader pausing in-between
+  bursts of files), so that a single import does not produce a string of
+  e-mails.  It goes back to ``idleness`` when activity resumes after a long
+  idle period.
+
+
+  Parameters:
+
+    idleness (float): Minimum number of seconds without activity, before a
+      digest is sent
+
+    maximum (float): Maximum number of seconds without activity, before a
+      digest is sent.  If not set, use 10 times ``idleness``.
+
+  """
+
+    def __init__(self, idleness, maximum=None):
+
+        self.idleness = idleness
+        self.maximum = maximum if maximum is not None else 10 * idleness
+        self.quiet = idleness
+        self.last_digest = None
+        self._resumed = False
+
+    def due(self, last_activity, now):
+        """Returns the number of seconds until the next digest is due
+
+
+    Parameters:
+
+      last_activity (float): The time of the last file system activity
+
+      now (float): The current time
 
-        completions = dict(
-            base=self.base, good_len=len(self.good), bad_len=len(self.bad),
-        )
 
-        body = body % completions
-        subject = subject % completions
+    Returns:
 
-        email = Email(subject, body, self.hostname, self.sender, self.to)
-        return email
+      float: The number of seconds until the next digest should be sent.  If
+      this number is zero or negative, then the digest is due.
+
+    """
+
+        if (
+            self.last_digest is not None
+            and not self._resumed
+            and last_activity > self.last_digest
+        ):
+            # first activity after the last digest - adapts quiet period
+            self._resumed = True
+            gap = last_activity - self.last_digest
+            if gap < self.quiet:
+                self.quiet = min(2 * self.quiet, self.maximum)
+            elif gap > self.maximum:
+                self.quiet = self.idleness
+            logger.debug("Digest quiet period set to %d seconds", self.quiet)
+
+        return last_activity + self.quiet - now
+
+    def sent(self, now):
+        """Registers a digest was sent"""
+
+        self.last_digest = now
+        self._resumed = False
 
 
 class Sorter(object):
@@ -1080,6 +2570,9 @@ class Sorter(object):
     dry (bool): If set to ``True``, then it will not copy anything, just log.
 
     email (bool): If set to ``True``, then e-mail admins about results.
+      E-mails are delivered on a separate thread, so that imports never wait
+      on the SMTP server, see :py:class:`popster.mailer.Mailer`.  If ``state``
+      is set, undelivered e-mails are kept in it across restarts.
 
     hostname (str): The value of hostname to use for e-mail headers.
 
@@ -1097,7 +2590,71 @@ class Sorter(object):
 
     password (str): Password for the user above on the SMTP server
 
-    idleness (int): Time after which, we should report
+    idleness (int): Time after which, we should report.  This time adapts to
+      the observed activity, see :py:class:`DigestPolicy`.
+
+    state (str): If set, path leading to a directory where to keep state that
+      persists across restarts (e.g. the import journal).  The directory is
+      created if it does not exist.
+
+    workers (int): Number of threads to use for processing queued files
+
+    settle (float): Number of seconds a file's size and modification time
+      must remain unchanged for, before it is considered complete, and
+      therefore, imported
+
+    max_idleness (int): Maximum time after which, we should report.  If not
+      set, use 10 times ``idleness``.
+
+    poll (float): If set, poll the base directory for changes every this
+      number of seconds, instead of relying on file system notifications
+      (e.g. for network mounts).  See :py:mod:`popster.poller`.
+
+    max_poll (float): Maximum number of seconds between polls, when no
+      changes are found.  If not set, use 10 times ``poll``.
+
+    routes (list): If set, a list of dictionaries describing additional
+      folders to watch, each with its own destination.  Each dictionary may
+      contain the keys ``base``, ``dst``, ``fmt``, ``timestamp``, ``nodate``
+      and ``move``, with the same meaning as the parameters above (``base``
+      and ``dst`` are mandatory).  Missing keys are set from the parameters
+      above.  All routes share the same observer, workers and state
+      directory, and a separate digest is sent for each of them.
+
+    batch (int): Maximum number of files to process from a route, before
+      processing files from the next one.  This ensures a busy route does not
+      starve the others.
+
+    max_watches (int): If set, watch at most this number of directories per
+      route with file system notifications, and poll the others (every
+      ``poll`` seconds, or 10 seconds, if that is not set).  Use this for
+      source trees too large to be watched otherwise.  See
+      :py:mod:`popster.hybrid`.
+
+    full_scan (float): For routes in copy mode, and if ``state`` is set,
+      fingerprints of directories in source folders are kept across restarts,
+      and directories that did not change are skipped when scanning for
+      existing files.  A full scan is forced if the last one is older than
+      this number of seconds.  If set to ``0``, always do a full scan.  See
+      :py:mod:`popster.fingerprints`.
+
+    order (str): How to order files waiting to be imported: ``size`` (smaller
+      files first), ``inode`` (favouring sequential reads) or ``arrival``.
+      Files on different devices take turns.  See
+      :py:mod:`popster.scheduler`.
+
+    lanes (int): If set, the maximum number of files from the same device
+      that are copied at once
+
+    rules (popster.rules.Rules): Rules deciding which files are imported,
+      ignored or erased, on all routes.  If not set, use the default ones.
+
+    content_hash (bool): For routes in copy mode, and if ``state`` is set, a
+      ledger of imported files is kept, so that they are never imported
+      again.  Files are identified by device, inode, size and modification
+      time.  If this is set, they are also identified by a hash of their
+      contents, e.g. to recognize files on a memory card that is mounted as a
+      different device.  See :py:mod:`popster.ledger`.
 
   """
 
@@ -1119,68 +2676,399 @@ class Sorter(object):
         username,
         password,
         idleness,
+        state=None,
+        workers=1,
+        settle=1.0,
+        max_idleness=None,
+        poll=None,
+        max_poll=None,
+        routes=None,
+        batch=64,
+        max_watches=None,
+        full_scan=7 * 24 * 60 * 60,
+        order="size",
+        lanes=None,
+        rules=None,
+        content_hash=False,
     ):
 
-        self.observer = watchdog.observers.Observer()
-        self.handler = Handler(
-            base, dst, fmt, timestamp, nodate, move, dry, hostname, sender, to
+        journal = None
+        requeue = []
+        self.fingerprints = None
+        self.ledger = None
+        if state is not None:
+            if not os.path.exists(state):
+                os.makedirs(state)
+            path = os.path.join(state, "journal")
+            requeue = recover(path, dry)
+            journal = Journal(path)
+            # existing files are not scanned when polling, see start()
+            copying = [not k.get("move", move) for k in [{}] + (routes or [])]
+            if any(copying) and not (dry or poll or max_watches):
+                self.fingerprints = Fingerprints(
+                    os.path.join(state, "fingerprints"), full_scan
+                )
+            if any(copying) and not dry:
+                self.ledger = Ledger(
+                    os.path.join(state, "ledger.sqlite"), content_hash
+                )
+
+        rules = rules or DEFAULT_RULES
+        select = dict(
+            select_dir=lambda k: rules.directory(k.name) == ACCEPT,
+            select_file=lambda k: rules.file(k.name) not in (IGNORE, ERASE),
         )
+        if max_watches:
+            poll = poll or 10.0
+            self.observer = HybridObserver(
+                poll, max_watches, max_poll, **select
+            )
+        elif poll:
+            self.observer = PollingObserver(poll, max_poll, **select)
+        else:
+            self.observer = watchdog.observers.Observer()
+        self.poll = poll
+
+        defaults = dict(
+            base=base,
+            dst=dst,
+            fmt=fmt,
+            timestamp=timestamp,
+            nodate=nodate,
+            move=move,
+        )
+        routes = [defaults] + [dict(defaults, **k) for k in (routes or [])]
+
+        # handlers share a condition, so a single thread serves all of them
+        self.wakeup = threading.Condition()
+        self.handlers = [
+            Handler(
+                k["base"],
+                k["dst"],
+                k["fmt"],
+                k["timestamp"],
+                k["nodate"],
+                k["move"],
+                dry,
+                hostname,
+                sender,
+                to,
+                journal,
+                workers,
+                settle,
+                self.wakeup,
+                state,
+                None if k["move"] else self.fingerprints,
+                order,
+                lanes,
+                rules,
+                None if k["move"] else self.ledger,
+            )
+            for k in routes
+        ]
+        self.handler = self.handlers[0]
+        self.journal = journal
+
+        # files left unprocessed may have still been written to at shutdown:
+        # they are only imported once stable
+        for k in requeue:
+            handler = self._route(k)
+            if handler is None:
+                logger.warning("[journal] %s is not on any route", k)
+                continue
+            handler.pending.discover(k)
+
         self.email = email
         self.server = server
         self.port = port
         self.username = username
         self.password = password
+        self.mailer = None
+        if email:
+            self.mailer = Mailer(
+                server,
+                port,
+                username,
+                password,
+                None if state is None else os.path.join(state, "outbox"),
+            )
         self.idleness = idleness
+        self.digests = [
+            DigestPolicy(idleness, max_idleness) for k in self.handlers
+        ]
+        self.batch = batch
+        self.thread = None
+        self.scanners = []
+        self.stopping = threading.Event()
+
+    def _route(self, path):
+        """Returns the handler watching ``path``, or ``None``"""
+
+        candidates = [
+            k
+            for k in self.handlers
+            if path.startswith(os.path.join(k.base, ""))
+        ]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda k: len(k.base))
+
+    def submit(self, paths):
+        """Queues files for import right away, on the route they belong to
 
-    def check_point(self):
-        """Checks if needs to send e-mail, and if so, do it"""
 
-        idleness = time.time() - self.handler.last_activity
-        logger.debug("Check-point (idle for %d seconds)", idleness)
+    Parameters:
+
+      paths (iterable): Paths of files or directories to import.  Directories
+        are scanned recursively.  All paths must be under the source folder of
+        a route (or be that folder), once symbolic links are resolved.
+
+
+    Returns:
+
+      list: The (absolute) paths of files that were queued
+
+
+    Raises:
+
+      ValueError: If a path is not under the source folder of any route.
+      Nothing is queued in that case.
+
+    """
+
+        routed = []
+        for path in paths:
+            path = os.path.abspath(path)
+            # with a trailing separator, the source folder itself is routed
+            handler = self._route(os.path.join(path, ""))
+            if handler is None or not os.path.join(
+                os.path.realpath(path), ""
+            ).startswith(os.path.join(os.path.realpath(handler.base), "")):
+                raise ValueError("%s is not under a source folder" % path)
+            routed.append((handler, path))
+
+        files = []
+        for handler, path in routed:
+            files += handler.submit([path])
+        return files
+
+    def _digest(self, handler, digest, now):
+        """Sends the digest of a route, if due
+
+
+    Returns:
+
+      float: The number of seconds after which the digest may be due, or
+      ``None``, if there is nothing to report
+
+    """
+
+        if handler.queue or not handler.needs_clearing():
+            # nothing to report (yet)
+            return None
 
         # if there seems to be activity on the handler (this means file system
-        # events are still happening), then wait more
-        should_check = idleness > self.idleness
-        if not should_check:
-            return
-        self.handler.last_activity = time.time()
+        # events are still happening), then wait more before reporting
+        due = digest.due(handler.last_activity, now)
+        if due > 0:
+            return due
 
         logger.debug(
-            "Running full check (idle for %d > %d seconds)",
-            idleness,
-            self.idleness,
+            "Sending digest for %s (idle for %d >= %d seconds)",
+            handler.base,
+            now - handler.last_activity,
+            digest.quiet,
         )
 
-        # if there is nothing to report, skip
-        if not self.handler.needs_clearing():
-            logger.debug("Queues are empty, nothing to report...")
-            return
+        self.report(handler)
+        handler.reset()
+        digest.sent(now)
+
+        return None
+
+    def check_point(self):
+        """Imports complete files, checks if needs to send e-mail and do it
+
+    Files are imported in batches, taking turns between routes, until all
+    queues are empty.
+
+
+    Returns:
+
+      float: The number of seconds after which this method should be called
+      again, or ``None``, if it only needs to be called when new files are
+      available.
+
+    """
+
+        while True:
+
+            # files are imported as soon as they are complete
+            for handler in self.handlers:
+                handler.promote()
+                handler.process_queue(limit=self.batch)
 
-        self.handler.process_queue()
-        email = self.handler.write_email()
+            now = time.time()
+            timeouts = [
+                self._digest(handler, digest, now)
+                for handler, digest in zip(self.handlers, self.digests)
+            ]
+
+            if self.stopping.is_set():
+                break
+            if not any([k.queue for k in self.handlers]):
+                break
+
+        logger.debug("Check-point done")
+
+        # polling observers do not lose events
+        timeouts += [k.verify(rescan=not self.poll) for k in self.handlers]
+        timeouts += [k.pending.next_check() for k in self.handlers]
+        timeouts = [k for k in timeouts if k is not None]
+        return min(timeouts) if timeouts else None
+
+    def wait(self, timeout=None):
+        """Waits until there may be new files to process on any route
+
+    Returns:
+
+      bool: ``True`` if new files may be available, ``False`` if the timeout
+      expired.
+
+    """
+
+        with self.wakeup:
+            retval = self.wakeup.wait_for(
+                lambda: any([k.dirty for k in self.handlers]), timeout
+            )
+            for k in self.handlers:
+                k.dirty = False
+        return retval
+
+    def _run(self):
+        """Processes files as they become complete, until stopped"""
+
+        timeout = None
+        while not self.stopping.is_set():
+            self.wait(timeout)
+            if self.stopping.is_set():
+                break
+            try:
+                timeout = self.check_point()
+            except Exception as e:
+                logger.exception("Check-point failed: %s", e)
+                timeout = self.idleness
+
+    def report(self, handler=None):
+        """Composes the e-mail about accumulated outputs and sends it
+
+    Parameters:
+
+      handler (Handler): The handler of the route to report about.  If not
+        set, report about the first route.
+
+    """
+
+        email = (handler or self.handler).write_email()
 
         if self.email:
             logger.debug(email.message())
-            email.send(self.server, self.port, self.username, self.password)
+            self.mailer.send(email)
         else:
             logger.info(email.message())
 
-        self.handler.reset()
-
     def start(self):
         """Runs the watchdog loop"""
 
-        self.observer.schedule(self.handler, self.handler.base, recursive=True)
+        if self.mailer is not None:
+            self.mailer.start()
+        for handler in self.handlers:
+            self.observer.schedule(handler, handler.base, recursive=True)
         self.observer.start()
+        self.thread = threading.Thread(target=self._run, name="popster-sorter")
+        self.thread.daemon = True
+        self.thread.start()
+        self.handler.notify()
+
+        if self.poll:
+            # the first poll reports existing files
+            return
+
+        # existing files are streamed for processing while observing
+        for i, handler in enumerate(self.handlers):
+            scanner = threading.Thread(
+                target=handler.queue_existing,
+                args=(self.stopping,),
+                name="popster-scanner-%d" % i,
+            )
+            scanner.daemon = True
+            scanner.start()
+            self.scanners.append(scanner)
 
     def stop(self):
         """Stops the sorter"""
 
         self.observer.stop()
+        self.stopping.set()
+        self.handler.notify()
 
-    def join(self):
-        """Joins the sorting thread"""
+    def join(self, timeout=None):
+        """Joins the sorting thread, draining files that are still queued
+
+
+    Parameters:
+
+      timeout (float): Maximum number of seconds to spend processing files
+        that are still queued.  If not set, then process all of them.  Files
+        left unprocessed are persisted on the journal, if one is available, so
+        they are picked-up on the next start.
+
+    """
+
+        deadline = None if timeout is None else time.time() + timeout
+        for handler in self.handlers:
+            handler.deadline = deadline
 
         self.observer.join()
-        self.check_point()
-        self.handler.reset()
+        for scanner in self.scanners:
+            scanner.join()
+        if self.thread is not None:
+            self.thread.join()
+        for handler in self.handlers:
+            handler.promote()
+        if any([len(k.pending) for k in self.handlers]):
+            # gives files still being written to, a last chance to complete
+            time.sleep(self.handler.pending.settle)
+            for handler in self.handlers:
+                handler.promote()
+
+        while any([k.queue for k in self.handlers]):
+            for handler in self.handlers:
+                handler.process_queue(deadline, limit=self.batch)
+            if deadline is not None and time.time() > deadline:
+                break
+
+        remaining = []
+        for handler in self.handlers:
+            remaining += sorted(handler.queue) + sorted(handler.pending)
+            if handler.needs_clearing():
+                self.report(handler)
+            handler.reset().result()
+            handler.cleaner.shutdown()
+
+        if self.journal is not None:
+            if remaining:
+                self.journal.persist_queue(remaining)
+            self.journal.close()
+
+        # only saved once files left unprocessed are safely persisted
+        if self.fingerprints is not None:
+            self.fingerprints.save(all([k.scanned for k in self.handlers]))
+        if self.ledger is not None:
+            self.ledger.close()
+
+        # e-mails that cannot be delivered in time are kept for the next start
+        if self.mailer is not None:
+            self.mailer.close(
+                None if deadline is None else max(deadline - time.time(), 1.0)
+            )
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Per-file stability detection, for files still being written to"""
+
+import os
+import time
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StabilityTracker(object):
+    """Tracks files that are being written to, tells when they are complete
+
+  A file is considered complete as soon as a close-after-write notification is
+  received for it (where the platform supports those), or when its size and
+  modification time are unchanged across two samples taken at least
+  ``settle`` seconds apart.  Repeated notifications for the same file are
+  coalesced.
+
+
+  Parameters:
+
+    settle (float): Minimum number of seconds between two samples of a file's
+      size and modification time, for it to be considered complete
+
+  """
+
+    def __init__(self, settle):
+
+        self.settle = settle
+        self.lock = threading.Lock()
+        self._files = {}  # path -> (size, mtime_ns, sampled at, closed)
+
+    @staticmethod
+    def _sample(path):
+        """Returns the size and modification time of a file or ``None``"""
+
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return info.st_size, info.st_mtime_ns
+
+    def touch(self, path):
+        """Registers ``path`` was created or modified
+
+
+    Returns:
+
+      bool: ``True`` if ``path`` was not being tracked before
+
+    """
+
+        sample = self._sample(path)
+        if sample is None:
+            return False
+        with self.lock:
+            entry = self._files.get(path)
+            if entry is not None and entry[3] and entry[:2] == sample:
+                # e.g. permissions changed after the file was closed
+                return False
+            self._files[path] = sample + (time.time(), False)
+        return entry is None
+
+    def discover(self, path, info=None):
+        """Registers an existing file, found while scanning a directory
+
+    Files that were not modified for at least ``settle`` seconds are
+    considered complete right away.  Files that are already being tracked
+    are left untouched.
+
+
+    Parameters:
+
+      path (str): The path leading to the file
+
+      info (os.stat_result): If available, the result of :py:func:`os.stat`
+        on ``path``, to avoid a second call
+
+
+    Returns:
+
+      bool: ``True`` if ``path`` was not being tracked before
+
+    """
+
+        if info is None:
+            try:
+                info = os.stat(path)
+            except OSError:
+                return False
+        now = time.time()
+        closed = (now - info.st_mtime) >= self.settle
+        with self.lock:
+            if path in self._files:
+                return False
+            self._files[path] = (info.st_size, info.st_mtime_ns, now, closed)
+        return True
+
+    def close(self, path):
+        """Registers ``path`` was closed after being written to"""
+
+        sample = self._sample(path) or (None, None)
+        with self.lock:
+            self._files[path] = sample + (time.time(), True)
+
+    def next_check(self):
+        """Returns the number of seconds until a file may become complete
+
+
+    Returns:
+
+      float: The number of seconds until :py:meth:`pop_ready` may return
+      something, or ``None``, if no files are being tracked.
+
+    """
+
+        with self.lock:
+            entries = list(self._files.values())
+
+        if not entries:
+            return None
+
+        now = time.time()
+        wait = [
+            0.0 if closed else (sampled_at + self.settle - now)
+            for size, mtime, sampled_at, closed in entries
+        ]
+        return max(0.0, min(wait))
+
+    def discard(self, path):
+        """Stops tracking ``path`` (e.g. because it was removed)"""
+
+        with self.lock:
+            self._files.pop(path, None)
+
+    def pop_ready(self):
+        """Returns files that are complete, stops tracking them
+
+    Files that are not complete yet are re-sampled, if they changed.
+
+
+    Returns:
+
+      list: A list of paths for files that are complete
+
+    """
+
+        now = time.time()
+        ready = []
+        resampled = []
+
+        with self.lock:
+            items = list(self._files.items())
+
+        for path, entry in items:
+            size, mtime, sampled_at, closed = entry
+            if closed:
+                ready.append((path, entry))
+                continue
+            sample = self._sample(path)
+            if sample is None:  # gone
+                ready.append((path, entry))
+            elif sample != (size, mtime):
+                resampled.append((path, entry, sample + (now, False)))
+            elif (now - sampled_at) >= self.settle:
+                ready.append((path, entry))
+
+        # only update entries that were not touched in the meanwhile
+        popped = []
+        with self.lock:
+            for path, entry, new_entry in resampled:
+                if self._files.get(path) == entry:
+                    self._files[path] = new_entry
+            for path, entry in ready:
+                if self._files.get(path) == entry:
+                    del self._files[path]
+                    popped.append(path)
+
+        return [k for k in popped if os.path.exists(k)]
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self._files))
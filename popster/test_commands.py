@@ -4,13 +4,21 @@
 """Test units"""
 
 import os
+import sys
 import stat
 import time
+import gzip
 import shutil
+import json
+import csv
+import socket
+import socketserver
+import threading
 import datetime
 import pkg_resources
 
 import pytest
+import watchdog.events
 
 # date used for testing purposes
 DUMMY_DATE = datetime.datetime(2002, 1, 26, 11, 49, 44)
@@ -22,13 +30,37 @@ from .sorter import (
     read_creation_date,
     copy,
     rcopy,
+    rcopy_iter,
     make_dirs,
     DateReadoutError,
     Sorter,
+    Handler,
+    Pipeline,
+    DigestPolicy,
     UnsupportedExtensionError,
+    AlreadyImported,
+    Email,
+    _RESERVED,
 )
 
 from .dedup import check_duplicates, recommend_action
+from .journal import Journal, recover
+from .stability import StabilityTracker
+from .walker import walk
+from .poller import Snapshot
+from .results import Results
+from .digest import Digest
+from .fingerprints import Fingerprints
+from .scheduler import Scheduler
+from .rules import Rules, ACCEPT, IGNORE, ERASE, UNSUPPORTED
+from .records import ImportRecord
+from .api import Server, submit
+from .ledger import Ledger, BloomFilter
+from .mailer import Mailer
+from .importer import main as import_main
+from .plan import read_plan, SourceChanged
+from .check_date import main as check_date_main
+from .audit import probe_all
 
 
 def data_path(f=None):
@@ -365,12 +397,83 @@ def test_copy_same():
             move=False,
             dry=False,
         )
-        assert os.path.exists(result2)
-        assert result1 != result2
-        assert result2.endswith("~.jpg")
+        # same contents: nothing is written, the source is left in place
+        assert result2.dst == result1.dst
+        assert result2.action == "skip" and result2.duplicate
+        assert os.listdir(os.path.dirname(result1.dst)) == [
+            os.path.basename(result1.dst)
+        ]
+        assert os.path.exists(src)
+
+        # same name, different contents: copied under a new name
+        with open(src, "ab") as f:
+            f.write(b"\0")
+        result3 = copy(
+            src,
+            dst,
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+        )
+        assert os.path.exists(result3)
+        assert result1 != result3
+        assert result3.dst.endswith("~.jpg")
+        assert result3.action == "copy"
+
+        # a duplicate of the renamed copy is found too, and removed if moving
+        result4 = copy(
+            src,
+            dst,
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+        )
+        assert result4.dst == result3.dst
+        assert result4.action == "unlink"
+        assert not os.path.exists(src)
         assert os.path.exists(subfolder)
 
 
+def test_import_record():
+
+    # Tests import records carry details about each import, and are compact
+
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as dst:
+        record = copy(
+            src,
+            dst,
+            "%Y/%B/%d.%m.%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+        )
+        assert isinstance(record, ImportRecord)
+        assert record.ok and record.error is None
+        assert record.src == src
+        assert os.path.exists(record) and os.fspath(record) == record.dst
+        assert record.size == os.path.getsize(src)
+        assert record.date == datetime.datetime(2003, 12, 14, 12, 1, 44)
+        assert record.reader == "exif"
+        assert len(record.timings) == 4 and record.elapsed >= 0
+
+    failed = ImportRecord(src, error=UnsupportedExtensionError)
+    assert not failed.ok and failed.dst is None
+    assert os.fspath(failed) == src
+    assert "UnsupportedExtensionError" in repr(failed)
+
+    # directories are shared between records, which have no __dict__
+    other = ImportRecord(data_path("img_with_xmp.png"))
+    assert other._srcdir is failed._srcdir
+    assert not hasattr(other, "__dict__")
+
+
 def test_copy_nodate():
 
     # Tests if can organize at least the sample photo
@@ -494,11 +597,11 @@ def test_move_many():
             dry=False,
         )
         bad_full = [os.path.join(base, k) for k in bad_src]
-        assert sorted(bad_full) == sorted(bad)
+        assert sorted(bad_full) == sorted([k.src for k in bad])
         for k in bad_full:
             assert os.path.exists(k), "%r does not exist" % k
         good_full = [os.path.join(dst, k) for k in good_dst]
-        assert sorted(good_full) == sorted(good)
+        assert sorted(good_full) == sorted([k.dst for k in good])
         for k in good_full:
             assert os.path.exists(k), "%r does not exist" % k
         old_good_full = [os.path.join(base, k) for k in good_src]
@@ -558,7 +661,7 @@ def test_move_all():
         assert len(bad) == 0
 
         good_full = [os.path.join(dst, k) for k in good_dst]
-        assert sorted(good_full) == sorted(good)
+        assert sorted(good_full) == sorted([k.dst for k in good])
         for k in good_full:
             assert os.path.exists(k), "%r does not exist" % k
         old_good_full = [os.path.join(base, k) for k in good_src]
@@ -570,6 +673,70 @@ def test_move_all():
         assert os.path.exists(base), "%r does not exist" % base
 
 
+def test_move_same_workers():
+
+    # Tests identical files with the same name, moved concurrently, land once
+    # at the destination: the others are removed as duplicates
+
+    src = data_path("img_with_exif.jpg")
+
+    for workers in (1, 4):
+        with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+            for k in range(20):
+                os.makedirs(os.path.join(base, "%02d" % k))
+                shutil.copy2(src, os.path.join(base, "%02d" % k, "x.jpg"))
+
+            good, bad = rcopy(
+                base,
+                dst,
+                "%Y",
+                timestamp=False,
+                nodate="nodate",
+                move=True,
+                dry=False,
+                workers=workers,
+            )
+
+            assert not bad
+            assert sorted([k.action for k in good]) == ["move"] + 19 * [
+                "unlink"
+            ]
+            assert set([k.dst for k in good]) == set(
+                [os.path.join(dst, "2003", "x.jpg")]
+            )
+            assert os.listdir(os.path.join(dst, "2003")) == ["x.jpg"]
+            assert not [k for _, _, f in os.walk(base) for k in f]
+
+
+def test_copy_stale_reservation(monkeypatch):
+
+    # Tests a destination name reserved, but never released, only delays
+    # imports of files with the same name for a bounded time
+
+    monkeypatch.setattr("popster.sorter.RESERVED_WAIT", 0.5)
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as dst:
+        stale = os.path.join(dst, "2003", "img_with_exif.jpg")
+        _RESERVED[stale] = threading.Event()
+        try:
+            start = time.time()
+            record = copy(
+                src,
+                dst,
+                "%Y",
+                timestamp=False,
+                nodate="nodate",
+                move=False,
+                dry=False,
+            )
+            assert time.time() - start < 5
+            assert record.action == "copy"
+            assert record.dst == os.path.join(dst, "2003", "img_with_exif~.jpg")
+        finally:
+            _RESERVED.pop(stale, None)
+
+
 def test_watch():
 
     # Tests if we can move a whole ensemble of files and that the source
@@ -789,6 +956,1181 @@ def test_start_with_files():
         assert os.path.exists(base), "%r does not exist" % base
 
 
+def test_poll():
+
+    # Tests the polling observer imports existing and new files
+
+    data = data_path()
+    fmt = "%Y/%B/%d.%m.%Y"
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        shutil.copy(data_path("img_with_exif.jpg"), base)
+
+        sorter = Sorter(
+            base,
+            dst,
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            email=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            server="smtp.gmail.com",
+            port=587,
+            username="dummy@gmail.com",
+            password="there-you-go",
+            idleness=1,
+            settle=0.2,
+            poll=0.1,
+        )
+        sorter.start()
+
+        src = os.path.join(base, os.path.basename(data))
+        os.makedirs(src)
+        shutil.copy(data_path("img_with_xmp.png"), src)
+
+        time.sleep(1)
+        sorter.stop()
+        sorter.join()
+
+        good_dst = [
+            os.path.join("2003", "december", "14.12.2003", "img_with_exif.jpg"),
+            os.path.join("2017", "august", "29.08.2017", "img_with_xmp.png"),
+        ]
+        for k in good_dst:
+            assert os.path.exists(os.path.join(dst, k)), "%r missing" % k
+        assert not os.path.exists(src), "%r still exists" % src
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="requires inotify"
+)
+def test_hybrid():
+
+    # Tests the hybrid observer imports files from watched and polled folders,
+    # using only a few watches
+
+    fmt = "%Y/%B/%d.%m.%Y"
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        folders = [
+            os.path.join(base, "a%d" % k, "b%d" % j)
+            for k in range(3)
+            for j in range(3)
+        ]
+        for k in folders:
+            os.makedirs(k)
+        os.makedirs(os.path.join(base, "MISC"))  # erased by rules, unwatched
+
+        sorter = Sorter(
+            base,
+            dst,
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            email=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            server="smtp.gmail.com",
+            port=587,
+            username="dummy@gmail.com",
+            password="there-you-go",
+            idleness=1,
+            settle=0.2,
+            poll=0.2,
+            max_watches=3,
+        )
+        sorter.start()
+        time.sleep(0.2)
+        emitter = list(sorter.observer.emitters)[0]
+        assert emitter.pinned == set([base, os.path.join(base, "a0")])
+
+        shutil.copy(data_path("img_with_exif.jpg"), folders[0])  # watched
+        shutil.copy(data_path("img_with_xmp.png"), folders[-1])  # polled
+
+        time.sleep(1.5)
+        emitter = list(sorter.observer.emitters)[0]
+        assert len(emitter.inotify) <= 3
+        sorter.stop()
+        sorter.join()
+
+        good_dst = [
+            os.path.join("2003", "december", "14.12.2003", "img_with_exif.jpg"),
+            os.path.join("2017", "august", "29.08.2017", "img_with_xmp.png"),
+        ]
+        for k in good_dst:
+            assert os.path.exists(os.path.join(dst, k)), "%r missing" % k
+
+
+def test_snapshot():
+
+    # Tests snapshots report changes, and skip unchanged directories
+
+    with TemporaryDirectory() as base:
+
+        sub = os.path.join(base, "sub")
+        os.makedirs(os.path.join(sub, ".hidden"))
+        for k in ("a.jpg", "b.jpg"):
+            with open(os.path.join(sub, k), "wb") as f:
+                f.write(b"0")
+
+        snapshot = Snapshot(base, lambda k: not k.name.startswith("."))
+        events = list(snapshot.refresh())
+        assert sorted([(k.event_type, k.src_path) for k in events]) == [
+            ("created", sub),
+            ("created", os.path.join(sub, "a.jpg")),
+            ("created", os.path.join(sub, "b.jpg")),
+        ]
+        assert len(snapshot) == 2
+
+        # recently modified directories are listed again
+        with open(os.path.join(sub, "a.jpg"), "ab") as f:
+            f.write(b"1")
+        os.unlink(os.path.join(sub, "b.jpg"))
+        events = list(snapshot.refresh())
+        assert sorted([(k.event_type, k.src_path) for k in events]) == [
+            ("deleted", os.path.join(sub, "b.jpg")),
+            ("modified", os.path.join(sub, "a.jpg")),
+        ]
+
+        # directories that did not change are not listed again
+        _time = time.mktime(DUMMY_DATE.timetuple())
+        for k in (base, sub):
+            os.utime(k, (_time, _time))
+        assert list(snapshot.refresh()) == []  # re-lists, as marked racy
+        with open(os.path.join(sub, "a.jpg"), "ab") as f:
+            f.write(b"2")
+        assert list(snapshot.refresh()) == []
+
+        shutil.rmtree(sub)
+        events = list(snapshot.refresh())
+        assert sorted([(k.event_type, k.src_path) for k in events]) == [
+            ("deleted", sub),
+            ("deleted", os.path.join(sub, "a.jpg")),
+        ]
+        assert len(snapshot) == 0
+
+
+def test_routes():
+
+    # Tests a single sorter imports files from several folders, each into its
+    # own destination, taking turns between them
+
+    fmt = "%Y/%B/%d.%m.%Y"
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        sources = [os.path.join(base, k) for k in ("sdcard", "usb")]
+        dests = [os.path.join(dst, k) for k in ("sdcard", "usb")]
+        for k in sources + dests:
+            os.makedirs(k)
+
+        sorter = Sorter(
+            sources[0],
+            dests[0],
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            email=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            server="smtp.gmail.com",
+            port=587,
+            username="dummy@gmail.com",
+            password="there-you-go",
+            idleness=1,
+            settle=0.2,
+            routes=[dict(base=sources[1], dst=dests[1], move=False)],
+            batch=1,
+        )
+        assert len(sorter.handlers) == 2
+        assert sorter._route(os.path.join(sources[1], "a.jpg")) is (
+            sorter.handlers[1]
+        )
+        assert sorter._route(os.path.join(base, "a.jpg")) is None
+        sorter.start()
+
+        for k in sources:
+            shutil.copy(data_path("img_with_exif.jpg"), k)
+            shutil.copy(data_path("img_with_xmp.png"), k)
+
+        time.sleep(1)
+        sorter.stop()
+        sorter.join()
+
+        for k in dests:
+            for j in (
+                os.path.join("2003", "december", "14.12.2003"),
+                os.path.join("2017", "august", "29.08.2017"),
+            ):
+                assert len(os.listdir(os.path.join(k, j))) == 1
+
+        # first route moves, second copies
+        assert not os.listdir(sources[0])
+        assert len(os.listdir(sources[1])) == 2
+
+
+def test_api():
+
+    # Tests files can be submitted to a running sorter, with progress streamed
+    # back until they are processed, and that only files in source folders
+    # are accepted
+
+    fmt = "%Y/%B/%d.%m.%Y"
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst, (
+        TemporaryDirectory()
+    ) as outside:
+
+        sorter = Sorter(
+            base,
+            dst,
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            email=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            server="smtp.gmail.com",
+            port=587,
+            username="dummy@gmail.com",
+            password="there-you-go",
+            idleness=60,
+        )
+        path = os.path.join(outside, "popster.sock")
+        api = Server(path, sorter)
+        api.start()
+
+        # uploaded before the sorter starts, so they are only found by the
+        # request
+        uploads = os.path.join(base, "uploads")
+        folder = os.path.join(uploads, "album")
+        os.makedirs(folder)
+        shutil.copy(data_path("img_with_xmp.png"), folder)
+        shutil.copy(data_path("unsupported.txt"), folder)
+        single = shutil.copy(data_path("img_with_exif.jpg"), uploads)
+
+        # files outside source folders are refused, and left in place
+        stray = shutil.copy(data_path("img_without_exif.jpg"), outside)
+        escape = os.path.join(base, os.pardir, os.path.basename(outside))
+        link = os.path.join(base, "link.jpg")
+        os.symlink(stray, link)
+        for k in ([stray], [single, escape], [link]):
+            with pytest.raises(RuntimeError, match="not under a source"):
+                list(submit(path, k, timeout=10))
+        assert os.path.exists(stray) and os.path.exists(single)
+        os.unlink(link)
+
+        replies = submit(path, [single, folder], timeout=10)
+        assert next(replies) == dict(job=1, files=3)
+        sorter.start()
+        replies = list(replies)
+        status = dict([(k["src"], k["status"]) for k in replies[:-1]])
+        assert status == {
+            single: "imported",
+            os.path.join(folder, "img_with_xmp.png"): "imported",
+            os.path.join(folder, "unsupported.txt"): "ignored",
+        }
+        assert replies[-1] == dict(
+            job=1, done=True, imported=2, ignored=1, failed=0
+        )
+        imported = os.path.join("2003", "december", "14.12.2003")
+        assert os.listdir(os.path.join(dst, imported)) == ["img_with_exif.jpg"]
+
+        # without waiting, and with invalid requests
+        replies = list(submit(path, [folder], wait=False, timeout=10))
+        assert replies == [dict(job=2, files=1)]
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(b'{"paths": [1, 2]}\n')
+            assert b"invalid request" in sock.makefile("rb").readline()
+
+        api.stop()
+        assert not os.path.exists(path)
+        sorter.stop()
+        sorter.join()
+        api.close()
+
+
+def test_process_queue_workers():
+
+    # Tests processing the queue with multiple workers yields the same results
+    # as doing it serially, even if destination names collide: identical
+    # files are imported once, and different ones get the same names
+
+    src = data_path("img_with_exif.jpg")
+    fmt = "%Y/%B/%d.%m.%Y"
+
+    for different in (False, True):
+        results = []
+        for workers in (1, 4):
+            with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+                for k in range(8):
+                    subfolder = os.path.join(base, "subfolder%d" % k)
+                    os.mkdir(subfolder)
+                    shutil.copy2(src, subfolder)
+                    if different:
+                        copied = os.path.join(subfolder, os.path.basename(src))
+                        with open(copied, "ab") as f:
+                            f.write(b"\0" * k)
+                shutil.copy2(data_path("unsupported.txt"), base)
+                shutil.copy2(data_path("img_without_exif.jpg"), base)
+
+                handler = Handler(
+                    base,
+                    dst,
+                    fmt,
+                    timestamp=False,
+                    nodate="nodate",
+                    move=False,
+                    dry=False,
+                    hostname="docker",
+                    sender="joe@example.com",
+                    to=["alice@example.com"],
+                    workers=workers,
+                    settle=0,
+                )
+                handler.queue_existing()
+                handler.promote()
+                handler.process_queue()
+                for k in handler.good:
+                    assert os.path.exists(k), "%r does not exist" % k
+                assert len(set(handler.good)) == (9 if different else 2)
+                assert not handler.bad
+                copies = [
+                    os.path.join(dirname, k)
+                    for dirname, _, files in os.walk(dst)
+                    for k in files
+                    if k.startswith("img_with_exif")
+                ]
+                assert len(copies) == (8 if different else 1)
+                results.append(
+                    sorted(
+                        (os.path.relpath(k, dst), os.path.getsize(k))
+                        for k in copies
+                    )
+                )
+
+        assert results[0] == results[1]
+
+
+def test_pipeline_backpressure():
+
+    # Tests the pipeline does not consume more input than it can hold, and that
+    # it can be stopped early
+
+    consumed = []
+
+    def _infinite(base):
+        k = 0
+        while True:
+            consumed.append(k)
+            yield os.path.join(base, "file%d.txt" % k)
+            k += 1
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+        pipeline = Pipeline(
+            dst,
+            "%Y/%B/%d.%m.%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+            workers=2,
+            depth=4,
+        )
+        results = pipeline.run(_infinite(base))
+        for k in range(10):
+            job = next(results)
+            assert isinstance(job.error, UnsupportedExtensionError)
+        time.sleep(0.5)  # would fill memory, if it was not bounded
+        results.close()
+        # queues, plus one job per thread in-between two queues
+        assert len(consumed) <= 10 + 5 * 4 + 7
+
+
+def test_pipeline_close_releases():
+
+    # Tests destination names reserved by files in flight are released when
+    # the caller stops early
+
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+        for k in range(400):
+            shutil.copy2(src, os.path.join(base, "%d.jpg" % k))
+
+        records = rcopy_iter(
+            base,
+            dst,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+            workers=4,
+        )
+        for record in records:
+            assert record.ok
+            break
+        records.close()
+        assert not _RESERVED
+
+
+def test_scheduler():
+
+    # Tests files are ordered by size class, with aging, and that copies from
+    # the same device are bounded
+
+    with TemporaryDirectory() as base:
+
+        sizes = dict(big=32 << 20, medium=2 << 20, small1=10, small2=20)
+        paths = {}
+        for name, size in sizes.items():
+            paths[name] = os.path.join(base, name + ".mp4")
+            with open(paths[name], "wb") as f:
+                f.truncate(size)
+        gone = os.path.join(base, "gone.jpg")
+
+        now = time.time()
+        scheduler = Scheduler("size", lanes=1, aging=60.0)
+        planned = scheduler.plan(list(paths.values()) + [gone], 3, now=now)
+        assert len(planned) == 3
+        assert planned[0] == gone  # on its own lane, fails right away
+        assert set(planned[1:]) == set([paths["small1"], paths["small2"]])
+
+        # the big file is promoted after waiting, and passes the medium one
+        left = [paths["medium"], paths["big"]]
+        assert scheduler.plan(left, now=now + 130) == left[::-1]
+
+        scheduler = Scheduler("arrival")
+        order = [paths[k] for k in ("big", "small1", "medium")]
+        assert scheduler.plan(order[:1], limit=0) == []
+        assert scheduler.plan(order[1:2], limit=0) == []
+        assert scheduler.plan(order[::-1]) == order
+
+        with pytest.raises(ValueError):
+            Scheduler("random")
+
+        # a single copy at once, for files on the same device
+        scheduler = Scheduler("inode", lanes=1)
+        planned = scheduler.plan(list(paths.values()))
+        assert len(planned) == 4
+        lane = scheduler.lane(planned[0])
+        assert lane is scheduler.lane(planned[1])
+        with lane:
+            assert not lane.acquire(blocking=False)
+        assert lane.acquire(blocking=False)
+        lane.release()
+
+
+def test_stability():
+
+    # Tests files are only considered complete once they stop changing, or
+    # as soon as they are closed
+
+    with TemporaryDirectory() as base:
+
+        growing = os.path.join(base, "growing.jpg")
+        closed = os.path.join(base, "closed.jpg")
+        for k in (growing, closed):
+            with open(k, "wb") as f:
+                f.write(b"0" * 1024)
+
+        tracker = StabilityTracker(settle=0.2)
+        tracker.touch(growing)
+        tracker.touch(growing)  # coalesced
+        tracker.touch(closed)
+        tracker.close(closed)
+        assert len(tracker) == 2
+
+        assert tracker.pop_ready() == [closed]
+        assert tracker.pop_ready() == []  # not settled yet
+
+        time.sleep(0.3)
+        with open(growing, "ab") as f:
+            f.write(b"1" * 1024)
+        assert tracker.pop_ready() == []  # changed since last sample
+
+        time.sleep(0.3)
+        assert tracker.pop_ready() == [growing]
+        assert len(tracker) == 0
+
+        # files found while scanning, that are old enough, are complete
+        _time = time.mktime(DUMMY_DATE.timetuple())
+        os.utime(closed, (_time, _time))
+        tracker.touch(growing)
+        assert not tracker.discover(growing)  # already tracked
+        assert tracker.discover(closed)
+        assert tracker.pop_ready() == [closed]
+
+
+def test_scan_dedup():
+
+    # Tests files found by both the startup scan and file system events, or
+    # imported while the scan is running, are only imported once
+
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        for k in ("a", "b"):
+            os.mkdir(os.path.join(base, k))
+        observed = os.path.join(base, "a", "observed.jpg")
+        processed = os.path.join(base, "b", "processed.jpg")
+        for k in (observed, processed):
+            shutil.copy2(src, k)
+
+        handler = Handler(
+            base,
+            dst,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            settle=0,
+        )
+        records = []
+        handler.listeners.append(records.extend)
+
+        # notified by the observer before the scan reaches it
+        handler.dispatch(watchdog.events.FileClosedEvent(observed))
+        handler.dispatch(watchdog.events.FileClosedEvent(processed))
+
+        class _ProcessWhileScanning(object):
+            """Imports queued files as soon as the scan starts"""
+
+            def unchanged(self, path, files, dirs):
+                if path == base:
+                    handler.promote()
+                    handler.process_queue()
+                return False
+
+            def handled(self, path, ok=True):
+                pass
+
+        handler.fingerprints = _ProcessWhileScanning()
+        handler.queue_existing()
+
+        # copies remain on the source, but are not tracked again
+        assert os.path.exists(observed) and os.path.exists(processed)
+        assert not handler.pending and not handler.queue
+        handler.promote()
+        assert handler.process_queue() == []
+        assert sorted(k.src for k in records) == sorted([observed, processed])
+        assert all(k.action == "copy" for k in records)
+        assert not handler.bad
+
+
+def test_scan_while_observing():
+
+    # Tests files appearing while the startup scan runs are imported, and
+    # each file only once
+
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        existing = []
+        for k in range(50):
+            path = os.path.join(base, "folder%d" % (k % 5), "%d.jpg" % k)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copy2(src, path)
+            with open(path, "ab") as f:
+                f.write(b"\0" * k)
+            existing.append(path)
+
+        sorter = Sorter(
+            base,
+            dst,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+            email=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            server="smtp.gmail.com",
+            port=587,
+            username="dummy@gmail.com",
+            password="there-you-go",
+            idleness=1,
+            settle=0.2,
+        )
+        records = []
+        sorter.handler.listeners.append(records.extend)
+        sorter.start()
+
+        # created while the existing files are being scanned
+        fresh = os.path.join(base, "folder0", "fresh.jpg")
+        shutil.copy2(src, fresh)
+        with open(fresh, "ab") as f:
+            f.write(b"\1")
+
+        time.sleep(1)
+        sorter.stop()
+        sorter.join()
+
+        imported = sorted(k.src for k in records)
+        assert imported == sorted(existing + [fresh])
+        assert all(k.action == "copy" for k in records)
+        copies = [k for _, _, files in os.walk(dst) for k in files]
+        assert len(copies) == len(existing) + 1
+        assert not [k for k in copies if "~" in k]
+
+
+def test_digest_policy():
+
+    # Tests the digest quiet period adapts to bursts of activity
+
+    policy = DigestPolicy(idleness=30, maximum=120)
+    assert policy.due(last_activity=100, now=110) == 20
+    assert policy.due(last_activity=100, now=140) < 0
+    policy.sent(140)
+
+    # activity resumes shortly after the digest: burst, wait longer
+    assert policy.due(last_activity=150, now=150) == 60
+    policy.sent(220)
+    assert policy.due(last_activity=230, now=230) == 120
+    policy.sent(400)
+    assert policy.quiet == 120  # capped
+
+    # activity resumes after a long idle period: back to normal
+    assert policy.due(last_activity=1000, now=1000) == 30
+
+
+def test_journal_recovery():
+
+    # Tests partial operations recorded on the journal are finished or rolled
+    # back on start-up
+
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        # a partial copy (intent only): destination must be rolled back
+        partial_src = os.path.join(base, "partial.jpg")
+        shutil.copy2(src, partial_src)
+        partial_dst = os.path.join(dst, "partial.jpg")
+        with open(partial_dst, "wb") as f:
+            f.write(b"truncated")
+
+        # a move that did not complete: source must be removed
+        moved_src = os.path.join(base, "moved.jpg")
+        shutil.copy2(src, moved_src)
+        moved_dst = os.path.join(dst, "moved.jpg")
+        shutil.copy2(src, moved_dst)
+
+        # a file that was queued, but never processed
+        queued_src = os.path.join(base, "queued.jpg")
+        shutil.copy2(src, queued_src)
+
+        # copies whose sources are gone: only complete destinations are kept
+        size = os.path.getsize(src)
+        gone_src = [os.path.join(base, "gone%d.jpg" % k) for k in range(2)]
+        gone_dst = [os.path.join(dst, "gone%d.jpg" % k) for k in range(2)]
+        shutil.copy2(src, gone_dst[0])
+        with open(gone_dst[1], "wb") as f:
+            f.write(b"truncated")
+
+        path = os.path.join(base, "journal")
+        journal = Journal(path, sync=False)
+        journal.intent(partial_src, partial_dst, move=True)
+        journal.intent(moved_src, moved_dst, move=True)
+        for k, j in zip(gone_src, gone_dst):
+            journal.intent(k, j, move=False, size=size)
+        journal.copied(moved_src)
+        journal.persist_queue([queued_src])
+        assert not journal.checkpoint()  # operations in flight
+        journal.close()
+
+        requeue = recover(path, dry=False)
+        assert sorted(requeue) == sorted([partial_src, queued_src])
+        assert not os.path.exists(partial_dst)
+        assert os.path.exists(partial_src)
+        assert not os.path.exists(moved_src)
+        assert os.path.exists(moved_dst)
+        assert os.path.getsize(gone_dst[0]) == size
+        assert not os.path.exists(gone_dst[1])
+        assert os.path.getsize(path) == 0
+
+        # a journaled copy leaves nothing to recover
+        journal = Journal(path, sync=False)
+        result = copy(
+            queued_src,
+            dst,
+            "%Y/%B/%d.%m.%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            journal=journal,
+        )
+        assert os.path.exists(result)
+        assert journal.checkpoint()
+        journal.close()
+        assert recover(path, dry=False) == []
+
+
+def test_journal_requeue_stable():
+
+    # Tests files left queued at shutdown are tracked for stability after a
+    # restart, as they may have still been written to
+
+    src = data_path("img_with_exif.jpg")
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        old, fresh = [os.path.join(base, k) for k in ("old.jpg", "fresh.jpg")]
+        for k in (old, fresh):
+            shutil.copy(src, k)
+        os.utime(old, (time.time() - 3600, time.time() - 3600))
+
+        state = os.path.join(dst, "state")
+        os.makedirs(state)
+        journal = Journal(os.path.join(state, "journal"), sync=False)
+        journal.persist_queue([old, fresh])
+        journal.close()
+
+        sorter = Sorter(
+            base,
+            dst,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            email=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            server="smtp.gmail.com",
+            port=587,
+            username="dummy@gmail.com",
+            password="there-you-go",
+            idleness=1,
+            state=state,
+            settle=60,
+        )
+        try:
+            handler = sorter.handler
+            assert not handler.queue
+            assert sorted(handler.pending) == sorted([fresh, old])
+            handler.promote()
+            assert handler.queue == set([old])
+        finally:
+            sorter.journal.close()
+            handler.cleaner.shutdown()
+
+
+def test_walk():
+
+    # Tests the walker prunes directories and finds the same files, in the
+    # same order, no matter the number of workers
+
+    with TemporaryDirectory() as base:
+
+        expected = set()
+        for k in ("a", "b", os.path.join("b", "c"), ".hidden"):
+            os.makedirs(os.path.join(base, k), exist_ok=True)
+            for j in range(3):
+                path = os.path.join(base, k, "%d.jpg" % j)
+                open(path, "wb").close()
+                if not k.startswith("."):
+                    expected.add(path)
+
+        def _select_dir(entry):
+            return not entry.name.startswith(".")
+
+        order = []
+        for workers in (1, 4):
+            found = [k.path for k in walk(base, _select_dir, workers=workers)]
+            assert len(found) == len(expected)
+            assert set(found) == expected
+            order.append(found)
+        assert order[0] == order[1]
+
+        dirs = [
+            k.path
+            for k in walk(base, _select_dir, directories=True)
+            if k.is_dir()
+        ]
+        assert sorted(dirs) == sorted(
+            [os.path.join(base, k) for k in ("a", "b", os.path.join("b", "c"))]
+        )
+
+
+def test_fingerprints():
+
+    # Tests unchanged directories are skipped when walked again, after
+    # fingerprints are saved
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as state:
+
+        path = os.path.join(state, "fingerprints")
+        past = time.time_ns() - 3600 * 10 ** 9
+
+        def _age(d, delta=0):
+            # fingerprints are not recorded for recently modified directories
+            os.utime(d, ns=(past + delta, past + delta))
+
+        files = []
+        for k in ("a", "b", os.path.join("a", "c")):
+            os.makedirs(os.path.join(base, k), exist_ok=True)
+            for j in range(3):
+                files.append(os.path.join(base, k, "%d.jpg" % j))
+                open(files[-1], "wb").close()
+        for k in ("a", "b", os.path.join("a", "c"), ""):
+            _age(os.path.join(base, k))
+
+        def _walk(fingerprints):
+            found = walk(base, unchanged=fingerprints.unchanged, workers=2)
+            found = sorted([k.path for k in found])
+            for k in found:
+                fingerprints.handled(k)
+            return found
+
+        fingerprints = Fingerprints(path)
+        assert _walk(fingerprints) == sorted(files)
+        fingerprints.save(complete=True)
+        assert os.path.exists(path)
+
+        # loading removes the file: fingerprints are only trusted if saved
+        fingerprints = Fingerprints(path)
+        assert not os.path.exists(path)
+        assert _walk(fingerprints) == []
+        assert fingerprints.skipped == 4
+        fingerprints.save(complete=True)
+
+        # a new file in b: only that directory is listed again
+        files.append(os.path.join(base, "b", "new.jpg"))
+        open(files[-1], "wb").close()
+        _age(os.path.join(base, "b"), 10 ** 9)
+        fingerprints = Fingerprints(path)
+        b = os.path.join(base, "b")
+        assert _walk(fingerprints) == sorted(
+            [k for k in files if os.path.dirname(k) == b]
+        )
+
+        # interrupted scans keep previous fingerprints
+        fingerprints.save(complete=False)
+        assert len(Fingerprints(path).old) == 4
+
+        # forced full scans ignore them
+        fingerprints.save(complete=True)
+        assert _walk(Fingerprints(path, full=0)) == sorted(files)
+
+
+def test_fingerprints_failures():
+
+    # Tests directories with files that failed to import, or that were not
+    # processed, are scanned again on the next start
+
+    src = data_path()
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        path = os.path.join(dst, "fingerprints")
+        for k in ("good", "bad", "pending"):
+            os.mkdir(os.path.join(base, k))
+        for k, d in (
+            ("img_with_exif.jpg", "good"),
+            ("img_without_exif.jpg", "bad"),
+            ("img_with_xmp.png", "pending"),
+        ):
+            shutil.copy2(os.path.join(src, k), os.path.join(base, d))
+        past = time.time_ns() - 3600 * 10 ** 9
+        for k in ("good", "bad", "pending", ""):
+            os.utime(os.path.join(base, k), ns=(past, past))
+
+        # files without dates cannot be imported, "nodate" is not a directory
+        open(os.path.join(dst, "nodate"), "wb").close()
+
+        def _handler(fingerprints):
+            return Handler(
+                base,
+                dst,
+                "%Y",
+                timestamp=False,
+                nodate="nodate",
+                move=False,
+                dry=False,
+                hostname="docker",
+                sender="joe@example.com",
+                to=["alice@example.com"],
+                settle=0,
+                fingerprints=fingerprints,
+            )
+
+        fingerprints = Fingerprints(path)
+        handler = _handler(fingerprints)
+        handler.queue_existing()
+        handler.promote()
+        failed = os.path.join(base, "bad", "img_without_exif.jpg")
+        pending = os.path.join(base, "pending", "img_with_xmp.png")
+        handler.queue.discard(pending)  # e.g. shutdown before processing it
+        handler.process_queue()
+        assert list(handler.bad) == [failed]
+        fingerprints.save(complete=True)
+
+        # once fixed, the failed file is retried, and the one not processed
+        os.unlink(os.path.join(dst, "nodate"))
+        fingerprints = Fingerprints(path)
+        handler = _handler(fingerprints)
+        handler.queue_existing()
+        assert sorted(handler.pending) == sorted([failed, pending])
+        assert fingerprints.skipped == 2  # base and good
+        handler.promote()
+        handler.process_queue()
+        assert not handler.bad
+        fingerprints.save(complete=True)
+
+        fingerprints = Fingerprints(path)
+        _handler(fingerprints).queue_existing()
+        assert fingerprints.skipped == 4
+
+
+def test_rules():
+
+    # Tests default and custom rules, and that rules can be loaded from a file
+
+    rules = Rules()
+    assert rules.directory("2019") == ACCEPT
+    assert rules.directory(".git") == IGNORE
+    assert rules.directory("CANONMSC") == ERASE
+    assert rules.file("IMG_0001.JPG") == ACCEPT
+    assert rules.file("notes.txt") == UNSUPPORTED
+    assert rules.file(".Icon") == IGNORE
+    assert rules.file(".DS_Store") == IGNORE  # ignore rules come first
+    assert rules.check(os.path.join("a", ".hidden", "b", "x.jpg")) == IGNORE
+    assert rules.check(os.path.join("a", "MISC", "x.jpg")) == ACCEPT
+    assert rules.accepts(os.path.join("a", "b", "x.mov"))
+    assert "*.heic" in rules.patterns()
+
+    with TemporaryDirectory() as tmpdir:
+
+        path = os.path.join(tmpdir, "rules.json")
+        with open(path, "wt") as f:
+            f.write(
+                '{"extensions": [".JPG", ".dng"], '
+                '"erase-dirs": ["tmp*"], "erase-files": ["*.lrv"]}'
+            )
+        rules = Rules.load(path)
+        assert rules.file("a.dng") == ACCEPT
+        assert rules.file("a.png") == UNSUPPORTED
+        assert rules.file("GL010203.LRV") == UNSUPPORTED  # case-sensitive
+        assert rules.file("GL010203.lrv") == ERASE
+        assert rules.directory("tmp.1") == ERASE
+        assert rules.directory(".tmp") == IGNORE
+
+        with open(path, "wt") as f:
+            f.write('{"extension": [".jpg"]}')
+        with pytest.raises(ValueError):
+            Rules.load(path)
+
+        # the handler drops events for files that are not accepted
+        handler = Handler(
+            tmpdir,
+            tmpdir,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=True,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            rules=rules,
+        )
+        for name in ("a.dng", "b.png", os.path.join(".hidden", "c.jpg")):
+            handler.dispatch(
+                watchdog.events.FileClosedEvent(os.path.join(tmpdir, name))
+            )
+        assert list(handler.pending) == [os.path.join(tmpdir, "a.dng")]
+
+
+def test_reset_removes_touched_dirs():
+
+    # Tests only directories files were taken from are checked for emptiness
+
+    with TemporaryDirectory() as base:
+
+        for k in ("a/b/c", "a/d", "untouched", "full", ".hidden"):
+            os.makedirs(os.path.join(base, k))
+        open(os.path.join(base, "a", "b", "c", ".DS_Store"), "wb").close()
+        open(os.path.join(base, "full", "keep.jpg"), "wb").close()
+
+        handler = Handler(
+            base,
+            base,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+        )
+        handler.touched.update(
+            [
+                os.path.join(base, "a", "b", "c"),
+                os.path.join(base, "full"),
+                os.path.join(base, ".hidden"),
+            ]
+        )
+        # files submitted while a digest is being sent are not dropped
+        queued = os.path.join(base, "full", "keep.jpg")
+        handler.submit([queued])
+        removed = handler.reset().result()
+        handler.cleaner.shutdown()
+        assert handler.queue == set([queued])
+
+        assert removed == [
+            os.path.join(base, "a", "b", "c"),
+            os.path.join(base, "a", "b"),
+        ]
+        assert os.path.exists(os.path.join(base, "a", "d"))
+        assert os.path.exists(os.path.join(base, "untouched"))
+        assert os.path.exists(os.path.join(base, "full"))
+        assert os.path.exists(os.path.join(base, ".hidden"))
+        assert not handler.touched
+
+
+def test_results():
+
+    # Tests results are spilled to disk and summarized on e-mails
+
+    with TemporaryDirectory() as base:
+
+        results = Results(sample=3, threshold=10, dirname=base)
+        paths = [
+            os.path.join(base, "folder%d" % (k % 4), "%d.jpg" % k)
+            for k in range(25)
+        ]
+        for k in paths:
+            results.append(k)
+
+        assert len(results) == 25
+        assert results.spill is not None and os.path.exists(results.spill)
+        assert len(results._memory) == 5  # the rest was spilled
+        assert list(results) == paths
+        assert results.folders[os.path.join(base, "folder0")] == 7
+        table = gzip.decompress(results.table()).decode().splitlines()
+        assert table[0].startswith("path,src,dst,size")
+        assert [k.split(",")[0] for k in table[1:]] == paths
+
+        handler = Handler(
+            base,
+            base,
+            "%Y",
+            timestamp=False,
+            nodate="nodate",
+            move=True,
+            dry=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+        )
+        handler.good = results
+        email = handler.write_email()
+        assert email.subject.endswith("Organized 25 files for you")
+        assert "folder0: 7" in email.body
+        assert paths[-1] not in email.body
+        attachments = [k for k in email.msg.walk() if k.get_filename()]
+        assert [k.get_filename() for k in attachments] == ["moved.csv.gz"]
+
+        # with records, bytes and dates are summarized per folder
+        records = Results(sample=1, dirname=base)
+        paths = [os.path.join(base, "2002", "%d.jpg" % k) for k in range(3)]
+        for k, path in enumerate(paths):
+            date = DUMMY_DATE + datetime.timedelta(hours=k)
+            records.append(path, ImportRecord("/src.jpg", path, 1500, date))
+        records.append(os.path.join(base, "other", "x.jpg"))
+        assert records.size == 4500
+        body = Digest(base, base, records, Results()).body()
+        dates = "2002-01-26 11:49 to 13:49"
+        assert "Total: 4 files, 4.5 kB, dated %s" % dates in body
+        assert "  2002: 3, 4.5 kB, %s\n" % dates in body
+        assert "  other: 1\n" in body
+        row = gzip.decompress(records.table()).decode().splitlines()[1]
+        assert row.startswith("%s,/src.jpg,%s,1500," % (paths[0], paths[0]))
+
+        spill = results.spill
+        handler.reset().result()
+        assert not os.path.exists(spill)
+        assert not handler.good and list(handler.good) == []
+
+
+def test_verify_burst():
+
+    # Tests files missed by notifications during bursts are found, without
+    # finding files that were already processed
+
+    fmt = "%Y/%B/%d.%m.%Y"
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        card = os.path.join(base, "card", "DCIM")
+        os.makedirs(os.path.join(card, "100CANON"))
+        _time = time.mktime(DUMMY_DATE.timetuple())
+
+        handler = Handler(
+            base,
+            dst,
+            fmt,
+            timestamp=False,
+            nodate="nodate",
+            move=False,
+            dry=False,
+            hostname="docker",
+            sender="joe@example.com",
+            to=["alice@example.com"],
+            settle=0,
+        )
+        handler.BURST = 2
+
+        notified = os.path.join(card, "100CANON", "notified.jpg")
+        missed = os.path.join(card, "100CANON", "missed.jpg")
+        missed_dir = os.path.join(card, "101CANON", "missed.jpg")
+        untouched = os.path.join(card, "000OLD", "untouched.jpg")
+        for k in (notified, missed, missed_dir, untouched):
+            os.makedirs(os.path.dirname(k), exist_ok=True)
+            shutil.copy2(data_path("img_with_exif.jpg"), k)
+        os.utime(os.path.dirname(untouched), (_time, _time))
+
+        handler.MARGIN = 60.0  # files were created just before the "burst"
+        handler._active(notified)
+        handler._active(notified)
+        handler.queue.add(notified)
+        handler.process_queue()
+        assert len(handler.good) == 1
+
+        assert handler.verify(now=time.time()) is None
+        assert sorted(handler.pending) == sorted([missed, missed_dir])
+        assert handler.burst_since is None and not handler.recent
+
+
 def test_dedup():
 
     # test de-duplication of files works as expected
@@ -828,3 +2170,343 @@ def test_dedup():
         assert ex2 in check[0]
         assert copy3 in check[0]
         assert copy4 in check[0]
+
+
+def test_ledger():
+
+    # Tests files already imported are not imported again, in copy mode
+
+    bloom = BloomFilter(100)
+    for k in range(100):
+        bloom.add(b"%d" % k)
+    assert all([(b"%d" % k) in bloom for k in range(100)])
+    assert sum([(b"x%d" % k) in bloom for k in range(1000)]) < 50
+
+    fmt = "%Y/%B/%d.%m.%Y"
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        state = os.path.join(dst, ".state")
+        os.makedirs(state)
+        src = os.path.join(base, "img_with_exif.jpg")
+        shutil.copy2(data_path("img_with_exif.jpg"), src)
+        path = os.path.join(state, "ledger.sqlite")
+
+        def _copy(path):
+            args = (fmt, False, "nodate", False, False, None, ledger)
+            return copy(path, dst, *args)
+
+        ledger = Ledger(path)
+        assert ledger.contains(os.stat(src)) == (False, None)
+        result = _copy(src)
+        assert os.path.exists(result.dst)
+        assert ledger.contains(os.stat(src))[0]
+        ledger.close()
+
+        # persisted, even if the imported copy was removed
+        os.unlink(result.dst)
+        ledger = Ledger(path)
+        assert len(ledger) == 1
+        with pytest.raises(AlreadyImported):
+            _copy(src)
+        good, bad = rcopy(
+            base, dst, fmt, False, "nodate", False, False, ledger=ledger
+        )
+        assert not good and not bad
+        assert not os.path.exists(result.dst)
+
+        # a file with the same contents, but a different identity, is only
+        # recognized if contents are hashed
+        other = os.path.join(base, "other.jpg")
+        shutil.copy2(src, other)
+        assert not ledger.contains(os.stat(other), other)[0]
+        ledger.close()
+
+        ledger = Ledger(path, hash=True)
+        result = _copy(other)
+        third = os.path.join(base, "third.jpg")
+        shutil.copy2(src, third)
+        seen, digest = ledger.contains(os.stat(third), third)
+        assert seen and digest is not None
+        ledger.close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """A minimal SMTP server, that keeps messages received"""
+
+    def _reply(self, *lines):
+        self.wfile.write(b"".join([k.encode() + b"\r\n" for k in lines]))
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply("220 localhost ESMTP")
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line == b".\r\n":
+                    self.server.messages.append(b"".join(data))
+                    data = None
+                    self._reply("250 queued")
+                else:
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                continue
+            command = line[:4].upper()
+            self.server.commands.append(command.decode())
+            if command == b"EHLO":  # no STARTTLS
+                self._reply("250-localhost", "250-AUTH PLAIN", "250 8BITMIME")
+            elif command == b"RCPT" and b"refused" in line:
+                self._reply("550 no such user")
+            elif command == b"DATA":
+                self._reply("354 go ahead")
+                data = []
+            elif command == b"QUIT":
+                self._reply("221 bye")
+                break
+            else:
+                self._reply("250 ok")
+
+
+def test_mailer():
+
+    # Tests e-mails are delivered in the background, kept in the spool
+    # directory while the server is down, and delivered after a restart
+
+    def _email(subject):
+        return Email(subject, "body", "docker", "joe@example.com", ["a@b.c"])
+
+    with TemporaryDirectory() as spool:
+
+        # nothing listens on this port
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        mailer = Mailer("127.0.0.1", port, spool=spool, timeout=2)
+        start = time.time()
+        mailer.send(_email("first"))
+        assert time.time() - start < 1.0  # does not wait for the server
+        mailer.close(timeout=5)
+        assert len(mailer) == 1 and mailer.retry_at is not None
+        assert len([k for k in os.listdir(spool) if k.endswith(".eml")]) == 1
+
+        address = ("127.0.0.1", 0)
+        server = socketserver.ThreadingTCPServer(address, _SMTPHandler)
+        server.daemon_threads = True
+        server.connections, server.commands, server.messages = 0, [], []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            port = server.server_address[1]
+            mailer = Mailer("127.0.0.1", port, spool=spool, timeout=2)
+            assert len(mailer) == 1  # picked-up from the spool directory
+            mailer.start()
+            mailer.send(_email("second"))
+            mailer.send(_email("third"))
+            mailer.close(timeout=10)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        assert len(mailer) == 0 and mailer.delivered == 3
+        assert not [k for k in os.listdir(spool) if k.endswith(".eml")]
+        subjects = [
+            [k for k in m.splitlines() if k.startswith(b"Subject")][0]
+            for m in server.messages
+        ]
+        assert [k.split()[-1] for k in subjects] == [
+            b"first",
+            b"second",
+            b"third",
+        ]
+        # a single connection, no STARTTLS, as it was not advertised
+        assert server.connections == 1
+        assert "STAR" not in server.commands
+
+        server = socketserver.ThreadingTCPServer(address, _SMTPHandler)
+        server.daemon_threads = True
+        server.connections, server.commands, server.messages = 0, [], []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            port = server.server_address[1]
+
+            # refused recipients only set their message aside
+            mailer = Mailer("127.0.0.1", port, spool=spool, timeout=2)
+            refused = _email("refused")
+            refused.msg.replace_header("To", "refused@b.c")
+            mailer.send(refused)
+            mailer.send(_email("fourth"))
+            mailer.close(timeout=10)
+            assert len(mailer) == 0 and mailer.delivered == 1
+            assert len(os.listdir(os.path.join(spool, "failed"))) == 1
+
+            # credentials are never sent without STARTTLS, messages are kept
+            mailer = Mailer(
+                "127.0.0.1",
+                port,
+                username="joe",
+                password="secret",
+                spool=spool,
+                timeout=2,
+            )
+            mailer.send(_email("fifth"))
+            mailer.close(timeout=5)
+            assert len(mailer) == 1 and mailer.retry_at is not None
+            assert "AUTH" not in server.commands
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        assert len(server.messages) == 1
+
+
+def test_import_command(capsys):
+
+    # Tests the one-shot import command streams results and summarizes them
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        src = data_path("img_with_exif.jpg")
+        for k in (src, data_path("img_without_exif.jpg")):
+            shutil.copy2(k, base)
+        shutil.copy2(data_path("unsupported.txt"), base)
+        output = os.path.join(dst, "results.jsonl")
+
+        assert import_main(["--copy", "-W2", "-o", output, base, dst]) == 0
+        with open(output) as f:
+            lines = sorted([json.loads(k) for k in f], key=lambda k: k["src"])
+        statuses = [k["status"] for k in lines]
+        assert statuses == ["imported", "imported", "ignored"]
+        assert lines[0]["reader"] == "exif" and lines[0]["action"] == "copy"
+        assert lines[0]["size"] == os.path.getsize(src)
+        assert os.path.exists(lines[0]["dst"])
+        assert "2 file(s) imported, 1 ignored, 0 failed" in (
+            capsys.readouterr().err
+        )
+
+        # files that cannot be imported fail, and so does the command
+        assert import_main(["--copy", base, output]) == 1
+        assert "0 file(s) imported, 1 ignored, 2 failed" in (
+            capsys.readouterr().err
+        )
+
+
+def test_plan(capsys):
+
+    # Tests import plans resolve collisions without changing anything, and
+    # are executed as planned, skipping files that changed since
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as dst:
+
+        src = data_path("img_with_exif.jpg")
+        sources = []
+        for k in range(3):
+            os.makedirs(os.path.join(base, "%d" % k))
+            sources.append(os.path.join(base, "%d" % k, os.path.basename(src)))
+            shutil.copy2(src, sources[-1])
+            with open(sources[-1], "ab") as f:
+                f.write(b"\0" * k)  # different contents, same name
+        os.makedirs(os.path.join(base, "3"))
+        same = os.path.join(base, "3", os.path.basename(src))
+        shutil.copy2(sources[1], same)  # same contents, same name
+        plan = os.path.join(dst, "import.plan.gz")
+
+        assert import_main(["--copy", "--plan", plan, base, dst]) == 0
+        assert os.listdir(dst) == ["import.plan.gz"]  # nothing else
+        header, entries = read_plan(plan)
+        assert header["move"] is False and header["dst"] == dst
+        entries = dict([(k[0], k) for k in entries])
+        names = set([os.path.basename(k[3]) for k in entries.values()])
+        assert sorted(names) == [
+            "img_with_exif.jpg",
+            "img_with_exif~.jpg",
+            "img_with_exif~~.jpg",
+        ]
+        assert all([k[4].startswith("2003-12-14") for k in entries.values()])
+        # identical files in the plan are imported once
+        pair = [entries[os.path.relpath(k, base)] for k in (sources[1], same)]
+        assert pair[0][3] == pair[1][3]
+        assert sorted([k[6] for k in pair]) == ["copy", "skip"]
+        assert "4 file(s) planned" in capsys.readouterr().err
+
+        # changes after planning are detected
+        with open(sources[2], "ab") as f:
+            f.write(b"\0")
+        output = os.path.join(dst, "results.jsonl")
+        assert import_main(["--execute", plan, "--output", output]) == 1
+        with open(output) as f:
+            results = dict([(k["src"], k) for k in map(json.loads, f)])
+        assert results[sources[2]]["error"] == SourceChanged.__name__
+        for k in sources[:2] + [same]:
+            planned = os.path.join(dst, entries[os.path.relpath(k, base)][3])
+            assert results[k]["dst"] == planned
+            with open(k, "rb") as f1, open(planned, "rb") as f2:
+                assert f1.read() == f2.read()
+        actions = [results[k]["action"] for k in (sources[1], same)]
+        assert sorted(actions) == ["copy", "skip"]
+
+
+def test_check_date_bulk(capsys):
+
+    # Tests dates are checked recursively and concurrently, with details on
+    # how they were found, and a summary per extension and camera model
+
+    with TemporaryDirectory() as base, TemporaryDirectory() as tmp:
+
+        os.makedirs(os.path.join(base, "sub", ".hidden"))
+        for k in ("with_exif.jpg", "without_exif.jpg", "with_xmp.png"):
+            shutil.copy2(data_path("img_" + k), os.path.join(base, "sub"))
+        shutil.copy2(data_path("unsupported.txt"), base)
+        hidden = os.path.join(base, "sub", ".hidden")
+        shutil.copy2(data_path("img_with_exif.jpg"), hidden)
+        output = os.path.join(tmp, "dates.csv")
+        argv = ["-W2", "-F", "csv", "-o", output, "--summary", base]
+        assert check_date_main(argv) == 0
+        with open(output, newline="") as f:
+            rows = csv.DictReader(f)
+            rows = dict([(os.path.basename(k["path"]), k) for k in rows])
+        assert sorted(rows) == [
+            "img_with_exif.jpg",
+            "img_with_xmp.png",
+            "img_without_exif.jpg",
+            "unsupported.txt",
+        ]
+        row = rows["img_with_exif.jpg"]
+        assert row["reader"] == "exif" and row["fallback"] == "False"
+        assert row["model"] == "Canon PowerShot S40"
+        assert row["date"] == "2003-12-14T12:01:44"
+        assert float(row["elapsed"]) > 0
+        assert row["bytes"] == "" or int(row["bytes"]) > 0
+        assert rows["unsupported.txt"]["bytes"] in ("", "0")  # not read
+        row = rows["img_without_exif.jpg"]
+        assert row["reader"] == "timestamp" and row["fallback"] == "True"
+        assert row["error"]
+        assert rows["img_with_xmp.png"]["reader"] == "xmp"
+        row = rows["unsupported.txt"]
+        assert row["error"] == "unsupported extension" and row["date"] == ""
+        summary = capsys.readouterr().err
+        assert "Total: 4 file(s), 2 failed" in summary
+        assert "  .jpg: 2 file(s), 1 failed" in summary
+        assert "  Canon PowerShot S40: 1 file(s), 0 failed" in summary
+        assert "  .txt: 1 file(s), 1 failed (100.0%)" in summary
+
+        # json lines, for a single file
+        src = data_path("img_with_exif.jpg")
+        assert check_date_main(["--format=json", src]) == 0
+        line = json.loads(capsys.readouterr().out)
+        assert line["path"] == src and line["reader"] == "exif"
+        assert line["fallback"] is False and line["extension"] == ".jpg"
+
+        # text, as before, marking files without date metadata
+        src = data_path("img_without_exif.jpg")
+        assert check_date_main([src]) == 0
+        assert capsys.readouterr().out.endswith("(file timestamp)\n")
+
+        # files that cannot be read are reported, without stopping the audit
+        gone = [os.path.join(base, "gone" + k) for k in (".jpg", ".aae")]
+        probes = list(probe_all(gone + [src], workers=2))
+        assert [k.path for k in probes] == gone + [src]
+        assert probes[0].failed and probes[0].date is None
+        assert probes[1].failed and probes[1].date is None
+        assert probes[2].reader == "timestamp"
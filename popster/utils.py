@@ -208,10 +208,21 @@ def heic_to_jpeg(sips, path, quality="best"):
     return output_path
 
 
-def files_match(p1, p2):
+def files_match(p1, p2, chunk=1 << 20):
     """Returns ``True`` if files pointed by path ``p1`` and ``p2`` have equal
     contents.  Otherwise, ``False``.
+
+    Sizes are compared first.  Contents are then compared block by block,
+    stopping at the first difference.
     """
 
-    __import__('ipdb').set_trace()
-    pass
+    if os.path.getsize(p1) != os.path.getsize(p2):
+        return False
+
+    with open(p1, "rb") as f1, open(p2, "rb") as f2:
+        while True:
+            b1 = f1.read(chunk)
+            if b1 != f2.read(chunk):
+                return False
+            if not b1:
+                return True
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A parallel, streaming, directory tree walker based on :py:func:`os.scandir`
+
+Compared to :py:func:`os.walk`, this walker yields :py:class:`os.DirEntry`
+objects, that cache file type and stat information, so callers do not need to
+re-join paths or stat files again.  Selection rules for directories and files
+are applied while traversing, so pruned subtrees are never listed.  Several
+directories can be listed concurrently, which is a big win on network file
+systems, where each listing pays a round-trip.
+"""
+
+import os
+import concurrent.futures
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _list(path, select_dir, select_file, unchanged=None):
+    """Lists a single directory, applying selection rules
+
+
+  Returns:
+
+    list: A list of :py:class:`os.DirEntry` objects, for selected files
+
+    list: A list of :py:class:`os.DirEntry` objects, for selected directories
+
+  """
+
+    files, dirs = [], []
+
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    # like os.walk(), do not follow symbolic links to dirs
+                    if entry.is_symlink():
+                        continue
+                    if select_dir is None or select_dir(entry):
+                        dirs.append(entry)
+                elif select_file is None or select_file(entry):
+                    files.append(entry)
+    except OSError as e:
+        logger.debug("cannot list %s: %s", path, e)
+        return files, dirs
+
+    if unchanged is not None and unchanged(path, files, dirs):
+        files = []
+
+    return files, dirs
+
+
+def walk(
+    base,
+    select_dir=None,
+    select_file=None,
+    workers=1,
+    directories=False,
+    unchanged=None,
+):
+    """Walks a directory tree, yielding entries as they are found
+
+
+  Parameters:
+
+    base (str): The path leading to the directory to walk
+
+    select_dir (callable): If set, a function that is called with the
+      :py:class:`os.DirEntry` of every directory found.  If it returns
+      ``False``, the directory is not traversed.  It may also erase the
+      directory, if that is desired.
+
+    select_file (callable): If set, a function that is called with the
+      :py:class:`os.DirEntry` of every file found.  If it returns ``False``,
+      the file is not yielded.
+
+    workers (int): Number of directories to list concurrently.  If larger than
+      one, directories to be visited next are listed ahead of time, on a pool
+      of threads.  Entries are yielded in the same order in any case.
+
+    directories (bool): If set, also yields entries for (selected)
+      directories, before any of their contents.
+
+    unchanged (callable): If set, a function that is called with the path of
+      every directory listed, and the lists of :py:class:`os.DirEntry` objects
+      for files and directories selected in it.  If it returns ``True``,
+      files in that directory are not yielded (its sub-directories are still
+      traversed).  See :py:class:`popster.fingerprints.Fingerprints`.
+
+
+  Yields:
+
+    os.DirEntry: An entry for each selected file (and directory, if requested)
+    found under ``base``
+
+  """
+
+    if workers <= 1:
+
+        stack = [base]
+        while stack:
+            files, dirs = _list(
+                stack.pop(), select_dir, select_file, unchanged
+            )
+            if directories:
+                yield from dirs
+            yield from files
+            stack.extend(reversed([k.path for k in dirs]))
+
+        return
+
+    # keeps a bounded number of listings in flight, for the directories on
+    # top of the stack (visited next), so directories deeper in the stack are
+    # just paths
+    stack = [base]
+    inflight = 0
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+
+        while stack:
+            k = len(stack) - 1
+            while k >= 0 and (inflight < 2 * workers or k == len(stack) - 1):
+                if isinstance(stack[k], str):
+                    stack[k] = pool.submit(
+                        _list, stack[k], select_dir, select_file, unchanged
+                    )
+                    inflight += 1
+                k -= 1
+            files, dirs = stack.pop().result()
+            inflight -= 1
+            if directories:
+                yield from dirs
+            yield from files
+            stack.extend(reversed([k.path for k in dirs]))
@@ -3,7 +3,7 @@
 
 """Watches and imports photos recursively from a folder
 
-Usage: %(prog)s [-v...] [options]
+Usage: %(prog)s [-v...] [--route=<spec>...] [options]
        %(prog)s --help
        %(prog)s --version
 
@@ -32,12 +32,22 @@ Options:
                               [default: /organized]
   -c, --copy                  Copy instead of moving files from the source
                               folder (this will be a bit slower).
-  -p, --check-point=<secs>    Number of seconds to wait before each check. This
-                              number should be smaller than the idleness
-                              setting. [default: 10]
+  -r, --route=<spec>          Watches another folder, importing photos into
+                              its own destination. The specification is a
+                              comma-separated list of settings, e.g.:
+                              "source=/usb,dest=/organized/usb,copy". Settings
+                              are "source", "dest" (mandatory), and
+                              "folder-format", "no-date-path", "copy" and
+                              "filesystem-timestamp" (that default to the
+                              options above). May be used multiple times
+  -p, --check-point=<secs>    Ignored, kept for backwards compatibility. Files
+                              are imported as soon as they are complete
+                              [default: 10]
   -i, --idleness=<secs>       Number of seconds to wait until no more activity
                               is registered and before it can dispatch summary
                               e-mails [default: 30]
+  -M, --max-idleness=<secs>   The idleness period adapts to bursts of activity,
+                              up to this number of seconds [default: 300]
   -S, --server=<host>         Name of the SMTP server to use for sending the
                               message [default: smtp.gmail.com]
   -P, --port=<port>           Port to use on the server [default: 587]
@@ -54,6 +64,61 @@ Options:
                               images using the filesystem timestamp - first try
                               the creation time if available, else the
                               last modification time.
+  -t, --state=<path>          Path leading to a directory where to keep state
+                              across restarts (e.g. the journal of in-flight
+                              imports, used for crash recovery). If not set,
+                              then no state is kept
+  -l, --settle=<secs>         Number of seconds a file's size and modification
+                              time must remain unchanged for, before it is
+                              imported. Files are imported as soon as they are
+                              closed, on systems that report it [default: 2]
+  -W, --workers=<n>           Number of threads to use for importing files
+                              concurrently [default: 4]
+  -o, --poll=<secs>           If set, poll the source folder for changes every
+                              this number of seconds, instead of relying on
+                              file system notifications. Use this if the
+                              source folder is a network mount (SMB, NFS)
+  -O, --max-poll=<secs>       When polling, the interval grows while no
+                              changes are found, up to this number of seconds
+                              [default: 60]
+  -L, --max-watches=<n>       If set, watch at most this number of directories
+                              (per source folder) with file system
+                              notifications, and poll all others. The most
+                              recently active directories are watched. Use
+                              this if the source folder is too large to be
+                              watched within the limits of your system
+  -R, --order=<name>          Order in which files waiting to be imported are
+                              processed: "size" (smaller files first),
+                              "inode" (favours sequential reads) or "arrival".
+                              Files on different devices take turns
+                              [default: size]
+  -J, --lanes=<n>             If set, copy at most this number of files from
+                              the same device at once
+  -U, --rules=<path>          Path leading to a JSON file with rules deciding
+                              which files are imported, ignored or erased. It
+                              may set lists "extensions", "ignore-dirs",
+                              "erase-dirs", "ignore-files" and "erase-files".
+                              Names may contain wildcards. Lists not set keep
+                              their defaults
+  -k, --socket=<path>         If set, listen on a Unix socket at this path for
+                              requests to import files or folders right away.
+                              These must be under a source folder. See the
+                              documentation of popster.api
+  -a, --full-scan=<days>      When copying, and if a state directory is set,
+                              directories of the source folder that did not
+                              change since the last run are not scanned again
+                              on start-up. A full scan is forced once every
+                              this number of days, and on every start-up if
+                              set to 0 [default: 7]
+  -K, --content-hash          When copying, and if a state directory is set,
+                              files already imported are never imported
+                              again. If set, recognize them by a hash of their
+                              contents too, e.g. on memory cards mounted as a
+                              different device (this reads new files twice)
+  -D, --drain=<secs>          Number of seconds to spend processing queued
+                              files after a termination request (SIGTERM or
+                              CTRL-C). Files that are left are persisted in
+                              the state directory [default: 8]
 
 
 Examples:
@@ -66,12 +131,67 @@ Examples:
 
      $ %(prog)s -vv --email --username=me@gmail.com --password=secret --sender=bob@example.com --to='alice@example.com,jack@example.com'
 
+  3. Imports photos from an SD card slot and a USB port, into different
+     folders:
+
+     $ %(prog)s -vv --source=/sdcard --dest=/organized --route=source=/usb,dest=/organized/usb
+
 """
 
 
 import os
 import sys
-import time
+import signal
+
+
+def parse_route(spec):
+    """Parses a route specification, as passed to ``--route``
+
+
+  Parameters:
+
+    spec (str): A comma-separated list of settings, e.g.
+      ``source=/usb,dest=/organized/usb,copy``
+
+
+  Returns:
+
+    dict: A dictionary with keys accepted by :py:class:`popster.sorter.Sorter`
+    routes
+
+
+  Raises:
+
+    ValueError: If the specification is invalid
+
+  """
+
+    keys = {
+        "source": "base",
+        "dest": "dst",
+        "folder-format": "fmt",
+        "no-date-path": "nodate",
+    }
+    flags = {
+        "copy": ("move", False),
+        "filesystem-timestamp": ("timestamp", True),
+    }
+
+    retval = {}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key in flags and not value:
+            retval[flags[key][0]] = flags[key][1]
+        elif key in keys and value:
+            retval[keys[key]] = value
+        else:
+            raise ValueError("invalid setting %r in route %r" % (item, spec))
+
+    if "base" not in retval or "dst" not in retval:
+        raise ValueError("route %r must set source and dest" % spec)
+
+    return retval
 
 
 def main(user_input=None):
@@ -96,6 +216,7 @@ def main(user_input=None):
     )
 
     from .sorter import setup_logger, Sorter
+    from .rules import Rules
 
     logger = setup_logger("popster", args["--verbose"])
 
@@ -106,13 +227,39 @@ def main(user_input=None):
     )
     logger.info("Watching for photos/movies on: %s", args["--source"])
     logger.info("Moving photos/movies to: %s", args["--dest"])
+    routes = [parse_route(k) for k in args["--route"]]
+    for k in routes:
+        logger.info("Additional route: %s -> %s", k["base"], k["dst"])
     logger.info("Folder format set to: %s", args["--folder-format"])
     logger.info(
         "Default to filesystem timestamps: %s", args["--filesystem-timestamp"]
     )
     logger.info("No-date path set to: %s", args["--no-date-path"])
-    logger.info("Checkpoint timeout: %s seconds", args["--check-point"])
-    logger.info("Idle time set to: %s seconds", args["--idleness"])
+    logger.info(
+        "Idle time set to: %s seconds (up to %s seconds)",
+        args["--idleness"],
+        args["--max-idleness"],
+    )
+    logger.info("State directory: %s", args["--state"])
+    logger.info("Number of workers: %s", args["--workers"])
+    logger.info("Settle time: %s seconds", args["--settle"])
+    logger.info("Drain timeout: %s seconds", args["--drain"])
+    logger.info("Full scan every: %s days", args["--full-scan"])
+    logger.info("Hash contents of imported files: %s", args["--content-hash"])
+    logger.info("Import order: %s", args["--order"])
+    logger.info("Rules: %s", args["--rules"] or "(defaults)")
+    if args["--socket"]:
+        logger.info("Listening for requests on: %s", args["--socket"])
+    if args["--lanes"]:
+        logger.info("Concurrent copies per device: %s", args["--lanes"])
+    if args["--max-watches"]:
+        logger.info("Maximum number of watches: %s", args["--max-watches"])
+    if args["--poll"]:
+        logger.info(
+            "Polling every %s seconds (up to %s seconds)",
+            args["--poll"],
+            args["--max-poll"],
+        )
     if args["--email"]:
         logger.info("Sending **real** e-mails")
     else:
@@ -120,8 +267,9 @@ def main(user_input=None):
     logger.info("E-mail From: %s", args["--sender"])
     logger.info("E-mail To: %s", args["--to"])
 
-    check_point = int(args["--check-point"])
     idleness = int(args["--idleness"])
+    max_idleness = int(args["--max-idleness"])
+    drain = int(args["--drain"])
 
     if args["--email"]:
         to = [k.strip() for k in args["--to"].split(",")]
@@ -145,13 +293,44 @@ def main(user_input=None):
         username=args["--username"],
         password=args["--password"],
         idleness=idleness,
+        state=args["--state"],
+        workers=int(args["--workers"]),
+        settle=float(args["--settle"]),
+        max_idleness=max_idleness,
+        poll=float(args["--poll"]) if args["--poll"] else None,
+        max_poll=float(args["--max-poll"]),
+        routes=routes,
+        max_watches=int(args["--max-watches"] or 0),
+        full_scan=float(args["--full-scan"]) * 24 * 60 * 60,
+        order=args["--order"],
+        lanes=int(args["--lanes"] or 0) or None,
+        rules=Rules.load(args["--rules"]) if args["--rules"] else None,
+        content_hash=args["--content-hash"],
     )
 
+    def _terminate(signum, frame):
+        logger.info("Received signal %d, draining...", signum)
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _terminate)
+
+    api = None
+    if args["--socket"]:
+        from .api import Server
+
+        api = Server(args["--socket"], the_sorter)
+
+    # files are processed on a separate thread, as soon as they are complete
     the_sorter.start()
+    if api is not None:
+        api.start()
     try:
         while True:
-            time.sleep(check_point)
-            the_sorter.check_point()
+            signal.pause()
     except KeyboardInterrupt:
+        if api is not None:
+            api.stop()
         the_sorter.stop()
-    the_sorter.join()
+    the_sorter.join(drain)
+    if api is not None:
+        api.close()
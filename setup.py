@@ -28,6 +28,7 @@ setup(
     entry_points={
         "console_scripts": [
             "watch = popster.watch:main",
+            "import = popster.importer:main",
             "check_date = popster.check_date:main",
             "heic_to_jpeg = popster.heic_to_jpeg:main",
             "deduplicate = popster.deduplicate:main",